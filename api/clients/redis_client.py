@@ -2,6 +2,16 @@ import os
 
 import redis
 
+from api.metrics import REDIS_SECONDS
+
 redis_host = os.getenv('REDIS_HOST', 'localhost')
 redis_port = int(os.getenv('REDIS_PORT', '6379'))
-redis_client = redis.Redis(decode_responses=True, host=redis_host, port=redis_port)
+
+
+class InstrumentedRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        with REDIS_SECONDS.labels(str(args[0]).lower()).time():
+            return super().execute_command(*args, **options)
+
+
+redis_client = InstrumentedRedis(decode_responses=True, host=redis_host, port=redis_port)
@@ -1,9 +1,12 @@
 import json
-from typing import TypedDict, Optional, List
+from typing import TypedDict, Optional, List, Dict
 
 from api.clients.redis_client import redis_client
+from api.data_models.versions import bump_version, annotations_resource
 
 REDIS_KEY = 'annotations'
+# Species and name of the annotation recorded for an image in which nothing was detected.
+UNDETECTED = 'undetected'
 
 
 class Annotation(TypedDict):
@@ -22,12 +25,15 @@ class Annotation(TypedDict):
 def truncate_annotations_for_collection(collection_id: str) -> None:
     key = __key_for_collection(collection_id)
     redis_client.delete(key)
+    bump_version(annotations_resource(collection_id))
 
 
 def save_annotations_for_collection(collection_id: str, annotations: List[Annotation]) -> None:
+    if len(annotations) == 0:
+        return
     key = __key_for_collection(collection_id)
-    for annotation in annotations:
-        redis_client.hset(key, annotation['id'], json.dumps(annotation))
+    redis_client.hset(key, mapping={annotation['id']: json.dumps(annotation) for annotation in annotations})
+    bump_version(annotations_resource(collection_id))
 
 
 def read_annotations_for_collection(collection_id: str) -> List[Annotation]:
@@ -38,5 +44,23 @@ def read_annotations_for_collection(collection_id: str) -> List[Annotation]:
     return annotations
 
 
+def read_annotations_by_id(collection_id: str, annotation_ids: List[str]) -> Dict[str, Annotation]:
+    if len(annotation_ids) == 0:
+        return {}
+    key = __key_for_collection(collection_id)
+    annotations = {}
+    for annotation_id, annotation_json in zip(annotation_ids, redis_client.hmget(key, annotation_ids)):
+        if annotation_json is not None:
+            annotations[annotation_id] = json.loads(annotation_json)
+    return annotations
+
+
+def delete_annotations_for_collection(collection_id: str, annotation_ids: List[str]) -> None:
+    if len(annotation_ids) == 0:
+        return
+    redis_client.hdel(__key_for_collection(collection_id), *annotation_ids)
+    bump_version(annotations_resource(collection_id))
+
+
 def __key_for_collection(collection_id: str) -> str:
     return f'{REDIS_KEY}:collections:{collection_id}'
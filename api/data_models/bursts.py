@@ -0,0 +1,82 @@
+import json
+import os
+from typing import TypedDict, List, Set
+
+from api.clients.redis_client import redis_client
+
+REDIS_KEY = 'bursts'
+
+
+class Burst(TypedDict):
+    id: str
+    representative: str
+    file_names: List[str]
+
+
+class BurstReport(TypedDict):
+    frames: int
+    bursts: int
+    inferred_frames: int
+    skipped_frames: int
+    saved_fraction: float
+
+
+def burst_report(bursts: List[Burst]) -> BurstReport:
+    frames = sum(len(b['file_names']) for b in bursts)
+    return BurstReport(
+        frames=frames,
+        bursts=len(bursts),
+        inferred_frames=len(bursts),
+        skipped_frames=frames - len(bursts),
+        saved_fraction=(frames - len(bursts)) / frames if frames > 0 else 0
+    )
+
+
+def save_bursts_for_collection(collection_id: str, bursts: List[Burst]) -> None:
+    key = __key_for_collection(collection_id)
+    redis_client.delete(key)
+    if len(bursts) > 0:
+        redis_client.hset(key, mapping={burst['id']: json.dumps(burst) for burst in bursts})
+
+
+def read_bursts_for_collection(collection_id: str) -> List[Burst]:
+    bursts = [json.loads(s) for s in redis_client.hvals(__key_for_collection(collection_id))]
+    bursts.sort(key=lambda b: b['representative'])
+    return bursts
+
+
+def remove_frames_from_bursts(collection_id: str, file_names: Set[str]) -> None:
+    """
+    Removes deleted frames from their bursts. A burst whose representative was removed is represented by its next frame.
+    """
+    if len(file_names) == 0:
+        return
+    bursts = []
+    for burst in read_bursts_for_collection(collection_id):
+        remaining = [f for f in burst['file_names'] if f not in file_names]
+        if len(remaining) == 0:
+            continue
+        representative = burst['representative'] if burst['representative'] in remaining else remaining[0]
+        bursts.append(Burst(id=os.path.basename(representative), representative=representative, file_names=remaining))
+    save_bursts_for_collection(collection_id, bursts)
+    redis_client.srem(__split_key_for_collection(collection_id), *file_names)
+
+
+def save_split_frames(collection_id: str, file_names: List[str]) -> None:
+    """
+    Marks frames that a reviewer split out of their burst, so they are never grouped again.
+    """
+    if len(file_names) > 0:
+        redis_client.sadd(__split_key_for_collection(collection_id), *file_names)
+
+
+def read_split_frames(collection_id: str) -> Set[str]:
+    return set(redis_client.smembers(__split_key_for_collection(collection_id)))
+
+
+def __key_for_collection(collection_id: str) -> str:
+    return f'{REDIS_KEY}:collections:{collection_id}'
+
+
+def __split_key_for_collection(collection_id: str) -> str:
+    return f'{REDIS_KEY}:split:{collection_id}'
@@ -0,0 +1,38 @@
+import json
+from typing import TypedDict, List, Set
+
+from api.clients.redis_client import redis_client
+
+REDIS_KEY = 'clips'
+
+
+class ClipFrame(TypedDict):
+    # The uploaded video clip the frame was sampled from.
+    clip: str
+    # The sampled frame, which is predicted like any other image of the collection.
+    file_name: str
+    frame_index: int
+    # Seconds from the start of the clip.
+    timestamp: float
+
+
+def save_clip_frames(collection_id: str, frames: List[ClipFrame]) -> None:
+    if len(frames) > 0:
+        redis_client.hset(
+            __key_for_collection(collection_id), mapping={frame['file_name']: json.dumps(frame) for frame in frames}
+        )
+
+
+def read_clip_frames_for_collection(collection_id: str) -> List[ClipFrame]:
+    frames = [json.loads(s) for s in redis_client.hvals(__key_for_collection(collection_id))]
+    frames.sort(key=lambda f: (f['clip'], f['timestamp']))
+    return frames
+
+
+def remove_frames_from_clips(collection_id: str, file_names: Set[str]) -> None:
+    if len(file_names) > 0:
+        redis_client.hdel(__key_for_collection(collection_id), *file_names)
+
+
+def __key_for_collection(collection_id: str) -> str:
+    return f'{REDIS_KEY}:collections:{collection_id}'
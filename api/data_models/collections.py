@@ -2,6 +2,7 @@ import json
 from typing import TypedDict, List
 
 from api.clients.redis_client import redis_client
+from api.data_models.versions import bump_version, collections_resource
 
 REDIS_KEY = 'collections'
 
@@ -21,3 +22,4 @@ def read_collections_from_redis() -> List[Collection]:
 
 def save_collection_to_redis(collection: Collection) -> None:
     redis_client.hset(REDIS_KEY, collection['id'], json.dumps(collection))
+    bump_version(collections_resource())
@@ -0,0 +1,104 @@
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List
+
+from api.clients.s3_client import s3_bucket
+from api.decoding import decode_image
+from api.metrics import submit_tracked
+
+logger = logging.getLogger(__name__)
+
+WEBSITE_DATA_PATH = 'website-data'
+DERIVATIVES_PATH = f'{WEBSITE_DATA_PATH}/derivatives'
+
+# The longest side, in pixels, of each derivative variant.
+DERIVATIVE_SIZES = {
+    'thumbnail': 256,
+    'review': 1024,
+}
+PREWARM_VARIANT = 'thumbnail'
+DERIVATIVE_QUALITY = 85
+
+prewarm_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='derivative-prewarm')
+
+
+def derivative_location(variant: str, name: str) -> str:
+    """
+    Parameters:
+    variant: one of the keys of DERIVATIVE_SIZES
+    name: the path of the source image, relative to the website-data directory
+    Returns: the local path of the derivative
+    """
+    return f'{DERIVATIVES_PATH}/{variant}/{name}'
+
+
+def derivative_locations_for(file_name: str) -> List[str]:
+    """
+    Returns the local paths of every derivative variant of a website-data file.
+    """
+    name = file_name.removeprefix(f'{WEBSITE_DATA_PATH}/')
+    return [derivative_location(variant, name) for variant in DERIVATIVE_SIZES]
+
+
+def ensure_derivative(variant: str, name: str) -> Optional[str]:
+    """
+    Generates the derivative of a source image if it is missing or older than the source.
+    Returns the local path of the derivative, or None if the source image does not exist.
+    """
+    source = __local_source(name)
+    if source is None:
+        return None
+
+    dest = derivative_location(variant, name)
+    if os.path.exists(dest) and os.path.getmtime(dest) >= os.path.getmtime(source):
+        return dest
+
+    size = DERIVATIVE_SIZES[variant]
+    # Most of the full resolution is discarded, so let the decoder downscale.
+    image = decode_image(source, (size, size))
+    image.thumbnail((size, size))
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # Write to a temporary file first, so concurrent requests never serve a partially written derivative.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        image.save(f, format='JPEG', quality=DERIVATIVE_QUALITY)
+    os.replace(tmp_path, dest)
+    return dest
+
+
+def prewarm_derivatives(file_names: List[str], variant: str = PREWARM_VARIANT) -> None:
+    """
+    Generates derivatives for newly written website-data files in the background.
+    """
+    names = []
+    for file_name in file_names:
+        if file_name is not None and file_name.startswith(f'{WEBSITE_DATA_PATH}/'):
+            names.append(file_name.removeprefix(f'{WEBSITE_DATA_PATH}/'))
+    if len(names) > 0:
+        submit_tracked(prewarm_executor, 'derivatives', __prewarm, variant, names)
+
+
+def __prewarm(variant: str, names: List[str]) -> None:
+    for name in names:
+        try:
+            ensure_derivative(variant, name)
+        except Exception:
+            logger.exception(f'Failed to generate the {variant} derivative for {name}.')
+
+
+def __local_source(name: str) -> Optional[str]:
+    source = f'{WEBSITE_DATA_PATH}/{name}'
+    if os.path.exists(source):
+        return source
+    if s3_bucket is None:
+        return None
+    try:
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        s3_bucket.download_file(source, source)
+    except Exception:
+        logger.warning(f'Source image {source} not found in S3.')
+        return None
+    return source
@@ -1,19 +1,30 @@
 import glob
 import os
 from typing import NamedTuple, List
-import PIL
-from PIL import Image
+import PIL.Image
 
 from werkzeug.datastructures import ImmutableMultiDict, FileStorage
 
 from api.clients.s3_client import s3_bucket
+from api.data_models.annotations import read_annotations_for_collection, delete_annotations_for_collection
+from api.data_models.bursts import remove_frames_from_bursts
+from api.data_models.clips import ClipFrame, save_clip_frames, read_clip_frames_for_collection, \
+    remove_frames_from_clips
+from api.data_models.derivatives import prewarm_derivatives, derivative_locations_for
+from api.data_models.versions import bump_version, images_resource
+from api.decoding import decode_resized
+from api.metrics import observe_stage
+from api.storage import DeleteReport, stored_file, delete_stored_files
+from api.video import is_video, sample_frames
 
 INPUTS_PATH = 'website-data/inputs'
+OUTPUTS_PATH = 'website-data/outputs'
+# Uploaded video clips are kept under `<INPUTS_PATH>/<collectionID>/<CLIPS_DIR>/`, apart from the images.
+CLIPS_DIR = 'clips'
 
 
 class InputImage(NamedTuple):
     file_name: str
-    original_image: PIL.Image.Image
     original_height: int
     original_width: int
     resized_image: PIL.Image.Image
@@ -21,10 +32,18 @@ class InputImage(NamedTuple):
 
 def list_image_paths_for_collection(collection_id: str) -> List[str]:
     if s3_bucket is not None:
-        return [o.key for o in s3_bucket.objects.filter(Prefix=f'{INPUTS_PATH}/{collection_id}/')]
+        clips_prefix = clips_location(collection_id)
+        return [
+            o.key for o in s3_bucket.objects.filter(Prefix=f'{INPUTS_PATH}/{collection_id}/')
+            if not o.key.startswith(f'{clips_prefix}/')
+        ]
     return [fname for fname in glob.glob(f'{INPUTS_PATH}/{collection_id}/**.jpg')]
 
 
+def clips_location(collection_id: str) -> str:
+    return f'{INPUTS_PATH}/{collection_id}/{CLIPS_DIR}'
+
+
 def read_images_for_collection(collection_id: str) -> List[InputImage]:
     return read_images(list_image_paths_for_collection(collection_id))
 
@@ -32,39 +51,97 @@ def read_images_for_collection(collection_id: str) -> List[InputImage]:
 def read_images(file_names: List[str]) -> List[InputImage]:
     images = []
     for file_name in file_names:
-        pil_image = PIL.Image.open(file_name)
-        width, height = pil_image.size
-        images.append(InputImage(
-            file_name=file_name,
-            original_image=pil_image,
-            original_height=height,
-            original_width=width,
-            resized_image=pil_image.resize((640, 640))
-        ))
+        with observe_stage('decode'):
+            resized_image, (width, height) = decode_resized(file_name, (640, 640))
+            images.append(InputImage(
+                file_name=file_name,
+                original_height=height,
+                original_width=width,
+                resized_image=resized_image
+            ))
     return images
 
 
 def save_images_for_collection(collection_id: str, files: ImmutableMultiDict[str, FileStorage]) -> List[str]:
+    """
+    Saves uploaded images, and the frames sampled from uploaded video clips, as inputs of a collection.
+    """
     os.makedirs(f'{INPUTS_PATH}/{collection_id}', exist_ok=True)
     uploaded = []
-    for file_name in files:
-        dest = f'{INPUTS_PATH}/{collection_id}/{os.path.basename(file_name)}'
-        files[file_name].save(dest)
-        if s3_bucket is not None:
-            s3_bucket.upload_file(dest, dest)
-        uploaded.append(dest)
+    try:
+        for file_name in files:
+            if is_video(file_name):
+                uploaded += save_clip_for_collection(collection_id, file_name, files[file_name])
+                continue
+            dest = f'{INPUTS_PATH}/{collection_id}/{os.path.basename(file_name)}'
+            files[file_name].save(dest)
+            if s3_bucket is not None:
+                s3_bucket.upload_file(dest, dest)
+            uploaded.append(dest)
+    finally:
+        # Images saved before a clip failed to decode are kept.
+        bump_version(images_resource(collection_id))
+        prewarm_derivatives(uploaded)
     return uploaded
 
 
-def delete_images_for_collection(collection_id: str, file_names: List[str]) -> None:
-    real_file_names = []
-    for file_name in file_names:
-        real_file_names.append(f'{INPUTS_PATH}/{collection_id}/{os.path.basename(file_name)}')
-
-    for file_name in real_file_names:
-        try:
-            os.remove(file_name)
-        except FileNotFoundError:
-            pass
-
-    s3_bucket.delete_objects(Delete={'Objects': [{'Key': key} for key in real_file_names]})
+def save_clip_for_collection(collection_id: str, file_name: str, file: FileStorage) -> List[str]:
+    """
+    Saves a video clip and writes only its sampled frames as images, named after the clip and their time in it. A clip
+    that fails to decode is deleted along with any frames written from it.
+    """
+    os.makedirs(clips_location(collection_id), exist_ok=True)
+    clip = f'{clips_location(collection_id)}/{os.path.basename(file_name)}'
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    written = [clip]
+    frames = []
+    try:
+        file.save(clip)
+        if s3_bucket is not None:
+            s3_bucket.upload_file(clip, clip)
+        with observe_stage('video_sampling'):
+            for frame in sample_frames(clip):
+                dest = f'{INPUTS_PATH}/{collection_id}/{stem}_{round(frame.timestamp * 1000):08d}ms.jpg'
+                written.append(dest)
+                frame.image.save(dest, quality=95)
+                if s3_bucket is not None:
+                    s3_bucket.upload_file(dest, dest)
+                frames.append(ClipFrame(clip=clip, file_name=dest, frame_index=frame.index, timestamp=frame.timestamp))
+    except Exception:
+        files = [stored_file(key) for key in written]
+        delete_stored_files([f for f in files if f.local or f.s3])
+        raise
+    save_clip_frames(collection_id, frames)
+    return [f['file_name'] for f in frames]
+
+
+def delete_images_for_collection(collection_id: str, file_names: List[str]) -> DeleteReport:
+    """
+    Deletes images along with their annotations, cropped and annotated outputs and derivatives. Deleting a video clip
+    deletes the frames sampled from it too.
+    """
+    real_file_names = {
+        f'{INPUTS_PATH}/{collection_id}/{os.path.basename(file_name)}' for file_name in file_names
+        if not is_video(file_name)
+    }
+    clips = {
+        f'{clips_location(collection_id)}/{os.path.basename(file_name)}' for file_name in file_names
+        if is_video(file_name)
+    }
+    real_file_names |= {f['file_name'] for f in read_clip_frames_for_collection(collection_id) if f['clip'] in clips}
+    annotations = [a for a in read_annotations_for_collection(collection_id) if a['file_name'] in real_file_names]
+
+    keys = list(clips) + list(real_file_names)
+    for annotation in annotations:
+        keys += [k for k in [annotation['cropped_file_name'], annotation['annotated_file_name']] if k is not None]
+    keys = list(dict.fromkeys(keys))
+    files = [stored_file(key) for key in keys]
+    # Derivatives are only ever generated locally.
+    files += [stored_file(d)._replace(s3=False) for key in keys for d in derivative_locations_for(key)]
+
+    report = delete_stored_files([f for f in files if f.local or f.s3])
+    bump_version(images_resource(collection_id))
+    delete_annotations_for_collection(collection_id, [a['id'] for a in annotations])
+    remove_frames_from_bursts(collection_id, real_file_names)
+    remove_frames_from_clips(collection_id, real_file_names)
+    return report
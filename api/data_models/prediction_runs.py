@@ -0,0 +1,27 @@
+import json
+from typing import TypedDict, Optional
+
+from api.clients.redis_client import redis_client
+
+REDIS_KEY = 'predictions:runs'
+
+
+class PredictionRun(TypedDict):
+    collection_id: str
+    # Fencing token of the lease the run was started under.
+    token: int
+    created_at: float
+    # `running`, `completed` or `failed`.
+    status: str
+    group_bursts: bool
+    finished_at: Optional[float]
+    error: Optional[str]
+
+
+def read_prediction_run(collection_id: str) -> Optional[PredictionRun]:
+    run_json = redis_client.hget(REDIS_KEY, collection_id)
+    return json.loads(run_json) if run_json is not None else None
+
+
+def save_prediction_run(run: PredictionRun) -> None:
+    redis_client.hset(REDIS_KEY, run['collection_id'], json.dumps(run))
@@ -0,0 +1,111 @@
+import json
+from typing import TypedDict, List, Dict, Optional, Tuple
+
+import redis
+
+from api.clients.redis_client import redis_client
+
+STREAM_REDIS_KEY = 'predictions:tasks'
+RESULTS_REDIS_KEY = 'predictions:results'
+CONSUMER_GROUP = 'prediction-workers'
+# Results of a run that nobody collected, e.g. because the server waiting for them restarted, expire after this long.
+RESULTS_TTL_SECONDS = 24 * 60 * 60
+
+
+class PredictionTask(TypedDict):
+    run_id: str
+    collection_id: str
+    file_name: str
+    # Number of times the task failed before this attempt.
+    attempt: int
+
+
+class PredictionTaskResult(TypedDict):
+    file_name: str
+    # Serialized YolovPrediction and IndividualPrediction tuples, or None if the task failed.
+    yolov_predictions: Optional[List[List]]
+    individual_predictions: Optional[List[List]]
+    error: Optional[str]
+
+
+def ensure_consumer_group() -> None:
+    try:
+        redis_client.xgroup_create(STREAM_REDIS_KEY, CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def publish_prediction_tasks(tasks: List[PredictionTask]) -> None:
+    ensure_consumer_group()
+    pipeline = redis_client.pipeline(transaction=False)
+    for task in tasks:
+        pipeline.xadd(STREAM_REDIS_KEY, {'task': json.dumps(task)})
+    pipeline.execute()
+
+
+def read_prediction_tasks(consumer: str, count: int, block_ms: int) -> List[Tuple[str, PredictionTask]]:
+    """
+    Reads tasks that no other worker of the consumer group has been given yet.
+    """
+    response = redis_client.xreadgroup(CONSUMER_GROUP, consumer, {STREAM_REDIS_KEY: '>'}, count=count, block=block_ms)
+    return [(message_id, json.loads(fields['task'])) for _, messages in response or [] for message_id, fields in messages]
+
+
+def claim_stale_prediction_tasks(consumer: str, min_idle_ms: int, count: int) -> List[Tuple[str, PredictionTask, int]]:
+    """
+    Takes over tasks that were given to a worker which has not acknowledged them for min_idle_ms, most likely because
+    it died. Returns each task along with the number of times it has been given to a worker.
+    """
+    _, messages, *_ = redis_client.xautoclaim(
+        STREAM_REDIS_KEY, CONSUMER_GROUP, consumer, min_idle_time=min_idle_ms, start_id='0-0', count=count
+    )
+    tasks = []
+    for message_id, fields in messages:
+        # Tasks can be deleted while they are pending, which leaves an empty message.
+        if fields is None or 'task' not in fields:
+            acknowledge_prediction_task(message_id)
+            continue
+        pending = redis_client.xpending_range(STREAM_REDIS_KEY, CONSUMER_GROUP, message_id, message_id, 1)
+        deliveries = pending[0]['times_delivered'] if len(pending) > 0 else 1
+        tasks.append((message_id, json.loads(fields['task']), deliveries))
+    return tasks
+
+
+def acknowledge_prediction_task(message_id: str, retry: Optional[PredictionTask] = None) -> None:
+    """
+    Removes a completed task from the stream, and atomically queues the task again if it should be retried.
+    """
+    pipeline = redis_client.pipeline(transaction=True)
+    if retry is not None:
+        pipeline.xadd(STREAM_REDIS_KEY, {'task': json.dumps(retry)})
+    pipeline.xack(STREAM_REDIS_KEY, CONSUMER_GROUP, message_id)
+    pipeline.xdel(STREAM_REDIS_KEY, message_id)
+    pipeline.execute()
+
+
+def save_prediction_task_result(run_id: str, result: PredictionTaskResult) -> None:
+    """
+    Saves the result of a task. Saving is idempotent, so a task that two workers both complete is only counted once.
+    """
+    key = __key_for_run(run_id)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.hset(key, result['file_name'], json.dumps(result))
+    pipeline.expire(key, RESULTS_TTL_SECONDS)
+    pipeline.execute()
+
+
+def count_prediction_task_results(run_id: str) -> int:
+    return redis_client.hlen(__key_for_run(run_id))
+
+
+def read_prediction_task_results(run_id: str) -> Dict[str, PredictionTaskResult]:
+    return {k: json.loads(v) for k, v in redis_client.hgetall(__key_for_run(run_id)).items()}
+
+
+def delete_prediction_task_results(run_id: str) -> None:
+    redis_client.delete(__key_for_run(run_id))
+
+
+def __key_for_run(run_id: str) -> str:
+    return f'{RESULTS_REDIS_KEY}:{run_id}'
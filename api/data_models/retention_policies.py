@@ -0,0 +1,51 @@
+import json
+import os
+from typing import TypedDict, Optional
+
+from api.clients.redis_client import redis_client
+
+REDIS_KEY = 'retention:policies'
+
+
+def __days_from_env(name: str, default: Optional[str]) -> Optional[float]:
+    value = os.getenv(name, default)
+    return float(value) if value not in [None, '', 'none'] else None
+
+
+# Defaults for collections without a policy of their own. None keeps data forever.
+RETENTION_INPUTS_DAYS = __days_from_env('RETENTION_INPUTS_DAYS', None)
+RETENTION_PROFILES_DAYS = __days_from_env('RETENTION_PROFILES_DAYS', '30')
+RETENTION_RETRAIN_LOGS_DAYS = __days_from_env('RETENTION_RETRAIN_LOGS_DAYS', '30')
+
+
+class RetentionPolicy(TypedDict):
+    collection_id: str
+    # Images older than this are deleted, along with their annotations and outputs.
+    inputs_max_age_days: Optional[float]
+    profiles_max_age_days: Optional[float]
+    # Logs and metrics of finished retraining jobs that started longer ago than this are deleted.
+    retrain_logs_max_age_days: Optional[float]
+
+
+def default_retention_policy(collection_id: str) -> RetentionPolicy:
+    return RetentionPolicy(
+        collection_id=collection_id,
+        inputs_max_age_days=RETENTION_INPUTS_DAYS,
+        profiles_max_age_days=RETENTION_PROFILES_DAYS,
+        retrain_logs_max_age_days=RETENTION_RETRAIN_LOGS_DAYS
+    )
+
+
+def read_retention_policy(collection_id: str) -> RetentionPolicy:
+    policy_json = redis_client.hget(REDIS_KEY, collection_id)
+    if policy_json is None:
+        return default_retention_policy(collection_id)
+    return json.loads(policy_json)
+
+
+def save_retention_policy(policy: RetentionPolicy) -> None:
+    redis_client.hset(REDIS_KEY, policy['collection_id'], json.dumps(policy))
+
+
+def delete_retention_policy(collection_id: str) -> None:
+    redis_client.hdel(REDIS_KEY, collection_id)
@@ -1,15 +1,35 @@
 import json
-from typing import TypedDict
+from typing import TypedDict, Optional
 
 from api.clients.redis_client import redis_client
 
 JOBS_REDIS_KEY = 'retrain:jobs'
 
 
+class RetrainBudget(TypedDict):
+    # Time by which retraining should be completed.
+    deadline: float
+    # Seconds before the deadline kept for retraining the classifiers and promoting training data.
+    reserved_seconds: float
+    # Measured once the first epoch of the embeddings backbone completes.
+    seconds_per_epoch: Optional[float]
+    planned_epochs: Optional[int]
+    completed_epochs: int
+    # Fraction of the time between the job being created and the deadline that has been used.
+    used: float
+    projected_finish: Optional[float]
+
+
 class RetrainStatus(TypedDict):
     collection_id: str
     created_at: float
     status: str
+    # Only set for retraining that was started with a deadline.
+    budget: Optional[RetrainBudget]
+    # Fencing token of the lease the job was started under, and the options it was started with.
+    token: Optional[int]
+    classifier_only: Optional[bool]
+    deadline: Optional[float]
 
 
 def read_job_status_from_redis(collection_id: str) -> RetrainStatus:
@@ -18,9 +38,14 @@ def read_job_status_from_redis(collection_id: str) -> RetrainStatus:
         return RetrainStatus(
             collection_id=collection_id,
             created_at=0,
-            status='not started'
+            status='not started',
+            budget=None,
+            token=None,
+            classifier_only=None,
+            deadline=None
         )
-    return json.loads(status_json)
+    # Jobs saved before budgets and options were added have neither.
+    return {'budget': None, 'token': None, 'classifier_only': None, 'deadline': None, **json.loads(status_json)}
 
 
 def save_job_status_to_redis(job_status: RetrainStatus) -> None:
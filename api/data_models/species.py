@@ -1,34 +1,87 @@
 from __future__ import annotations
 
+import glob
 import json
-from enum import Enum
-from typing import Optional, List
+import os
+import threading
+from typing import Optional, List, NamedTuple, Tuple
 
+MODELS_PATH = 'models'
+TRAINING_DATA_PATH = 'training_data/cropped'
+TRAINING_SHARDS_PATH = 'training_data/shards'
+# Species that are known even before any of their model artifacts or training data exist, separated by commas.
+EXTRA_SPECIES = [s for s in os.getenv('SPECIES', '').split(',') if s != '']
 
-class Species(Enum):
-    HYENA = 'Crocuta_crocuta'
-    LEOPARD = 'Panthera_pardus'
-    GIRAFFE = 'Giraffa_tippelskirchi'
+# Species discovered from the artifacts, along with the modification times of the directories they were found in.
+__registry: Tuple[Tuple[float, float, float], List[Species]] = ((-1, -1, -1), [])
+__registry_lock = threading.Lock()
+
+
+class Species(NamedTuple):
+    """
+    A species with a classifier of known individuals, such as `Crocuta_crocuta`. Species are discovered from the model
+    artifacts and training data, so a new species only needs its artifacts to be added.
+    """
+    value: str
 
     def __str__(self) -> str:
         return self.value
 
     @staticmethod
     def from_string(s: str) -> Optional[Species]:
-        for species in Species:
-            if species.value == s:
-                return species
-        return None
+        """
+        Returns the species if it is known, even if it has no classifier yet, or None.
+        """
+        species = Species(s)
+        return species if species in list_species() else None
 
     def training_data_location(self) -> str:
-        return f'training_data/cropped/{self}'
+        return f'{TRAINING_DATA_PATH}/{self}'
+
+    def training_shards_location(self) -> str:
+        return f'{TRAINING_SHARDS_PATH}/{self}'
 
     def model_location(self) -> str:
-        return f'models/{self}_knn.joblib'
+        return f'{MODELS_PATH}/{self}_knn.joblib'
 
     def labels_location(self) -> str:
-        return f'models/{self}_labels.json'
+        return f'{MODELS_PATH}/{self}_labels.json'
+
+    def has_classifier(self) -> bool:
+        return os.path.exists(self.model_location()) and os.path.exists(self.labels_location())
 
     def read_labels(self) -> List[str]:
         with open(self.labels_location()) as f:
             return json.load(f)
+
+
+def list_species() -> List[Species]:
+    """
+    Lists every species with a classifier, labels or training data, in alphabetical order. The directories are only
+    scanned again once files have been added to or removed from them.
+    """
+    global __registry
+    version = (__mtime(MODELS_PATH), __mtime(TRAINING_DATA_PATH), __mtime(TRAINING_SHARDS_PATH))
+    with __registry_lock:
+        if __registry[0] == version:
+            return __registry[1]
+
+    names = set(EXTRA_SPECIES)
+    for suffix in ['_knn.joblib', '_labels.json']:
+        for path in glob.glob(f'{MODELS_PATH}/*{suffix}'):
+            names.add(os.path.basename(path).removesuffix(suffix))
+    for training_path in [TRAINING_DATA_PATH, TRAINING_SHARDS_PATH]:
+        for path in glob.glob(f'{training_path}/*/'):
+            names.add(os.path.basename(os.path.dirname(path)))
+
+    species = [Species(name) for name in sorted(names)]
+    with __registry_lock:
+        __registry = (version, species)
+    return species
+
+
+def __mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,45 @@
+import time
+from typing import List
+
+from api.clients.redis_client import redis_client
+
+REDIS_KEY = 'versions'
+
+
+def collections_resource() -> str:
+    return 'collections'
+
+
+def images_resource(collection_id: str) -> str:
+    return f'images:{collection_id}'
+
+
+def annotations_resource(collection_id: str) -> str:
+    return f'annotations:{collection_id}'
+
+
+def labels_resource(species: str) -> str:
+    return f'labels:{species}'
+
+
+def bump_version(resource: str) -> None:
+    """
+    Marks a resource as changed. Call this after every write, so that a response built from the old data never carries
+    the new version.
+    """
+    __ensure_versions([resource])
+    redis_client.hincrby(REDIS_KEY, resource, 1)
+
+
+def read_versions(resources: List[str]) -> List[str]:
+    versions = redis_client.hmget(REDIS_KEY, resources)
+    if None in versions:
+        __ensure_versions([r for r, v in zip(resources, versions) if v is None])
+        versions = redis_client.hmget(REDIS_KEY, resources)
+    return [f'{r}:{v}' for r, v in zip(resources, versions)]
+
+
+def __ensure_versions(resources: List[str]) -> None:
+    # Versions start from the current time rather than 0, so that they never repeat if Redis loses them.
+    for resource in resources:
+        redis_client.hsetnx(REDIS_KEY, resource, time.time_ns())
@@ -0,0 +1,90 @@
+"""
+Shared image decoding.
+
+Most decodes only need a small image, such as the detector's 640x640 input or a 224x224 embedding input, while trap
+images are often 12-20 MP. JPEGs can be decoded at 1/2, 1/4 or 1/8 scale in the DCT domain for a fraction of the cost,
+so reduced decodes are used whenever the result is still at least as large as the target. Crops need every pixel, so
+they always decode at full resolution.
+"""
+import os
+from typing import Optional, Tuple, Union, BinaryIO
+
+import PIL.Image
+
+# `pil` uses PIL's draft mode, `opencv` uses OpenCV's reduced-size reads and `full` always decodes every pixel.
+IMAGE_DECODER = os.getenv('IMAGE_DECODER', 'pil')
+IMAGE_DECODERS = ['pil', 'opencv', 'full']
+# Scales the JPEG decoder can reduce by, largest first.
+JPEG_REDUCTIONS = [8, 4, 2]
+
+# A file name, or an open binary file such as an image read from a training data shard.
+ImageSource = Union[str, BinaryIO]
+
+
+def image_size(file_name: ImageSource) -> Tuple[int, int]:
+    """
+    Returns the width and height of an image, only reading its header.
+    """
+    with PIL.Image.open(file_name) as image:
+        return image.size
+
+
+def decode_image(
+        file_name: ImageSource,
+        min_size: Optional[Tuple[int, int]] = None,
+        decoder: Optional[str] = None
+) -> PIL.Image.Image:
+    """
+    Decodes an image to RGB. With min_size, the image may be decoded at a reduced scale that is no smaller than
+    min_size in either dimension, so callers still resize to their exact target. Without it the full resolution is
+    decoded.
+    """
+    decoder = decoder or IMAGE_DECODER
+    if decoder not in IMAGE_DECODERS:
+        raise ValueError(f'Unknown image decoder {decoder}, expected one of {IMAGE_DECODERS}.')
+
+    if min_size is not None and decoder == 'opencv':
+        image = __decode_opencv(file_name, min_size)
+        if image is not None:
+            return image
+
+    with PIL.Image.open(file_name) as image:
+        if min_size is not None and decoder == 'pil':
+            image.draft('RGB', min_size)
+        return image.convert('RGB')
+
+
+def decode_resized(
+        file_name: str,
+        size: Tuple[int, int],
+        decoder: Optional[str] = None
+) -> Tuple[PIL.Image.Image, Tuple[int, int]]:
+    """
+    Decodes an image resized to exactly size, along with its original width and height.
+    """
+    original_size = image_size(file_name)
+    return decode_image(file_name, size, decoder).resize(size), original_size
+
+
+def __decode_opencv(file_name: ImageSource, min_size: Tuple[int, int]) -> Optional[PIL.Image.Image]:
+    # OpenCV is only needed for this backend.
+    import cv2
+
+    reduced_flags = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4, 2: cv2.IMREAD_REDUCED_COLOR_2}
+    width, height = image_size(file_name)
+    flag = cv2.IMREAD_COLOR
+    for scale in JPEG_REDUCTIONS:
+        if width // scale >= min_size[0] and height // scale >= min_size[1]:
+            flag = reduced_flags[scale]
+            break
+    # PIL does not apply EXIF orientation either, so both backends return the same pixels.
+    if isinstance(file_name, str):
+        pixels = cv2.imread(file_name, flag | cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+        import numpy as np
+
+        file_name.seek(0)
+        pixels = cv2.imdecode(np.frombuffer(file_name.read(), np.uint8), flag | cv2.IMREAD_IGNORE_ORIENTATION)
+    if pixels is None:
+        return None
+    return PIL.Image.fromarray(cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB))
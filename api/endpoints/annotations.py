@@ -1,40 +1,163 @@
-from typing import TypedDict, List
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import TypedDict, List, Dict, Optional
 
-from PIL import Image
+import flask
+from flask import request, Blueprint
 
-from api.data_models.annotations import save_annotations_for_collection, Annotation, read_annotations_for_collection
+from api.data_models.annotations import save_annotations_for_collection, Annotation, \
+    read_annotations_for_collection, read_annotations_by_id
+from api.data_models.versions import read_versions, annotations_resource
 from api.endpoints.helpers import StatusResponse, must_get_collection_id
-from flask import request, Blueprint
+from api.metrics import submit_tracked
+from api.predictions.predict_bounding_boxes import BoundingBox, RenderTask, render_outputs
+from api.response_cache import cached_json_response
 
-from api.predictions.predict_bounding_boxes import BoundingBox, crop_and_upload, annotate_and_upload
+logger = logging.getLogger(__name__)
 
 flask_blueprint = Blueprint('annotations', __name__)
 
+# Fields that a client may change with a PATCH request. The file names and IDs are owned by the server.
+EDITABLE_FIELDS = {'bbox', 'species_confidence', 'predicted_species', 'predicted_name', 'accepted', 'ignored'}
+
+# A single worker keeps renders for the same image in the order they were requested.
+render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='annotation-render')
+
 
 class GetAnnotationsResponse(TypedDict):
     status: str
     annotations: List[Annotation]
 
 
+class PatchAnnotationsResponse(TypedDict):
+    status: str
+    annotations: List[Annotation]
+
+
+class PatchAnnotationResponse(TypedDict):
+    status: str
+    annotation: Annotation
+
+
 @flask_blueprint.get('/api/v1/annotations')
-def get_annotations() -> GetAnnotationsResponse:
+def get_annotations() -> flask.Response:
     collection_id = must_get_collection_id()
-    return {'status': 'ok', 'annotations': read_annotations_for_collection(collection_id)}
+    return cached_json_response(
+        read_versions([annotations_resource(collection_id)]),
+        lambda: GetAnnotationsResponse(status='ok', annotations=read_annotations_for_collection(collection_id))
+    )
 
 
 @flask_blueprint.post('/api/v1/annotations')
 def post_annotations() -> StatusResponse:
     collection_id = must_get_collection_id()
     annotations: List[Annotation] = request.get_json()
+    previous_annotations = read_annotations_by_id(collection_id, [a['id'] for a in annotations])
     save_annotations_for_collection(collection_id, annotations)
-    for annotation in annotations:
-        image = Image.open(annotation['file_name'])
-        bbox = BoundingBox(
-            x=annotation['bbox'][0],
-            y=annotation['bbox'][1],
-            w=annotation['bbox'][2],
-            h=annotation['bbox'][3]
-        )
-        crop_and_upload(image.copy(), annotation['cropped_file_name'], bbox)
-        annotate_and_upload(image.copy(), annotation['annotated_file_name'], bbox)
+    submit_render(collection_id, changed_annotations(previous_annotations, annotations))
     return {'status': 'ok'}
+
+
+@flask_blueprint.patch('/api/v1/annotations')
+def patch_annotations() -> PatchAnnotationsResponse:
+    collection_id = must_get_collection_id()
+    updates: List[Dict] = request.get_json()
+    if not isinstance(updates, list):
+        flask.abort(400, 'Expected a list of annotation updates.')
+    return {'status': 'ok', 'annotations': update_annotations(collection_id, updates)}
+
+
+@flask_blueprint.patch('/api/v1/annotations/<annotation_id>')
+def patch_annotation(annotation_id: str) -> PatchAnnotationResponse:
+    collection_id = must_get_collection_id()
+    update: Dict = request.get_json()
+    if not isinstance(update, dict):
+        flask.abort(400, 'Expected an annotation update.')
+    update['id'] = annotation_id
+    return {'status': 'ok', 'annotation': update_annotations(collection_id, [update])[0]}
+
+
+def update_annotations(collection_id: str, updates: List[Dict]) -> List[Annotation]:
+    """
+    Applies partial updates to stored annotations and re-renders the images of any annotation whose bbox changed.
+    """
+    for update in updates:
+        if not isinstance(update, dict) or 'id' not in update:
+            flask.abort(400, 'Field `id` required.')
+        unknown_fields = set(update.keys()) - EDITABLE_FIELDS - {'id'}
+        if len(unknown_fields) > 0:
+            flask.abort(400, f'Fields {sorted(unknown_fields)} cannot be updated.')
+        if 'bbox' in update and not __is_bbox(update['bbox']):
+            flask.abort(400, 'Field `bbox` must be a list of four numbers: x, y, width and height.')
+
+    previous_annotations = read_annotations_by_id(collection_id, [u['id'] for u in updates])
+    annotations = []
+    for update in updates:
+        previous_annotation = previous_annotations.get(update['id'])
+        if previous_annotation is None:
+            flask.abort(404, f"Annotation `{update['id']}` not found.")
+        annotations.append(Annotation(**{**previous_annotation, **update}))
+
+    save_annotations_for_collection(collection_id, annotations)
+    submit_render(collection_id, changed_annotations(previous_annotations, annotations))
+    return annotations
+
+
+def changed_annotations(
+        previous_annotations: Dict[str, Annotation],
+        annotations: List[Annotation]
+) -> List[Annotation]:
+    """
+    Returns the annotations whose rendered images are out of date: new annotations, and those with a new bbox.
+    """
+    results = []
+    for annotation in annotations:
+        previous_annotation: Optional[Annotation] = previous_annotations.get(annotation['id'])
+        if previous_annotation is not None and previous_annotation.get('bbox') == annotation.get('bbox'):
+            continue
+        results.append(annotation)
+    return results
+
+
+def submit_render(collection_id: str, annotations: List[Annotation]) -> Optional[Future]:
+    """
+    Re-renders the crops of the given annotations. The annotated image of each affected source image is redrawn with
+    the bboxes of all annotations from that image, so the boxes of unchanged annotations are kept.
+    """
+    changed_ids = {a['id'] for a in annotations if __is_renderable(a)}
+    if len(changed_ids) == 0:
+        return None
+    changed_file_names = {a['file_name'] for a in annotations if a['id'] in changed_ids}
+
+    tasks = []
+    for annotation in read_annotations_for_collection(collection_id):
+        if annotation['file_name'] not in changed_file_names or not __is_renderable(annotation):
+            continue
+        tasks.append(RenderTask(
+            file_name=annotation['file_name'],
+            cropped_file_name=annotation['cropped_file_name'],
+            annotated_file_name=annotation['annotated_file_name'],
+            bbox=BoundingBox(*annotation['bbox']),
+            crop=annotation['id'] in changed_ids
+        ))
+    future = submit_tracked(render_executor, 'render', render_outputs, tasks)
+    future.add_done_callback(__log_render_failure)
+    return future
+
+
+def __is_bbox(bbox) -> bool:
+    return isinstance(bbox, list) and len(bbox) == 4 and all(
+        isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in bbox
+    )
+
+
+def __is_renderable(annotation: Annotation) -> bool:
+    return None not in [
+        annotation.get('bbox'), annotation.get('cropped_file_name'), annotation.get('annotated_file_name')
+    ]
+
+
+def __log_render_failure(future: Future) -> None:
+    if future.exception() is not None:
+        logger.error('Failed to render annotations.', exc_info=future.exception())
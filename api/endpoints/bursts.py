@@ -0,0 +1,44 @@
+from typing import TypedDict, List
+
+import flask
+from flask import request, Blueprint
+
+from api.data_models.annotations import read_annotations_for_collection, delete_annotations_for_collection
+from api.data_models.bursts import Burst, BurstReport, burst_report, read_bursts_for_collection, \
+    save_bursts_for_collection, save_split_frames
+from api.endpoints.helpers import must_get_collection_id
+
+flask_blueprint = Blueprint('bursts', __name__)
+
+
+class GetBurstsResponse(TypedDict):
+    status: str
+    bursts: List[Burst]
+    report: BurstReport
+
+
+@flask_blueprint.get('/api/v1/bursts')
+def get_bursts() -> GetBurstsResponse:
+    collection_id = must_get_collection_id()
+    bursts = read_bursts_for_collection(collection_id)
+    return {'status': 'ok', 'bursts': bursts, 'report': burst_report(bursts)}
+
+
+@flask_blueprint.post('/api/v1/bursts/split')
+def post_split_bursts() -> GetBurstsResponse:
+    from api.predictions.bursts import split_bursts
+
+    collection_id = must_get_collection_id()
+    file_names: List[str] = request.get_json()
+    if not isinstance(file_names, list):
+        flask.abort(400, 'Expected a list of file names.')
+    save_split_frames(collection_id, file_names)
+    bursts = read_bursts_for_collection(collection_id)
+    # Annotations copied from a representative no longer apply once a frame leaves its burst. The frame is predicted
+    # on its own the next time predictions run.
+    copied = {f for b in bursts for f in b['file_names'] if f in file_names and f != b['representative']}
+    annotations = [a for a in read_annotations_for_collection(collection_id) if a['file_name'] in copied]
+    delete_annotations_for_collection(collection_id, [a['id'] for a in annotations])
+    bursts = split_bursts(bursts, set(file_names))
+    save_bursts_for_collection(collection_id, bursts)
+    return {'status': 'ok', 'bursts': bursts, 'report': burst_report(bursts)}
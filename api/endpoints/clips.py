@@ -0,0 +1,57 @@
+from typing import TypedDict, List, Dict
+
+from flask import Blueprint
+
+from api.data_models.annotations import read_annotations_for_collection
+from api.data_models.clips import ClipFrame, read_clip_frames_for_collection
+from api.endpoints.helpers import must_get_collection_id
+
+flask_blueprint = Blueprint('clips', __name__)
+
+
+class ClipDetection(TypedDict):
+    annotation_id: str
+    file_name: str
+    # Seconds from the start of the clip.
+    timestamp: float
+    predicted_species: str
+    predicted_name: str
+
+
+class Clip(TypedDict):
+    clip: str
+    frames: List[ClipFrame]
+    detections: List[ClipDetection]
+
+
+class GetClipsResponse(TypedDict):
+    status: str
+    clips: List[Clip]
+
+
+@flask_blueprint.get('/api/v1/clips')
+def get_clips() -> GetClipsResponse:
+    """
+    Lists the uploaded video clips of a collection with their sampled frames and the detections in those frames.
+    """
+    collection_id = must_get_collection_id()
+    clips: Dict[str, Clip] = {}
+    frames: Dict[str, ClipFrame] = {}
+    for frame in read_clip_frames_for_collection(collection_id):
+        clips.setdefault(frame['clip'], Clip(clip=frame['clip'], frames=[], detections=[]))['frames'].append(frame)
+        frames[frame['file_name']] = frame
+
+    for annotation in read_annotations_for_collection(collection_id):
+        frame = frames.get(annotation['file_name'])
+        if frame is None or annotation['cropped_file_name'] is None:
+            continue
+        clips[frame['clip']]['detections'].append(ClipDetection(
+            annotation_id=annotation['id'],
+            file_name=frame['file_name'],
+            timestamp=frame['timestamp'],
+            predicted_species=annotation['predicted_species'],
+            predicted_name=annotation['predicted_name'],
+        ))
+    for clip in clips.values():
+        clip['detections'].sort(key=lambda d: d['timestamp'])
+    return {'status': 'ok', 'clips': [{**c, 'clip': f'/{c["clip"]}'} for c in clips.values()]}
@@ -5,6 +5,8 @@ import flask
 from flask import request, Blueprint
 
 from api.data_models.collections import Collection, save_collection_to_redis, read_collections_from_redis
+from api.data_models.versions import read_versions, collections_resource
+from api.response_cache import cached_json_response
 
 flask_blueprint = Blueprint('collections', __name__)
 
@@ -25,8 +27,11 @@ class PostCollectionResponse(TypedDict):
 
 
 @flask_blueprint.get('/api/v1/collections')
-def get_collections() -> GetCollectionsResponse:
-    return {'status': 'ok', 'collections': read_collections_from_redis()}
+def get_collections() -> flask.Response:
+    return cached_json_response(
+        read_versions([collections_resource()]),
+        lambda: GetCollectionsResponse(status='ok', collections=read_collections_from_redis())
+    )
 
 
 @flask_blueprint.post('/api/v1/collections')
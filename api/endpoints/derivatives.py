@@ -0,0 +1,32 @@
+import os
+
+import flask
+from flask import Blueprint, send_from_directory
+from werkzeug.security import safe_join
+
+from api.data_models.derivatives import DERIVATIVE_SIZES, DERIVATIVES_PATH, WEBSITE_DATA_PATH, ensure_derivative
+from api.data_models.prediction_inputs import OUTPUTS_PATH
+
+flask_blueprint = Blueprint('derivatives', __name__)
+
+DERIVATIVE_MAX_AGE = int(os.getenv('DERIVATIVE_MAX_AGE', '86400'))
+
+
+@flask_blueprint.get('/website-data/derivatives/<variant>/<path:name>')
+def get_derivative(variant: str, name: str):
+    if variant not in DERIVATIVE_SIZES:
+        flask.abort(404, f'Unknown image variant `{variant}`.')
+    if safe_join(WEBSITE_DATA_PATH, name) is None or name.startswith('derivatives/'):
+        flask.abort(404)
+    if ensure_derivative(variant, name) is None:
+        flask.abort(404, f'Image `{name}` not found.')
+    # Crops and annotated images are re-rendered in place when annotations change, so browsers must revalidate them.
+    rerendered = f'{WEBSITE_DATA_PATH}/{name}'.startswith(f'{OUTPUTS_PATH}/')
+    # Conditional responses give a strong ETag, If-None-Match and Range support.
+    response = send_from_directory(
+        DERIVATIVES_PATH, f'{variant}/{name}', max_age=0 if rerendered else DERIVATIVE_MAX_AGE, conditional=True,
+        etag=True
+    )
+    if rerendered:
+        response.cache_control.no_cache = True
+    return response
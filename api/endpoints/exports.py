@@ -0,0 +1,47 @@
+import flask
+from flask import request, Blueprint, Response, stream_with_context
+
+from api.endpoints.helpers import must_get_collection_id
+from api.exports import EXPORT_FORMATS, ANNOTATION_FORMATS, EXPORT_CONTENTS, plan_export, stream_tar, stream_zip
+
+flask_blueprint = Blueprint('exports', __name__)
+
+MIMETYPES = {'tar': 'application/x-tar', 'zip': 'application/zip'}
+
+
+@flask_blueprint.get('/api/v1/export')
+def get_export() -> Response:
+    collection_id = must_get_collection_id()
+    archive_format = request.args.get('format', 'tar')
+    annotation_format = request.args.get('annotations', 'json')
+    contents = request.args.get('include', ','.join(EXPORT_CONTENTS)).split(',')
+    if archive_format not in EXPORT_FORMATS:
+        flask.abort(400, f"Url argument `format` must be one of {', '.join(EXPORT_FORMATS)}.")
+    if annotation_format not in ANNOTATION_FORMATS:
+        flask.abort(400, f"Url argument `annotations` must be one of {', '.join(ANNOTATION_FORMATS)}.")
+    if not set(contents).issubset(EXPORT_CONTENTS):
+        flask.abort(400, f"Url argument `include` must be a list of {', '.join(EXPORT_CONTENTS)}.")
+
+    plan = plan_export(collection_id, archive_format, annotation_format, contents)
+    headers = {
+        'Content-Disposition': f'attachment; filename="{collection_id}.{archive_format}"',
+        'ETag': f'"{plan.etag}"',
+    }
+    if archive_format == 'zip':
+        # The size of a streamed zip archive is not known in advance, so it is sent with chunked transfer encoding.
+        return Response(stream_with_context(stream_zip(plan)), mimetype=MIMETYPES['zip'], headers=headers)
+
+    # Tar archives are laid out in advance, so an interrupted download can be resumed with a Range request.
+    headers['Accept-Ranges'] = 'bytes'
+    start, end, status = 0, plan.size - 1, 200
+    if request.range is not None and (request.if_range.etag is None or request.if_range.etag == plan.etag):
+        byte_range = request.range.range_for_length(plan.size)
+        if byte_range is None:
+            headers['Content-Range'] = f'bytes */{plan.size}'
+            return Response(status=416, headers=headers)
+        start, end, status = byte_range[0], byte_range[1] - 1, 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{plan.size}'
+    headers['Content-Length'] = str(end - start + 1)
+    return Response(
+        stream_with_context(stream_tar(plan, start, end)), status=status, mimetype=MIMETYPES['tar'], headers=headers
+    )
@@ -1,9 +1,16 @@
+import os
+import re
+from datetime import datetime
+
 import flask
 
-from typing import TypedDict
+from typing import TypedDict, Optional
 
 from api.data_models.collections import collection_exists
 
+# Whether predictions group near-duplicate burst frames when the request does not say.
+BURST_DETECTION = os.getenv('BURST_DETECTION', 'false').lower() in ['1', 'true']
+
 
 class StatusResponse(TypedDict):
     status: str
@@ -15,3 +22,49 @@ def must_get_collection_id() -> str:
         if collection_exists(collection_id):
             return collection_id
     flask.abort(400, f'Collection ID `{collection_id}` not found.')
+
+
+def should_profile() -> bool:
+    return __bool_arg('profile', default=False)
+
+
+def should_group_bursts() -> bool:
+    return __bool_arg('bursts', default=BURST_DETECTION)
+
+
+def is_dry_run() -> bool:
+    return __bool_arg('dryRun', default=False)
+
+
+def get_deadline() -> Optional[float]:
+    """
+    Returns the `deadline` argument, given as a Unix timestamp or an ISO 8601 date and time with a UTC offset, as a
+    Unix timestamp.
+    """
+    value = flask.request.args.get('deadline')
+    if value is None:
+        return None
+    try:
+        deadline = float(value)
+    except ValueError:
+        # Python 3.10 does not parse `Z`.
+        iso_value = f'{value[:-1]}+00:00' if value[-1:] in ['Z', 'z'] else value
+        # An unencoded `+` in the query string arrives as a space.
+        iso_value = re.sub(r' (\d{2}:\d{2})$', r'+\1', iso_value)
+        try:
+            parsed = datetime.fromisoformat(iso_value)
+        except ValueError:
+            flask.abort(400, f'Deadline `{value}` is neither a Unix timestamp nor an ISO 8601 date and time.')
+        if parsed.tzinfo is None:
+            flask.abort(400, f'Deadline `{value}` needs a UTC offset, such as `Z` or `+02:00`.')
+        deadline = parsed.timestamp()
+    if deadline <= datetime.now().timestamp():
+        flask.abort(400, f'Deadline `{value}` has already passed.')
+    return deadline
+
+
+def __bool_arg(name: str, default: bool) -> bool:
+    value = flask.request.args.get(name)
+    if value is None:
+        return default
+    return value.lower() in ['1', 'true']
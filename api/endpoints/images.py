@@ -1,10 +1,14 @@
 from typing import TypedDict, List
 
+import flask
 from flask import request, Blueprint
 
 from api.data_models.prediction_inputs import save_images_for_collection, delete_images_for_collection, \
     list_image_paths_for_collection
-from api.endpoints.helpers import must_get_collection_id, StatusResponse
+from api.data_models.versions import read_versions, images_resource
+from api.endpoints.helpers import must_get_collection_id
+from api.response_cache import cached_json_response
+from api.storage import DeleteReport
 
 flask_blueprint = Blueprint('images', __name__)
 
@@ -19,23 +23,37 @@ class GetImagesResponse(TypedDict):
     images: List[str]
 
 
+class DeleteImagesResponse(TypedDict):
+    status: str
+    deleted: DeleteReport
+
+
 @flask_blueprint.get('/api/v1/images')
-def get_images() -> GetImagesResponse:
+def get_images() -> flask.Response:
     collection_id = must_get_collection_id()
-    return {'status': 'ok', 'images': [f'/{i}' for i in list_image_paths_for_collection(collection_id)]}
+    return cached_json_response(
+        read_versions([images_resource(collection_id)]),
+        lambda: GetImagesResponse(
+            status='ok',
+            images=[f'/{i}' for i in list_image_paths_for_collection(collection_id)]
+        )
+    )
 
 
 @flask_blueprint.post('/api/v1/images')
 def post_images() -> PostImagesResponse:
     collection_id = must_get_collection_id()
     files = request.files
-    uploaded = save_images_for_collection(collection_id, files)
+    try:
+        uploaded = save_images_for_collection(collection_id, files)
+    except ValueError as e:
+        # A video clip that OpenCV cannot decode.
+        flask.abort(400, str(e))
     return {'status': 'ok', 'uploaded': [f'/{i}' for i in uploaded]}
 
 
 @flask_blueprint.delete('/api/v1/images')
-def delete_images() -> StatusResponse:
+def delete_images() -> DeleteImagesResponse:
     collection_id = must_get_collection_id()
     images: List[str] = request.get_json()
-    delete_images_for_collection(collection_id, images)
-    return {'status': 'ok'}
+    return {'status': 'ok', 'deleted': delete_images_for_collection(collection_id, images)}
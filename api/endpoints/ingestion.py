@@ -0,0 +1,25 @@
+import json
+
+import flask
+from flask import request, Blueprint, Response, stream_with_context
+
+from api.endpoints.helpers import must_get_collection_id
+from api.ingestion import ARCHIVE_FORMATS, ingest_archive
+
+flask_blueprint = Blueprint('ingestion', __name__)
+
+ZIP_MIMETYPES = ['application/zip', 'application/x-zip-compressed']
+
+
+@flask_blueprint.post('/api/v1/images/archive')
+def post_images_archive() -> Response:
+    collection_id = must_get_collection_id()
+    archive_format = request.args.get('format', 'zip' if request.mimetype in ZIP_MIMETYPES else 'tar')
+    if archive_format not in ARCHIVE_FORMATS:
+        flask.abort(400, f"Url argument `format` must be one of {', '.join(ARCHIVE_FORMATS)}.")
+
+    # The archive is read from the request body while results are streamed back, one JSON object per line.
+    results = ingest_archive(collection_id, request.stream, archive_format)
+    return Response(
+        stream_with_context(json.dumps(result) + '\n' for result in results), mimetype='application/x-ndjson'
+    )
@@ -1,9 +1,11 @@
+import os
 from typing import List, TypedDict
 
 from flask import Blueprint
 
 from api.clients.s3_client import s3_bucket
-from api.data_models.species import Species
+from api.data_models.species import list_species
+from api.predictions.models import load_labels
 
 flask_blueprint = Blueprint('known_individuals', __name__)
 
@@ -22,8 +24,10 @@ class GetKnownIndividualsResponse(TypedDict):
 @flask_blueprint.get('/api/v1/known_individuals')
 def get_known_individuals() -> GetKnownIndividualsResponse:
     individuals = []
-    for species in Species:
-        for label in species.read_labels():
+    for species in list_species():
+        if not os.path.exists(species.labels_location()):
+            continue
+        for label in load_labels(species):
             for obj in s3_bucket.objects.filter(Prefix=f'{species.training_data_location()}{label}/'):
                 print('obj.key')
                 if obj.key.endswith('.jpg'):
@@ -1,9 +1,13 @@
+import os
 from typing import TypedDict, List
 
 import flask
 from flask import Blueprint, request
 
 from api.data_models.species import Species
+from api.data_models.versions import read_versions, labels_resource
+from api.predictions.models import load_labels
+from api.response_cache import cached_json_response
 
 flask_blueprint = Blueprint('labels', __name__)
 
@@ -14,11 +18,15 @@ class GetLabelsResponse(TypedDict):
 
 
 @flask_blueprint.get('/api/v1/labels')
-def get_labels() -> GetLabelsResponse:
+def get_labels() -> flask.Response:
     species_arg = request.args.get('species')
     if species_arg is None:
         flask.abort(400, f'Species required.')
     species = Species.from_string(species_arg)
     if species is None:
         flask.abort(400, f'No labels for {species_arg}.')
-    return {'status': 'ok', 'labels': species.read_labels()}
+    if not os.path.exists(species.labels_location()):
+        flask.abort(400, f'No labels for {species_arg}.')
+    # The modification time covers labels that are replaced without retraining, such as by a deployment.
+    versions = read_versions([labels_resource(str(species))]) + [str(os.path.getmtime(species.labels_location()))]
+    return cached_json_response(versions, lambda: GetLabelsResponse(status='ok', labels=load_labels(species)))
@@ -0,0 +1,24 @@
+import flask
+from flask import Blueprint
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+
+from api.metrics import PROMETHEUS_MULTIPROC_DIR, update_process_rss
+
+flask_blueprint = Blueprint('metrics', __name__)
+
+
+@flask_blueprint.get('/metrics')
+def get_metrics() -> flask.Response:
+    update_process_rss()
+    registry = REGISTRY
+    if PROMETHEUS_MULTIPROC_DIR is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return flask.Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+@flask_blueprint.before_app_request
+def before_request() -> None:
+    if PROMETHEUS_MULTIPROC_DIR is not None:
+        # Each worker reports its own memory, since /metrics is only served by one of them at a time.
+        update_process_rss()
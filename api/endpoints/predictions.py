@@ -1,11 +1,17 @@
-from typing import TypedDict, List
+import time
+from typing import TypedDict, List, Optional
 
+import flask
 from flask import Blueprint
 
-from api.data_models.annotations import Annotation, truncate_annotations_for_collection, save_annotations_for_collection
-from api.endpoints.helpers import must_get_collection_id
-from api.predictions.predict_bounding_boxes import predict_bounding_boxes_for_collection
-from api.predictions.predict_individual import predict_individuals_from_yolov_predictions
+from api.data_models.annotations import Annotation, UNDETECTED, truncate_annotations_for_collection, \
+    save_annotations_for_collection, read_annotations_for_collection
+from api.data_models.bursts import save_bursts_for_collection, read_split_frames
+from api.data_models.prediction_inputs import list_image_paths_for_collection
+from api.data_models.prediction_runs import PredictionRun, read_prediction_run, save_prediction_run
+from api.endpoints.helpers import must_get_collection_id, should_profile, should_group_bursts
+from api.leases import Lease, LEASE_POLL_SECONDS, acquire_lease, keep_lease, read_lease_token, check_fencing_token
+from api.profiling import profile_run
 
 flask_blueprint = Blueprint('predictions', __name__)
 
@@ -15,34 +21,136 @@ class PostPredictionsResponse(TypedDict):
     annotations: List[Annotation]
 
 
-UNDETECTED = 'undetected'
+# WSGI environ key that serve.py stores the time a request arrived under, before it waits for a prediction slot.
+RECEIVED_AT_ENVIRON_KEY = 'safarisleuths.received_at'
 
 
 @flask_blueprint.post('/api/v1/predictions')
 def post_predictions() -> PostPredictionsResponse:
+    """
+    Predicts every image of a collection. Only one run per collection happens at a time, and a request made while an
+    identical run is in flight waits for that run and returns its annotations.
+    """
+    received_at = flask.request.environ.get(RECEIVED_AT_ENVIRON_KEY, time.time())
     collection_id = must_get_collection_id()
-    truncate_annotations_for_collection(collection_id)
-
-    yolov_predictions = predict_bounding_boxes_for_collection(collection_id)
-    individual_predictions = predict_individuals_from_yolov_predictions(yolov_predictions)
-
-    yolov_predictions.sort(key=lambda p: p.cropped_file_name or '')
-    individual_predictions.sort(key=lambda p: p.cropped_file_name or '')
-    annotations = []
-    for yolov_prediction, individual_prediction in zip(
-            yolov_predictions, individual_predictions
-    ):
-        annotations.append(Annotation(
-            id=yolov_prediction.id,
-            file_name=yolov_prediction.file_name,
-            annotated_file_name=yolov_prediction.annotated_file_name,
-            cropped_file_name=yolov_prediction.cropped_file_name,
-            bbox=yolov_prediction.bbox or [0, 0, 0, 0],
-            species_confidence=yolov_prediction.confidence or 0,
-            predicted_species=yolov_prediction.predicted_species or UNDETECTED,
-            predicted_name=individual_prediction.individual_name or UNDETECTED,
-            accepted=False,
-            ignored=False,
-        ))
-    save_annotations_for_collection(collection_id, annotations)
-    return {'status': 'ok', 'annotations': annotations}
+    group_bursts = should_group_bursts()
+    lease_name = f'predictions:{collection_id}'
+    while True:
+        lease = acquire_lease(lease_name)
+        if lease is not None:
+            with keep_lease(lease):
+                run = read_prediction_run(collection_id)
+                # A request that queued for a prediction slot behind an identical run takes that run's result.
+                if run is not None and run['status'] == 'completed' and run['group_bursts'] == group_bursts \
+                        and run['finished_at'] >= received_at:
+                    return {'status': 'ok', 'annotations': read_run_annotations(collection_id)}
+                annotations = run_predictions(collection_id, lease, group_bursts, should_profile())
+            return {'status': 'ok', 'annotations': annotations}
+        annotations = attach_to_run(collection_id, lease_name, group_bursts)
+        if annotations is not None:
+            return {'status': 'ok', 'annotations': annotations}
+
+
+def attach_to_run(collection_id: str, lease_name: str, group_bursts: bool) -> Optional[List[Annotation]]:
+    """
+    Waits for the run holding the lease to finish and returns its annotations, or None if its holder died without
+    finishing, so the caller should try to take over.
+    """
+    token = read_lease_token(lease_name)
+    while token is not None:
+        run = read_prediction_run(collection_id)
+        if run is not None and run['token'] == token:
+            if run['group_bursts'] != group_bursts:
+                flask.abort(409, f'Predictions for `{collection_id}` are already running with different options.')
+            if run['status'] == 'completed':
+                return read_run_annotations(collection_id)
+            if run['status'] == 'failed':
+                flask.abort(500, f'Predictions for `{collection_id}` failed: {run["error"]}')
+        if read_lease_token(lease_name) != token:
+            # The run either finished between the two reads, or its holder died.
+            run = read_prediction_run(collection_id)
+            if run is None or run['token'] != token or run['status'] == 'running':
+                return None
+            continue
+        time.sleep(LEASE_POLL_SECONDS)
+    return None
+
+
+def read_run_annotations(collection_id: str) -> List[Annotation]:
+    annotations = read_annotations_for_collection(collection_id)
+    annotations.sort(key=lambda a: a['cropped_file_name'] or '')
+    return annotations
+
+
+def run_predictions(collection_id: str, lease: Lease, group_bursts: bool, profile: bool) -> List[Annotation]:
+    # Imported here so that the ML stack is only loaded once a prediction is requested.
+    from api.predictions.predict_bounding_boxes import predict_bounding_boxes_for_collection
+    from api.predictions.predict_individual import predict_individuals_from_yolov_predictions
+    from api.predictions.bursts import group_bursts as group_frames_into_bursts, propagate_burst_predictions
+    from api.predictions.distributed import should_use_workers, predict_with_workers
+    from api.predictions.sharding import PREDICTION_PROCESSES, prediction_pool
+
+    run = PredictionRun(
+        collection_id=collection_id,
+        token=lease.token,
+        created_at=time.time(),
+        status='running',
+        group_bursts=group_bursts,
+        finished_at=None,
+        error=None
+    )
+    save_prediction_run(run)
+    try:
+        # A run that lost its lease must not clear or overwrite the annotations of the run that replaced it.
+        check_fencing_token(f'annotations:{collection_id}', lease)
+        truncate_annotations_for_collection(collection_id)
+
+        offloaded = None
+        if should_use_workers():
+            offloaded = 'Images were predicted by prediction workers, through the Redis queue.'
+        elif profile and prediction_pool() is not None:
+            offloaded = f'Images were predicted in a pool of {PREDICTION_PROCESSES} prediction processes.'
+        with profile_run(collection_id, 'predictions', profile, offloaded):
+            file_names = list_image_paths_for_collection(collection_id)
+            bursts = []
+            if group_bursts:
+                # Only the first frame of each burst goes through the models.
+                bursts = group_frames_into_bursts(file_names, read_split_frames(collection_id))
+                file_names = [b['representative'] for b in bursts]
+            save_bursts_for_collection(collection_id, bursts)
+
+            if should_use_workers():
+                yolov_predictions, individual_predictions = predict_with_workers(collection_id, file_names)
+            else:
+                yolov_predictions = predict_bounding_boxes_for_collection(collection_id, file_names=file_names)
+                individual_predictions = predict_individuals_from_yolov_predictions(yolov_predictions)
+            if len(bursts) > 0:
+                yolov_predictions, individual_predictions = propagate_burst_predictions(
+                    collection_id, bursts, yolov_predictions, individual_predictions
+                )
+
+        yolov_predictions.sort(key=lambda p: p.cropped_file_name or '')
+        individual_predictions.sort(key=lambda p: p.cropped_file_name or '')
+        annotations = []
+        for yolov_prediction, individual_prediction in zip(
+                yolov_predictions, individual_predictions
+        ):
+            annotations.append(Annotation(
+                id=yolov_prediction.id,
+                file_name=yolov_prediction.file_name,
+                annotated_file_name=yolov_prediction.annotated_file_name,
+                cropped_file_name=yolov_prediction.cropped_file_name,
+                bbox=yolov_prediction.bbox or [0, 0, 0, 0],
+                species_confidence=yolov_prediction.confidence or 0,
+                predicted_species=yolov_prediction.predicted_species or UNDETECTED,
+                predicted_name=individual_prediction.individual_name or UNDETECTED,
+                accepted=False,
+                ignored=False,
+            ))
+        check_fencing_token(f'annotations:{collection_id}', lease)
+        save_annotations_for_collection(collection_id, annotations)
+    except Exception as e:
+        save_prediction_run(PredictionRun(**{**run, 'status': 'failed', 'finished_at': time.time(), 'error': str(e)}))
+        raise
+    save_prediction_run(PredictionRun(**{**run, 'status': 'completed', 'finished_at': time.time()}))
+    return annotations
@@ -0,0 +1,21 @@
+from typing import TypedDict, List
+
+from flask import Blueprint
+
+from api.endpoints.helpers import must_get_collection_id
+from api.profiling import Profile, list_profiles_for_collection
+
+flask_blueprint = Blueprint('profiles', __name__)
+
+
+class GetProfilesResponse(TypedDict):
+    status: str
+    profiles: List[Profile]
+
+
+@flask_blueprint.get('/api/v1/profiles')
+def get_profiles() -> GetProfilesResponse:
+    collection_id = must_get_collection_id()
+    return {'status': 'ok', 'profiles': [
+        Profile(name=p['name'], files=[f'/{f}' for f in p['files']]) for p in list_profiles_for_collection(collection_id)
+    ]}
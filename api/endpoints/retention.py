@@ -0,0 +1,53 @@
+from typing import TypedDict
+
+import flask
+from flask import request, Blueprint
+
+from api.data_models.retention_policies import RetentionPolicy, read_retention_policy, save_retention_policy
+from api.endpoints.helpers import must_get_collection_id, is_dry_run
+from api.retention import GcReport, collect_garbage
+
+flask_blueprint = Blueprint('retention', __name__)
+
+POLICY_FIELDS = {'inputs_max_age_days', 'profiles_max_age_days', 'retrain_logs_max_age_days'}
+
+
+class RetentionPolicyResponse(TypedDict):
+    status: str
+    policy: RetentionPolicy
+
+
+class PostGcResponse(TypedDict):
+    status: str
+    report: GcReport
+
+
+@flask_blueprint.get('/api/v1/retention')
+def get_retention_policy() -> RetentionPolicyResponse:
+    collection_id = must_get_collection_id()
+    return {'status': 'ok', 'policy': read_retention_policy(collection_id)}
+
+
+@flask_blueprint.put('/api/v1/retention')
+def put_retention_policy() -> RetentionPolicyResponse:
+    collection_id = must_get_collection_id()
+    update = request.get_json()
+    if not isinstance(update, dict):
+        flask.abort(400, 'Expected a JSON object.')
+    unknown_fields = set(update.keys()) - POLICY_FIELDS
+    if len(unknown_fields) > 0:
+        flask.abort(400, f"Unknown fields: {', '.join(sorted(unknown_fields))}.")
+    for field, value in update.items():
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0):
+            flask.abort(400, f'Field `{field}` must be a non-negative number of days or null.')
+
+    policy = read_retention_policy(collection_id)
+    policy.update(update)
+    save_retention_policy(policy)
+    return {'status': 'ok', 'policy': policy}
+
+
+@flask_blueprint.post('/api/v1/retention/gc')
+def post_gc() -> PostGcResponse:
+    collection_id = must_get_collection_id()
+    return {'status': 'ok', 'report': collect_garbage(collection_id, dry_run=is_dry_run())}
@@ -2,13 +2,14 @@ import time
 from multiprocessing import Process
 from typing import TypedDict, List, Optional
 
+import flask
 from flask import Blueprint, current_app
 
 from api.data_models.retrain_event_log import RetrainEventLog, truncate_job_logs, read_event_logs
 from api.data_models.retrain_status import RetrainStatus, delete_job_status_from_redis, read_job_status_from_redis, \
     save_job_status_to_redis
-from api.retraining.retraining_orchestrator import RetrainingOrchestrator
-from api.endpoints.helpers import StatusResponse, must_get_collection_id
+from api.endpoints.helpers import StatusResponse, must_get_collection_id, should_profile, get_deadline
+from api.leases import LEASE_POLL_SECONDS, LEASE_TTL_SECONDS, acquire_lease, read_lease_token
 
 flask_blueprint = Blueprint('retrain_job', __name__)
 
@@ -23,35 +24,64 @@ class GetRetrainLogsResponse(TypedDict):
     logs: List[RetrainEventLog]
 
 
+def retraining_lease_name(collection_id: str) -> str:
+    return f'retrain:{collection_id}'
+
+
 @flask_blueprint.post('/api/v1/retrain/classifier')
 def post_retrain_classifier() -> StatusResponse:
-    collection_id = must_get_collection_id()
-    save_job_status_to_redis(RetrainStatus(
-        collection_id=collection_id,
-        created_at=time.time(),
-        status='created'
-    ))
-    trainer = RetrainingOrchestrator(
-        collection_id=collection_id,
-        logger=current_app.logger,
-        classifier_only=True
-    )
-    Process(target=trainer.start_retraining, args=()).start()
-    return {'status': 'ok'}
+    return start_retraining(classifier_only=True)
 
 
 @flask_blueprint.post('/api/v1/retrain/embeddings')
 def post_retrain_embeddings() -> StatusResponse:
+    return start_retraining(classifier_only=False)
+
+
+def start_retraining(classifier_only: bool) -> StatusResponse:
+    """
+    Starts retraining in a background process. A request made while retraining with the same options is running
+    returns without starting another, and one with different options gets a 409.
+    """
     collection_id = must_get_collection_id()
+    deadline = get_deadline()
+    lease_name = retraining_lease_name(collection_id)
+    lease = acquire_lease(lease_name)
+    # The holder saves the job status right after acquiring the lease, so wait a little for it to appear.
+    wait_until = time.time() + LEASE_TTL_SECONDS
+    while lease is None:
+        token = read_lease_token(lease_name)
+        job = read_job_status_from_redis(collection_id)
+        if token is not None and job['token'] == token:
+            if job['classifier_only'] != classifier_only or job['deadline'] != deadline:
+                flask.abort(409, f'Retraining for `{collection_id}` is already running with different options.')
+            # Its progress is reported by the status endpoint.
+            return {'status': 'ok'}
+        if token is not None and time.time() > wait_until:
+            # The status of the running job was cleared, so its options are unknown.
+            return {'status': 'ok'}
+        time.sleep(LEASE_POLL_SECONDS)
+        lease = acquire_lease(lease_name)
+
+    # Imported here so that the ML stack is only loaded once retraining starts.
+    from api.retraining.retraining_orchestrator import RetrainingOrchestrator
+
     save_job_status_to_redis(RetrainStatus(
         collection_id=collection_id,
         created_at=time.time(),
-        status='created'
+        status='created',
+        budget=None,
+        token=lease.token,
+        classifier_only=classifier_only,
+        deadline=deadline
     ))
     trainer = RetrainingOrchestrator(
         collection_id=collection_id,
         logger=current_app.logger,
-        classifier_only=False
+        classifier_only=classifier_only,
+        profile=should_profile(),
+        lease=lease,
+        deadline=deadline
     )
     Process(target=trainer.start_retraining, args=()).start()
     return {'status': 'ok'}
@@ -4,7 +4,7 @@ from typing import List, TypedDict
 
 from flask import Blueprint
 
-from api.data_models.species import Species
+from api.data_models.species import list_species
 
 flask_blueprint = Blueprint('species', __name__)
 
@@ -16,4 +16,4 @@ class GetSpeciesResponse(TypedDict):
 
 @flask_blueprint.get('/api/v1/species')
 def get_species() -> GetSpeciesResponse:
-    return {'status': 'ok', 'species': [x.value for x in Species]}
+    return {'status': 'ok', 'species': [x.value for x in list_species()]}
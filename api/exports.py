@@ -0,0 +1,284 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from typing import NamedTuple, Optional, List, Iterator, Tuple, Dict
+
+import PIL.ImageFile
+
+from api.clients.s3_client import s3_bucket
+from api.data_models.annotations import Annotation, UNDETECTED, read_annotations_for_collection
+from api.data_models.prediction_inputs import INPUTS_PATH, OUTPUTS_PATH
+from api.storage import StoredFile, list_stored_files
+
+EXPORT_FORMATS = ['tar', 'zip']
+ANNOTATION_FORMATS = ['json', 'coco']
+EXPORT_CONTENTS = ['inputs', 'cropped', 'annotated']
+# Files are streamed in chunks of this many bytes, so memory use does not depend on the size of the collection.
+CHUNK_SIZE = 256 * 1024
+# Most bytes read from the start of an image to find its dimensions for COCO annotations.
+IMAGE_HEADER_BYTES = 1024 * 1024
+# Zip archives cannot store dates before 1980.
+ZIP_MIN_TIMESTAMP = 315619200
+
+
+class ArchiveEntry(NamedTuple):
+    name: str
+    size: int
+    modified: float
+    # The website-data path the contents are read from, or None for generated contents.
+    source: Optional[StoredFile]
+    data: Optional[bytes]
+
+
+class Segment(NamedTuple):
+    offset: int
+    size: int
+    data: Optional[bytes]
+    source: Optional[StoredFile]
+
+
+class ArchivePlan(NamedTuple):
+    entries: List[ArchiveEntry]
+    # Byte layout of the archive, only known in advance for tar archives.
+    segments: Optional[List[Segment]]
+    size: Optional[int]
+    etag: str
+
+
+def plan_export(
+        collection_id: str,
+        archive_format: str,
+        annotation_format: str,
+        contents: List[str]
+) -> ArchivePlan:
+    """
+    Lists the files of a collection to export. Tar archives are laid out in advance, so that a response can be resumed
+    from any byte offset.
+    """
+    annotations = sorted(read_annotations_for_collection(collection_id), key=lambda a: a['id'])
+    inputs = list_stored_files(f'{INPUTS_PATH}/{collection_id}/')
+    outputs = list_stored_files(f'{OUTPUTS_PATH}/{collection_id}/')
+
+    files: Dict[str, StoredFile] = {}
+    if 'inputs' in contents:
+        files.update(inputs)
+    for annotation in annotations:
+        for content, key in [('cropped', annotation['cropped_file_name']),
+                             ('annotated', annotation['annotated_file_name'])]:
+            if content in contents and key in outputs:
+                files[key] = outputs[key]
+
+    if annotation_format == 'coco':
+        annotations_name, annotations_data = 'annotations_coco.json', __coco_annotations(annotations, inputs)
+    else:
+        annotations_name, annotations_data = 'annotations.json', json.dumps(annotations, indent=2).encode()
+
+    modified = max([f.modified for f in files.values()], default=0)
+    entries = [ArchiveEntry(
+        name=f'{collection_id}/{annotations_name}',
+        size=len(annotations_data),
+        modified=modified,
+        source=None,
+        data=annotations_data
+    )]
+    for key in sorted(files.keys()):
+        entries.append(ArchiveEntry(
+            name=f'{collection_id}/{__archive_path(collection_id, key)}',
+            size=files[key].size,
+            modified=files[key].modified,
+            source=files[key],
+            data=None
+        ))
+
+    digest = hashlib.sha1(f'{archive_format}:{annotation_format}'.encode())
+    digest.update(annotations_data)
+    for entry in entries[1:]:
+        digest.update(f'{entry.name}:{entry.size}:{entry.modified}'.encode())
+    etag = digest.hexdigest()
+
+    if archive_format == 'tar':
+        segments = __tar_segments(entries)
+        size = segments[-1].offset + segments[-1].size
+        return ArchivePlan(entries=entries, segments=segments, size=size, etag=etag)
+    return ArchivePlan(entries=entries, segments=None, size=None, etag=etag)
+
+
+def stream_tar(plan: ArchivePlan, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Yields the bytes of a tar archive from start up to and including end.
+    """
+    end = plan.size - 1 if end is None else end
+    for segment in plan.segments:
+        segment_end = segment.offset + segment.size - 1
+        if segment_end < start or segment.offset > end:
+            continue
+        first = max(start, segment.offset) - segment.offset
+        last = min(end, segment_end) - segment.offset
+        if segment.data is not None:
+            yield segment.data[first:last + 1]
+        else:
+            yield from read_chunks(segment.source, first, last)
+
+
+def stream_zip(plan: ArchivePlan) -> Iterator[bytes]:
+    """
+    Yields the bytes of a zip archive. Images are already compressed, so entries are stored rather than deflated.
+    """
+    buffer = ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for entry in plan.entries:
+            info = zipfile.ZipInfo(entry.name, date_time=time.localtime(max(entry.modified, ZIP_MIN_TIMESTAMP))[:6])
+            info.file_size = entry.size
+            with archive.open(info, 'w', force_zip64=True) as dest:
+                chunks = [entry.data] if entry.data is not None else read_chunks(entry.source, 0, entry.size - 1)
+                for chunk in chunks:
+                    dest.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+    yield from buffer.drain()
+
+
+def read_chunks(source: StoredFile, first: int, last: int) -> Iterator[bytes]:
+    """
+    Yields bytes first to last of a file, reading from local disk if it is there and from S3 otherwise.
+    """
+    if last < first:
+        return
+    if source.local and os.path.exists(source.key):
+        with open(source.key, 'rb') as f:
+            f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if len(chunk) == 0:
+                    raise IOError(f'{source.key} changed while it was being exported.')
+                remaining -= len(chunk)
+                yield chunk
+        return
+    body = s3_bucket.Object(source.key).get(Range=f'bytes={first}-{last}')['Body']
+    yield from body.iter_chunks(CHUNK_SIZE)
+
+
+class ChunkBuffer(io.RawIOBase):
+    """
+    A write-only stream that holds what has been written until it is drained. It is not seekable, so zipfile writes
+    sizes and checksums after each entry's data instead of seeking back to its header.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.__chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.__chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> Iterator[bytes]:
+        """
+        Yields what has been written since the last drain, if anything. Empty chunks would end a chunked response.
+        """
+        data = b''.join(self.__chunks)
+        self.__chunks = []
+        if len(data) > 0:
+            yield data
+
+
+def __tar_segments(entries: List[ArchiveEntry]) -> List[Segment]:
+    segments = []
+    offset = 0
+
+    def append(size: int, data: Optional[bytes] = None, source: Optional[StoredFile] = None) -> None:
+        nonlocal offset
+        if size > 0:
+            segments.append(Segment(offset=offset, size=size, data=data, source=source))
+            offset += size
+
+    for entry in entries:
+        info = tarfile.TarInfo(entry.name)
+        info.size = entry.size
+        info.mtime = int(entry.modified)
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT)
+        append(len(header), data=header)
+        append(entry.size, data=entry.data, source=entry.source)
+        append(-entry.size % tarfile.BLOCKSIZE, data=bytes(-entry.size % tarfile.BLOCKSIZE))
+
+    # Two empty blocks end the archive, which is then padded to a whole record, as tarfile does.
+    end_size = 2 * tarfile.BLOCKSIZE
+    end_size += -(offset + end_size) % tarfile.RECORDSIZE
+    append(end_size, data=bytes(end_size))
+    return segments
+
+
+def __archive_path(collection_id: str, key: str) -> str:
+    # website-data/inputs/<collectionID>/<name> is stored as <collectionID>/inputs/<name>, and
+    # website-data/outputs/<collectionID>/<kind>/... as <collectionID>/<kind>/...
+    for prefix, folder in [(f'{INPUTS_PATH}/{collection_id}/', 'inputs/'), (f'{OUTPUTS_PATH}/{collection_id}/', '')]:
+        if key.startswith(prefix):
+            return folder + key.removeprefix(prefix)
+    return key
+
+
+def __coco_annotations(annotations: List[Annotation], inputs: Dict[str, StoredFile]) -> bytes:
+    file_names = sorted({a['file_name'] for a in annotations})
+    image_ids = {file_name: idx + 1 for idx, file_name in enumerate(file_names)}
+    # Images without detections are still listed, but have no annotations and add no category.
+    detections = [a for a in annotations if a['cropped_file_name'] is not None and a['predicted_species'] != UNDETECTED]
+    species = sorted({a['predicted_species'] for a in detections})
+    category_ids = {s: idx + 1 for idx, s in enumerate(species)}
+
+    images = []
+    for file_name in file_names:
+        width, height = __image_size(inputs.get(file_name))
+        images.append({
+            'id': image_ids[file_name],
+            'file_name': os.path.basename(file_name),
+            'width': width,
+            'height': height,
+        })
+
+    coco_annotations = []
+    for annotation in detections:
+        x, y, w, h = annotation['bbox']
+        coco_annotations.append({
+            'id': len(coco_annotations) + 1,
+            'image_id': image_ids[annotation['file_name']],
+            'category_id': category_ids.get(annotation['predicted_species']),
+            'bbox': annotation['bbox'],
+            'area': w * h,
+            'iscrowd': 0,
+            'attributes': {
+                'annotation_id': annotation['id'],
+                'individual': annotation['predicted_name'],
+                'species_confidence': annotation['species_confidence'],
+                'accepted': annotation['accepted'],
+                'ignored': annotation['ignored'],
+            },
+        })
+
+    return json.dumps({
+        'images': images,
+        'annotations': coco_annotations,
+        'categories': [{'id': category_ids[s], 'name': s} for s in species],
+    }, indent=2).encode()
+
+
+def __image_size(source: Optional[StoredFile]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Returns the dimensions of an image, only reading as much of it as needed to parse its header.
+    """
+    if source is None:
+        return None, None
+    parser = PIL.ImageFile.Parser()
+    for chunk in read_chunks(source, 0, min(source.size, IMAGE_HEADER_BYTES) - 1):
+        parser.feed(chunk)
+        if parser.image is not None:
+            return parser.image.size
+    return None, None
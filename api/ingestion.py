@@ -0,0 +1,360 @@
+import io
+import logging
+import os
+import struct
+import tarfile
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import NamedTuple, Optional, Iterator, TypedDict, BinaryIO, Dict, List, Set
+
+import PIL.Image
+
+from api.clients.s3_client import s3_bucket
+from api.data_models.derivatives import prewarm_derivatives
+from api.data_models.prediction_inputs import INPUTS_PATH
+from api.data_models.versions import bump_version, images_resource
+from api.metrics import observe_stage, submit_tracked
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMATS = ['tar', 'zip']
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg']
+# Threads that decode-check and write extracted images, and threads that upload them to S3.
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '4'))
+INGEST_UPLOAD_THREADS = int(os.getenv('INGEST_UPLOAD_THREADS', '8'))
+# Larger archive entries are rejected without being held in memory.
+INGEST_MAX_IMAGE_BYTES = int(os.getenv('INGEST_MAX_IMAGE_BYTES', str(64 * 1024 * 1024)))
+# Extracted images waiting to be checked and written. Reading the archive pauses while this many are in memory.
+INGEST_MAX_IN_FLIGHT = 2 * INGEST_WORKERS
+CHUNK_SIZE = 256 * 1024
+DECODE_CHECK_SIZE = 256
+
+ZIP_LOCAL_FILE_SIGNATURE = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+# Signatures of the records that follow the last entry of an archive: the central directory, the zip64 end of central
+# directory and the end of central directory, which is all an empty archive contains.
+ZIP_END_SIGNATURES = [b'PK\x01\x02', b'PK\x06\x06', b'PK\x05\x06']
+ZIP_FLAG_ENCRYPTED = 0x01
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xFFFFFFFF
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+upload_executor = ThreadPoolExecutor(max_workers=INGEST_UPLOAD_THREADS, thread_name_prefix='ingest-upload')
+
+
+class ArchiveMember(NamedTuple):
+    name: str
+    data: Optional[bytes]
+    error: Optional[str]
+
+
+class IngestResult(TypedDict):
+    file_name: str
+    status: str
+    error: Optional[str]
+
+
+class IngestSummary(TypedDict):
+    status: str
+    saved: int
+    invalid: int
+    skipped: int
+    failed: int
+    error: Optional[str]
+
+
+def ingest_archive(collection_id: str, stream: BinaryIO, archive_format: str) -> Iterator[Dict]:
+    """
+    Extracts the images in a tar or zip stream into a collection while the stream is still arriving. Each image is
+    decode-checked and written by a worker pool and uploaded to S3 by an upload pool. Yields the result of each file
+    as it completes, and then an IngestSummary.
+
+    At most INGEST_MAX_IN_FLIGHT images are held in memory, so memory use does not depend on the size of the archive.
+    """
+    os.makedirs(f'{INPUTS_PATH}/{collection_id}', exist_ok=True)
+    in_flight = threading.BoundedSemaphore(INGEST_MAX_IN_FLIGHT)
+    pending: Dict[Future, str] = {}
+    counts = {'saved': 0, 'invalid': 0, 'skipped': 0, 'failed': 0}
+    saved_file_names: List[str] = []
+    # Images are saved under their base name, so a second image with the same name would overwrite the first.
+    seen_file_names: Set[str] = set()
+
+    def completed(block: bool) -> Iterator[IngestResult]:
+        done, _ = wait(pending.keys(), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = pending.pop(future)
+            result: IngestResult = future.result()
+            if stage == 'save' and result['status'] == 'saved' and s3_bucket is not None:
+                pending[submit_tracked(upload_executor, 'ingest_upload', __upload, result['file_name'])] = 'upload'
+                continue
+            if result['status'] == 'saved':
+                saved_file_names.append(result['file_name'])
+            counts[result['status']] += 1
+            yield result
+
+    error = None
+    try:
+        members = iter_tar(stream) if archive_format == 'tar' else iter_zip(stream)
+        for member in members:
+            file_name = os.path.basename(member.name)
+            if os.path.splitext(file_name)[1].lower() not in IMAGE_EXTENSIONS or file_name.startswith('.'):
+                counts['skipped'] += 1
+                yield IngestResult(file_name=member.name, status='skipped', error='Not a JPEG image.')
+                continue
+            if member.error is not None:
+                counts['invalid'] += 1
+                yield IngestResult(file_name=member.name, status='invalid', error=member.error)
+                continue
+            if file_name in seen_file_names:
+                counts['failed'] += 1
+                yield IngestResult(
+                    file_name=member.name, status='failed', error=f'Another image in the archive is named {file_name}.'
+                )
+                continue
+            seen_file_names.add(file_name)
+
+            in_flight.acquire()
+            future = submit_tracked(ingest_executor, 'ingest', __check_and_save, collection_id, file_name, member.data)
+            future.add_done_callback(lambda _: in_flight.release())
+            pending[future] = 'save'
+            yield from completed(block=False)
+    except (tarfile.TarError, zlib.error, ValueError, EOFError) as e:
+        logger.warning(f'Stopped reading archive for collection {collection_id}: {e}')
+        error = f'Invalid archive: {e}'
+
+    while len(pending) > 0:
+        yield from completed(block=True)
+
+    if len(saved_file_names) > 0:
+        bump_version(images_resource(collection_id))
+    prewarm_derivatives(saved_file_names)
+    yield IngestSummary(status='ok' if error is None else 'error', error=error, **counts)
+
+
+def iter_tar(stream: BinaryIO) -> Iterator[ArchiveMember]:
+    """
+    Reads a tar archive, optionally gzip, bzip2 or xz compressed, from a stream that cannot seek.
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for info in archive:
+            if not info.isfile():
+                continue
+            if info.size > INGEST_MAX_IMAGE_BYTES:
+                yield ArchiveMember(name=info.name, data=None, error='File is too large.')
+                continue
+            yield ArchiveMember(name=info.name, data=archive.extractfile(info).read(), error=None)
+
+
+def iter_zip(stream: BinaryIO) -> Iterator[ArchiveMember]:
+    """
+    Reads a zip archive from a stream that cannot seek, using the local header in front of each entry rather than the
+    central directory at the end of the archive. Stored and deflated entries are supported, including entries whose
+    sizes are only written after their data, as by zip writers that cannot seek.
+    """
+    reader = PushbackReader(stream)
+    while True:
+        signature = reader.read(4)
+        if signature in ZIP_END_SIGNATURES:
+            return
+        if signature != ZIP_LOCAL_FILE_SIGNATURE:
+            raise ValueError('Not a zip archive.')
+
+        flags, method, crc, compressed_size, size, name_length, extra_length = struct.unpack(
+            '<2xHH4xIIIHH', reader.read_exactly(26)
+        )
+        name = reader.read_exactly(name_length).decode('utf-8' if flags & ZIP_FLAG_UTF8 else 'cp437')
+        extra = reader.read_exactly(extra_length)
+        if ZIP64_LIMIT in [size, compressed_size]:
+            size, compressed_size = __zip64_sizes(extra, size, compressed_size)
+        has_descriptor = flags & ZIP_FLAG_DATA_DESCRIPTOR != 0
+
+        if flags & ZIP_FLAG_ENCRYPTED or method not in [ZIP_STORED, ZIP_DEFLATED]:
+            if has_descriptor:
+                raise ValueError(f'Cannot read past {name}, which is encrypted or uses an unsupported compression.')
+            reader.skip(compressed_size)
+            yield ArchiveMember(name=name, data=None, error='Encrypted or unsupported compression.')
+            continue
+
+        if method == ZIP_DEFLATED:
+            data, compressed_size, size = __inflate(reader, name)
+        elif has_descriptor:
+            data = __read_stored_until_descriptor(reader, name)
+            compressed_size = size = len(data)
+        elif compressed_size > INGEST_MAX_IMAGE_BYTES:
+            reader.skip(compressed_size)
+            data = None
+        else:
+            data = reader.read_exactly(compressed_size)
+
+        if has_descriptor:
+            crc = __read_data_descriptor(reader, compressed_size, size)
+        if name.endswith('/'):
+            continue
+        if data is None:
+            yield ArchiveMember(name=name, data=None, error='File is too large.')
+        elif zlib.crc32(data) != crc:
+            yield ArchiveMember(name=name, data=None, error='Checksum mismatch.')
+        else:
+            yield ArchiveMember(name=name, data=data, error=None)
+
+
+class PushbackReader:
+    """
+    Wraps a stream so that bytes read past the end of an entry can be put back for the next one.
+    """
+
+    def __init__(self, stream: BinaryIO):
+        self.__stream = stream
+        self.__buffer = b''
+
+    def read(self, n: int) -> bytes:
+        """
+        Reads up to n bytes, which is fewer only at the end of the stream.
+        """
+        chunks = [self.__buffer[:n]]
+        self.__buffer = self.__buffer[n:]
+        remaining = n - len(chunks[0])
+        while remaining > 0:
+            chunk = self.__stream.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def read_exactly(self, n: int) -> bytes:
+        data = self.read(n)
+        if len(data) < n:
+            raise EOFError('Archive ended unexpectedly.')
+        return data
+
+    def read_some(self) -> bytes:
+        if len(self.__buffer) > 0:
+            data, self.__buffer = self.__buffer, b''
+            return data
+        return self.__stream.read(CHUNK_SIZE)
+
+    def skip(self, n: int) -> None:
+        while n > 0:
+            n -= len(self.read_exactly(min(n, CHUNK_SIZE)))
+
+    def unread(self, data: bytes) -> None:
+        self.__buffer = data + self.__buffer
+
+
+def __check_and_save(collection_id: str, file_name: str, data: bytes) -> IngestResult:
+    try:
+        with observe_stage('ingest_decode_check'):
+            # A reduced size decode still reads every compressed byte, so it catches truncated and corrupt images.
+            image = PIL.Image.open(io.BytesIO(data))
+            image.draft('RGB', (DECODE_CHECK_SIZE, DECODE_CHECK_SIZE))
+            image.load()
+    except Exception as e:
+        return IngestResult(file_name=file_name, status='invalid', error=f'Not a valid image: {e}')
+
+    dest = f'{INPUTS_PATH}/{collection_id}/{file_name}'
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, dest)
+    except OSError as e:
+        logger.exception(f'Failed to save {dest}.')
+        return IngestResult(file_name=dest, status='failed', error=str(e))
+    return IngestResult(file_name=dest, status='saved', error=None)
+
+
+def __upload(dest: str) -> IngestResult:
+    try:
+        with observe_stage('upload'):
+            s3_bucket.upload_file(dest, dest)
+    except Exception as e:
+        logger.exception(f'Failed to upload {dest}.')
+        return IngestResult(file_name=dest, status='failed', error=f'Upload failed: {e}')
+    return IngestResult(file_name=dest, status='saved', error=None)
+
+
+def __zip64_sizes(extra: bytes, size: int, compressed_size: int):
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack('<HH', extra[offset:offset + 4])
+        if header_id == ZIP64_EXTRA_ID:
+            values = extra[offset + 4:offset + 4 + length]
+            # Only the sizes that overflowed are present, uncompressed first.
+            if size == ZIP64_LIMIT:
+                size, values = struct.unpack('<Q', values[:8])[0], values[8:]
+            if compressed_size == ZIP64_LIMIT:
+                compressed_size = struct.unpack('<Q', values[:8])[0]
+            break
+        offset += 4 + length
+    return size, compressed_size
+
+
+def __inflate(reader: PushbackReader, name: str):
+    """
+    Returns the inflated data of an entry, or None if it is too large, along with its compressed and inflated sizes.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    chunks = []
+    size = 0
+    compressed_size = 0
+    while not decompressor.eof:
+        chunk = reader.read_some()
+        if not chunk:
+            raise EOFError(f'Archive ended inside {name}.')
+        compressed_size += len(chunk)
+        data = decompressor.decompress(chunk)
+        size += len(data)
+        if size <= INGEST_MAX_IMAGE_BYTES:
+            chunks.append(data)
+    reader.unread(decompressor.unused_data)
+    compressed_size -= len(decompressor.unused_data)
+    return (b''.join(chunks) if size <= INGEST_MAX_IMAGE_BYTES else None), compressed_size, size
+
+
+def __read_stored_until_descriptor(reader: PushbackReader, name: str) -> bytes:
+    """
+    Reads a stored entry whose size is only written after its data, by finding the data descriptor that follows it.
+    A candidate descriptor is only accepted if its size and checksum match the data before it.
+    """
+    data = b''
+    search_from = 0
+    while True:
+        idx = data.find(ZIP_DATA_DESCRIPTOR_SIGNATURE, search_from)
+        # The descriptor is up to 24 bytes long.
+        if idx >= 0 and len(data) >= idx + 24:
+            crc, size_32 = struct.unpack('<II', data[idx + 4:idx + 12])
+            size_64 = struct.unpack('<Q', data[idx + 8:idx + 16])[0]
+            if idx in [size_32, size_64] and zlib.crc32(data[:idx]) == crc:
+                reader.unread(data[idx:])
+                return data[:idx]
+            search_from = idx + 1
+            continue
+        if len(data) > INGEST_MAX_IMAGE_BYTES:
+            raise ValueError(f'{name} is too large to read without its size.')
+        chunk = reader.read_some()
+        if not chunk:
+            raise EOFError(f'Archive ended inside {name}.')
+        data += chunk
+
+
+def __read_data_descriptor(reader: PushbackReader, compressed_size: int, size: int) -> int:
+    """
+    Reads the data descriptor after an entry and returns its checksum. Sizes are 4 bytes, or 8 bytes in zip64
+    archives, which is told apart by which interpretation matches the sizes that were read.
+    """
+    descriptor = reader.read(24)
+    offset = 4 if descriptor[:4] == ZIP_DATA_DESCRIPTOR_SIGNATURE else 0
+    crc = struct.unpack('<I', descriptor[offset:offset + 4])[0]
+    sizes_32 = struct.unpack('<II', descriptor[offset + 4:offset + 12])
+    if size <= ZIP64_LIMIT and sizes_32 == (compressed_size, size) and len(descriptor) >= offset + 12:
+        reader.unread(descriptor[offset + 12:])
+    else:
+        reader.unread(descriptor[offset + 20:])
+    return crc
@@ -0,0 +1,152 @@
+"""
+Redis leases that let only one process at a time run a piece of work, such as predicting a collection or writing a
+species classifier.
+
+A lease expires unless its holder keeps renewing it, so work held by a process that died is eventually picked up
+again. Each lease comes with a fencing token that increases every time the lease is acquired. Writers check their
+token against the highest one already used for the resource right before writing, so a holder that stalled long enough
+to lose its lease does not overwrite the work of the next holder. The check is not atomic with the write, most of which
+are model files rather than Redis keys, so a holder that stalls between the two can still write stale data. Holders
+renew the lease far more often than it expires, which keeps that window short.
+"""
+import contextlib
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import NamedTuple, Optional, Iterator, List
+
+from api.clients.redis_client import redis_client
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY = 'leases'
+# Seconds a lease lasts without being renewed. Holders renew it three times per period.
+LEASE_TTL_SECONDS = float(os.getenv('LEASE_TTL_SECONDS', '30'))
+LEASE_POLL_SECONDS = 0.5
+
+ACQUIRE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return false
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+return token
+"""
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+FENCE_SCRIPT = """
+local highest = tonumber(redis.call('get', KEYS[1]) or '0')
+if tonumber(ARGV[1]) < highest then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class Lease(NamedTuple):
+    name: str
+    owner: str
+    token: int
+
+    def value(self) -> str:
+        return f'{self.owner}:{self.token}'
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+def acquire_lease(name: str, ttl_seconds: float = LEASE_TTL_SECONDS) -> Optional[Lease]:
+    """
+    Acquires a lease, or returns None if another process holds it.
+    """
+    owner = uuid.uuid4().hex
+    token = __run(ACQUIRE_SCRIPT, [__lease_key(name), __token_key(name)], [owner, int(ttl_seconds * 1000)])
+    if token is None:
+        return None
+    return Lease(name=name, owner=owner, token=int(token))
+
+
+def wait_for_lease(name: str, ttl_seconds: float = LEASE_TTL_SECONDS) -> Lease:
+    """
+    Acquires a lease, waiting for as long as other processes hold it.
+    """
+    while True:
+        lease = acquire_lease(name, ttl_seconds)
+        if lease is not None:
+            return lease
+        time.sleep(LEASE_POLL_SECONDS)
+
+
+def renew_lease(lease: Lease, ttl_seconds: float = LEASE_TTL_SECONDS) -> bool:
+    return __run(RENEW_SCRIPT, [__lease_key(lease.name)], [lease.value(), int(ttl_seconds * 1000)]) == 1
+
+
+def release_lease(lease: Lease) -> None:
+    __run(RELEASE_SCRIPT, [__lease_key(lease.name)], [lease.value()])
+
+
+def read_lease_token(name: str) -> Optional[int]:
+    """
+    Returns the fencing token of the current holder of a lease, or None if nobody holds it.
+    """
+    value = redis_client.get(__lease_key(name))
+    return int(value.rsplit(':', 1)[1]) if value is not None else None
+
+
+def check_fencing_token(resource: str, lease: Lease) -> None:
+    """
+    Raises LeaseLostError if a lease with a newer token has already written to resource, and otherwise records this
+    token as the newest. Call this right before each write, since a stall between the two is not detected.
+    """
+    if __run(FENCE_SCRIPT, [f'{REDIS_KEY}:fences:{resource}'], [lease.token]) != 1:
+        raise LeaseLostError(f'Lease {lease.name} with token {lease.token} was superseded before writing {resource}.')
+
+
+@contextlib.contextmanager
+def keep_lease(lease: Lease, ttl_seconds: float = LEASE_TTL_SECONDS) -> Iterator[Lease]:
+    """
+    Renews a held lease in the background for the duration of the `with` block, and releases it afterwards.
+    """
+    stop = threading.Event()
+
+    def renew() -> None:
+        while not stop.wait(ttl_seconds / 3):
+            if not renew_lease(lease, ttl_seconds):
+                logger.warning(f'Lost lease {lease.name} with token {lease.token}.')
+                return
+
+    thread = threading.Thread(target=renew, name=f'lease-{lease.name}', daemon=True)
+    thread.start()
+    try:
+        yield lease
+    finally:
+        stop.set()
+        thread.join()
+        release_lease(lease)
+
+
+def __run(script: str, keys: List[str], args: List) -> Optional[int]:
+    # Scripts run atomically in Redis. Registering one only hashes it, and it is sent to Redis on first use.
+    return redis_client.register_script(script)(keys=keys, args=args)
+
+
+def __lease_key(name: str) -> str:
+    return f'{REDIS_KEY}:{name}'
+
+
+def __token_key(name: str) -> str:
+    return f'{REDIS_KEY}:tokens:{name}'
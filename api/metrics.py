@@ -0,0 +1,112 @@
+import contextlib
+import os
+import time
+from concurrent.futures import Executor, Future
+from typing import Iterator, Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Set PROMETHEUS_MULTIPROC_DIR when running several worker processes, so that /metrics aggregates all of them.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR', None)
+
+STAGE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600)
+
+STAGE_SECONDS = Histogram(
+    'safarisleuths_stage_seconds',
+    'Time spent in each stage of the prediction and retraining pipelines.',
+    ['stage'],
+    buckets=STAGE_BUCKETS
+)
+STAGE_ITEMS = Counter(
+    'safarisleuths_stage_items_total',
+    'Number of items, such as images or crops, processed by each pipeline stage.',
+    ['stage']
+)
+STAGE_ERRORS = Counter(
+    'safarisleuths_stage_errors_total',
+    'Number of pipeline stage runs that raised an exception.',
+    ['stage']
+)
+REDIS_SECONDS = Histogram(
+    'safarisleuths_redis_command_seconds',
+    'Time spent in each redis command.',
+    ['command']
+)
+MODEL_LOAD_SECONDS = Gauge(
+    'safarisleuths_model_load_seconds',
+    'Time taken by the most recent load of each model.',
+    ['model'],
+    multiprocess_mode='liveall'
+)
+MODEL_VERSION = Gauge(
+    'safarisleuths_model_version',
+    'Modification time of the loaded model file, which changes whenever the model is retrained.',
+    ['model'],
+    multiprocess_mode='liveall'
+)
+MODEL_CACHE_EVENTS = Counter(
+    'safarisleuths_species_model_cache_total',
+    'Hits, misses and evictions of the species classifier and labels cache.',
+    ['event']
+)
+MODEL_CACHE_BYTES = Gauge(
+    'safarisleuths_species_model_cache_bytes',
+    'File size of the species classifiers and labels held in memory.',
+    multiprocess_mode='liveall'
+)
+RESPONSE_CACHE_EVENTS = Counter(
+    'safarisleuths_response_cache_total',
+    'Hits, misses and 304 Not Modified responses of the cache of read-mostly endpoints.',
+    ['event']
+)
+VIDEO_FRAMES = Counter(
+    'safarisleuths_video_frames_total',
+    'Frames of uploaded video clips that were sampled for predictions or skipped.',
+    ['outcome']
+)
+QUEUE_DEPTH = Gauge(
+    'safarisleuths_queue_depth',
+    'Number of tasks waiting or running in each background queue.',
+    ['queue'],
+    multiprocess_mode='livesum'
+)
+PROCESS_RSS = Gauge(
+    'safarisleuths_process_resident_memory_bytes',
+    'Resident memory of each server process.',
+    multiprocess_mode='liveall'
+)
+
+
+@contextlib.contextmanager
+def observe_stage(stage: str, items: int = 1) -> Iterator[None]:
+    """
+    Records the duration of the `with` block, the number of items it processed and any exception it raised.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start_time)
+        STAGE_ITEMS.labels(stage).inc(items)
+
+
+def submit_tracked(executor: Executor, queue: str, fn: Callable, *args) -> Future:
+    """
+    Submits a task to an executor while tracking the depth of its queue.
+    """
+    QUEUE_DEPTH.labels(queue).inc()
+    future = executor.submit(fn, *args)
+    future.add_done_callback(lambda _: QUEUE_DEPTH.labels(queue).dec())
+    return future
+
+
+def update_process_rss() -> None:
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return
+    PROCESS_RSS.set(resident_pages * os.sysconf('SC_PAGE_SIZE'))
@@ -0,0 +1,182 @@
+import logging
+import os
+from datetime import datetime
+from typing import NamedTuple, Optional, List, Set, Tuple, Dict
+
+import PIL.Image
+
+from api.data_models.bursts import Burst
+from api.metrics import observe_stage
+from api.predictions.predict_bounding_boxes import YolovPrediction, RenderTask, render_outputs, \
+    annotated_file_name_for
+
+logger = logging.getLogger(__name__)
+
+# Frames taken within this many seconds of the previous frame in a burst may join the burst.
+BURST_MAX_SECONDS = float(os.getenv('BURST_MAX_SECONDS', '10'))
+# Frames whose perceptual hashes differ by at most this many of their 64 bits are near-duplicates.
+BURST_MAX_HASH_DISTANCE = int(os.getenv('BURST_MAX_HASH_DISTANCE', '6'))
+HASH_SIZE = 8
+
+EXIF_IFD = 0x8769
+EXIF_DATE_TIME_ORIGINAL = 36867
+EXIF_DATE_TIME = 306
+
+
+class Frame(NamedTuple):
+    file_name: str
+    timestamp: Optional[float]
+    hash: int
+
+
+def read_frame(file_name: str) -> Frame:
+    image = PIL.Image.open(file_name)
+    timestamp = __read_timestamp(image)
+    # The hash only needs a tiny grayscale image, so let the JPEG decoder skip most of the work.
+    image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    return Frame(file_name=file_name, timestamp=timestamp, hash=difference_hash(image))
+
+
+def difference_hash(image: PIL.Image.Image) -> int:
+    """
+    Returns a 64 bit perceptual hash, where each bit records whether a pixel is brighter than its right neighbour.
+    """
+    pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), PIL.Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            idx = row * (HASH_SIZE + 1) + col
+            bits = (bits << 1) | int(pixels[idx] > pixels[idx + 1])
+    return bits
+
+
+def hash_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def group_bursts(file_names: List[str], split_file_names: Set[str]) -> List[Burst]:
+    """
+    Groups near-duplicate frames taken in quick succession. Frames are ordered by capture time, and a frame joins the
+    current burst when it was taken soon after the previous frame and looks like the burst's representative, which is
+    its first frame. Frames without an EXIF timestamp and frames a reviewer split out are each a burst of their own.
+    """
+    with observe_stage('burst_hash', items=len(file_names)):
+        frames = [read_frame(file_name) for file_name in file_names]
+    frames.sort(key=lambda f: (f.timestamp is None, f.timestamp or 0, f.file_name))
+
+    groups: List[List[Frame]] = []
+    current: Optional[List[Frame]] = None
+    for frame in frames:
+        if frame.file_name in split_file_names or frame.timestamp is None:
+            # Nothing joins these, and the current burst may continue after them.
+            groups.append([frame])
+        elif current is not None and __joins_burst(current, frame):
+            current.append(frame)
+        else:
+            current = [frame]
+            groups.append(current)
+
+    return [
+        Burst(id=os.path.basename(group[0].file_name), representative=group[0].file_name,
+              file_names=[f.file_name for f in group])
+        for group in groups
+    ]
+
+
+def split_bursts(bursts: List[Burst], file_names: Set[str]) -> List[Burst]:
+    """
+    Moves each of the given frames out of its burst and into a burst of its own.
+    """
+    results = []
+    for burst in bursts:
+        remaining = [f for f in burst['file_names'] if f not in file_names]
+        for file_name in burst['file_names']:
+            if file_name in file_names:
+                results.append(Burst(id=os.path.basename(file_name), representative=file_name, file_names=[file_name]))
+        if len(remaining) > 0:
+            representative = burst['representative'] if burst['representative'] in remaining else remaining[0]
+            results.append(Burst(id=os.path.basename(representative), representative=representative,
+                                 file_names=remaining))
+    return results
+
+
+def propagate_burst_predictions(
+        collection_id: str,
+        bursts: List[Burst],
+        yolov_predictions: List[YolovPrediction],
+        individual_predictions: List,
+) -> Tuple[List[YolovPrediction], List]:
+    """
+    Copies the detections and identities predicted for each burst's representative to the other frames in the burst,
+    and renders their crops and annotated images.
+    """
+    yolov_by_file: Dict[str, List[YolovPrediction]] = {}
+    for prediction in yolov_predictions:
+        yolov_by_file.setdefault(prediction.file_name, []).append(prediction)
+    individual_by_crop = {p.cropped_file_name: p for p in individual_predictions}
+    undetected_individual = next((p for p in individual_predictions if p.cropped_file_name is None), None)
+
+    yolov_results = list(yolov_predictions)
+    individual_results = list(individual_predictions)
+    render_tasks = []
+    for burst in bursts:
+        representative = burst['representative']
+        for file_name in burst['file_names']:
+            if file_name == representative:
+                continue
+            for prediction in yolov_by_file.get(representative, []):
+                member_prediction = __member_prediction(collection_id, prediction, file_name)
+                yolov_results.append(member_prediction)
+                if prediction.cropped_file_name is None:
+                    individual_results.append(undetected_individual)
+                    continue
+                individual_results.append(individual_by_crop[prediction.cropped_file_name]._replace(
+                    cropped_file_name=member_prediction.cropped_file_name
+                ))
+                render_tasks.append(RenderTask(
+                    file_name=file_name,
+                    cropped_file_name=member_prediction.cropped_file_name,
+                    annotated_file_name=member_prediction.annotated_file_name,
+                    bbox=member_prediction.bbox
+                ))
+
+    render_outputs(render_tasks)
+    return yolov_results, individual_results
+
+
+def __member_prediction(collection_id: str, prediction: YolovPrediction, file_name: str) -> YolovPrediction:
+    representative_name = os.path.basename(prediction.file_name)
+    member_name = os.path.basename(file_name)
+
+    def for_member(path: str) -> str:
+        return path.removesuffix(representative_name) + member_name
+
+    if prediction.cropped_file_name is None:
+        return prediction._replace(file_name=file_name, id=member_name.removesuffix('.jpg'))
+    return prediction._replace(
+        file_name=file_name,
+        id=for_member(prediction.id + '.jpg').removesuffix('.jpg'),
+        cropped_file_name=for_member(prediction.cropped_file_name),
+        annotated_file_name=annotated_file_name_for(collection_id, file_name)
+    )
+
+
+def __joins_burst(burst: List[Frame], frame: Frame) -> bool:
+    previous = burst[-1]
+    # Without timestamps, frames of a fixed camera taken hours apart would look like one burst.
+    if frame.timestamp is None or previous.timestamp is None:
+        return False
+    if frame.timestamp - previous.timestamp > BURST_MAX_SECONDS:
+        return False
+    return hash_distance(burst[0].hash, frame.hash) <= BURST_MAX_HASH_DISTANCE
+
+
+def __read_timestamp(image: PIL.Image.Image) -> Optional[float]:
+    exif = image.getexif()
+    value = exif.get_ifd(EXIF_IFD).get(EXIF_DATE_TIME_ORIGINAL) or exif.get(EXIF_DATE_TIME)
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
@@ -0,0 +1,98 @@
+"""
+Predictions split into per-image tasks on a Redis stream, which `python -m api.predictions.worker` processes on any
+number of nodes take from a consumer group. Workers read images from S3 when they are not on local disk, and upload
+their crops and annotated images there, so every node must share Redis and S3 with the api server. The api server
+downloads those outputs from S3 when they are first requested, and retraining downloads the accepted crops it trains on.
+"""
+import logging
+import os
+import time
+import uuid
+from typing import List, Tuple
+
+from api.data_models.prediction_tasks import PredictionTask, PredictionTaskResult, publish_prediction_tasks, \
+    count_prediction_task_results, read_prediction_task_results, delete_prediction_task_results
+from api.metrics import observe_stage
+from api.predictions.predict_bounding_boxes import YolovPrediction, BoundingBox, predict_bounding_boxes_for_files
+from api.predictions.predict_individual import IndividualPrediction, predict_individuals_for_shard
+from api.storage import ensure_local
+
+logger = logging.getLogger(__name__)
+
+# `local` runs predictions in the process that received the request, `redis` hands them to prediction workers.
+PREDICTION_QUEUE = os.getenv('PREDICTION_QUEUE', 'local')
+PREDICTION_QUEUES = ['local', 'redis']
+if PREDICTION_QUEUE not in PREDICTION_QUEUES:
+    raise ValueError(f'PREDICTION_QUEUE must be one of {PREDICTION_QUEUES}, not `{PREDICTION_QUEUE}`.')
+# How long a prediction request waits for workers to complete every task.
+PREDICTION_RUN_TIMEOUT_SECONDS = float(os.getenv('PREDICTION_RUN_TIMEOUT_SECONDS', str(6 * 60 * 60)))
+RESULTS_POLL_SECONDS = 0.5
+
+
+def should_use_workers() -> bool:
+    return PREDICTION_QUEUE == 'redis'
+
+
+def predict_with_workers(
+        collection_id: str,
+        file_names: List[str]
+) -> Tuple[List[YolovPrediction], List[IndividualPrediction]]:
+    """
+    Publishes a task for each image and waits for workers to complete them all. Images whose task failed on every
+    attempt are left out of the results.
+    """
+    run_id = uuid.uuid4().hex
+    publish_prediction_tasks([
+        PredictionTask(run_id=run_id, collection_id=collection_id, file_name=file_name, attempt=0)
+        for file_name in file_names
+    ])
+    logger.info(f'Published {len(file_names)} prediction tasks for run {run_id}.')
+
+    deadline = time.monotonic() + PREDICTION_RUN_TIMEOUT_SECONDS
+    try:
+        with observe_stage('prediction_tasks_wait', items=len(file_names)):
+            while count_prediction_task_results(run_id) < len(file_names):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Prediction workers did not complete run {run_id} in time.')
+                time.sleep(RESULTS_POLL_SECONDS)
+        results = read_prediction_task_results(run_id)
+    finally:
+        delete_prediction_task_results(run_id)
+
+    yolov_predictions = []
+    individual_predictions = []
+    for file_name in sorted(results.keys()):
+        result = results[file_name]
+        if result['error'] is not None:
+            logger.warning(f'Prediction failed for {file_name}: {result["error"]}')
+            continue
+        yolov_predictions += [__yolov_prediction(p) for p in result['yolov_predictions']]
+        individual_predictions += [IndividualPrediction(*p) for p in result['individual_predictions']]
+    return yolov_predictions, individual_predictions
+
+
+def predict_task(task: PredictionTask) -> PredictionTaskResult:
+    """
+    Detects the animals in one image and identifies each of them, in the current process.
+    """
+    if not ensure_local(task['file_name']):
+        raise FileNotFoundError(f'{task["file_name"]} is neither on local disk nor in S3.')
+    yolov_predictions = predict_bounding_boxes_for_files([task['file_name']], task['collection_id'])
+    individual_predictions = predict_individuals_for_shard(yolov_predictions)
+    return PredictionTaskResult(
+        file_name=task['file_name'],
+        yolov_predictions=[list(p) for p in yolov_predictions],
+        individual_predictions=[
+            # Labels predicted by scikit-learn are numpy integers, which JSON cannot encode.
+            [p.cropped_file_name, None if p.individual_label is None else int(p.individual_label), p.individual_name]
+            for p in individual_predictions
+        ],
+        error=None
+    )
+
+
+def __yolov_prediction(fields: List) -> YolovPrediction:
+    prediction = YolovPrediction(*fields)
+    if prediction.bbox is not None:
+        prediction = prediction._replace(bbox=BoundingBox(*prediction.bbox))
+    return prediction
@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple, List, TypedDict
+
+from api.data_models.species import Species, list_species
+from api.metrics import MODEL_LOAD_SECONDS, MODEL_VERSION, MODEL_CACHE_EVENTS, MODEL_CACHE_BYTES
+
+logger = logging.getLogger(__name__)
+
+# torch, torchvision and joblib are imported by the loaders, so that importing this module stays cheap.
+
+DETECTOR_PATH = 'models/frozen_backbone_coco_unlabeled.pt'
+BACKBONE_PATH = 'models/simclrresnet18embed.pth'
+
+# Bytes of per-species classifiers and labels kept in memory, measured by the size of their files. The least recently
+# used species are evicted first.
+SPECIES_MODEL_CACHE_BYTES = int(os.getenv('SPECIES_MODEL_CACHE_BYTES', str(1024 * 1024 * 1024)))
+
+# Loaded models keyed by file path, along with the modification time of the file when it was loaded.
+__models: Dict[str, Tuple[float, Any]] = {}
+__models_lock = threading.Lock()
+# Loaded species classifiers and labels keyed by file path, along with their modification times and file sizes.
+__species_models: OrderedDict[str, Tuple[float, int, Any]] = OrderedDict()
+__species_models_lock = threading.Lock()
+
+
+class ModelCacheStats(TypedDict):
+    entries: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+__species_stats = ModelCacheStats(entries=0, bytes=0, max_bytes=SPECIES_MODEL_CACHE_BYTES, hits=0, misses=0, evictions=0)
+
+
+def load_detector():
+    return __load_cached(DETECTOR_PATH, __load_detector)
+
+
+def load_backbone():
+    return __load_cached(BACKBONE_PATH, __load_backbone)
+
+
+def load_classifier(species: Species):
+    return __load_species_cached(species.model_location(), lambda: __load_classifier(species))
+
+
+def load_labels(species: Species) -> List[str]:
+    return __load_species_cached(species.labels_location(), species.read_labels)
+
+
+def species_model_cache_stats() -> ModelCacheStats:
+    with __species_models_lock:
+        return ModelCacheStats(**__species_stats)
+
+
+def preload_models() -> None:
+    """
+    Loads every model into memory, and as many species classifiers as fit in the cache. Call this before forking
+    worker processes so that the weights are shared.
+    """
+    load_detector()
+    load_backbone()
+    for species in list_species():
+        if not species.has_classifier():
+            continue
+        size = os.path.getsize(species.model_location()) + os.path.getsize(species.labels_location())
+        # A smaller species later on may still fit.
+        if species_model_cache_stats()['bytes'] + size > SPECIES_MODEL_CACHE_BYTES:
+            continue
+        load_classifier(species)
+        load_labels(species)
+
+
+def __load_cached(path: str, load: Callable[[], Any]) -> Any:
+    """
+    Returns the model loaded from path, reloading it if the file has changed, e.g. after retraining.
+    """
+    mtime = os.path.getmtime(path)
+    with __models_lock:
+        cached = __models.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    logger.info(f'Loading model {path}.')
+    start_time = time.perf_counter()
+    model = load()
+    MODEL_LOAD_SECONDS.labels(path).set(time.perf_counter() - start_time)
+    MODEL_VERSION.labels(path).set(mtime)
+    with __models_lock:
+        __models[path] = (mtime, model)
+    return model
+
+
+def __load_species_cached(path: str, load: Callable[[], Any]) -> Any:
+    """
+    Returns the classifier or labels loaded from path, like __load_cached, but evicts the least recently used ones once
+    they no longer fit in SPECIES_MODEL_CACHE_BYTES.
+    """
+    mtime = os.path.getmtime(path)
+    with __species_models_lock:
+        cached = __species_models.get(path)
+        if cached is not None and cached[0] == mtime:
+            __species_models.move_to_end(path)
+            __species_stats['hits'] += 1
+            MODEL_CACHE_EVENTS.labels('hit').inc()
+            return cached[2]
+        __species_stats['misses'] += 1
+        MODEL_CACHE_EVENTS.labels('miss').inc()
+
+    logger.info(f'Loading model {path}.')
+    start_time = time.perf_counter()
+    model = load()
+    MODEL_LOAD_SECONDS.labels(path).set(time.perf_counter() - start_time)
+    MODEL_VERSION.labels(path).set(mtime)
+
+    size = os.path.getsize(path)
+    with __species_models_lock:
+        __species_models.pop(path, None)
+        __species_models[path] = (mtime, size, model)
+        # The model just loaded is always kept, even if it is larger than the cache on its own.
+        while len(__species_models) > 1 and sum(m[1] for m in __species_models.values()) > SPECIES_MODEL_CACHE_BYTES:
+            evicted, _ = __species_models.popitem(last=False)
+            logger.info(f'Evicted model {evicted}.')
+            __species_stats['evictions'] += 1
+            MODEL_CACHE_EVENTS.labels('eviction').inc()
+        __species_stats['entries'] = len(__species_models)
+        __species_stats['bytes'] = sum(m[1] for m in __species_models.values())
+        MODEL_CACHE_BYTES.set(__species_stats['bytes'])
+    return model
+
+
+def __load_detector():
+    import torch
+    return torch.hub.load(
+        'ultralytics/yolov5', 'custom', DETECTOR_PATH,
+        autoshape=True, force_reload=True
+    )
+
+
+def __load_backbone():
+    import torch
+    import torchvision
+    resnet18 = torchvision.models.resnet18()
+    backbone = torch.nn.Sequential(*list(resnet18.children())[:-1])
+    ckpt = torch.load(BACKBONE_PATH)
+    backbone.load_state_dict(ckpt['resnet18_parameters'])
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    backbone = backbone.to(device)
+    backbone.eval()
+    return backbone, device
+
+
+def __load_classifier(species: Species):
+    import joblib
+    return joblib.load(species.model_location())
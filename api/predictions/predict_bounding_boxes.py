@@ -1,18 +1,22 @@
+import io
 import logging
 import os.path
 from datetime import datetime
-from typing import NamedTuple, Optional, List, Tuple
+from typing import NamedTuple, Optional, List, Tuple, Dict
 
 import PIL
-import torch
 from PIL import Image, ImageDraw
 
-from api.data_models.prediction_inputs import InputImage, read_images_for_collection
+from api.data_models.prediction_inputs import InputImage, OUTPUTS_PATH, read_images, list_image_paths_for_collection
 from api.clients.s3_client import s3_bucket
+from api.data_models.derivatives import prewarm_derivatives
+from api.decoding import decode_image
+from api.metrics import observe_stage
+from api.predictions.models import load_detector
+from api.predictions.sharding import PredictionPool, prediction_pool, map_sharded
 
 logger = logging.getLogger(__name__)
 
-OUTPUTS_PATH = 'website-data/outputs'
 BOX_COLOR = (0, 0, 255)
 
 
@@ -36,42 +40,64 @@ class YolovPrediction(NamedTuple):
     predicted_species: Optional[str]
 
 
-def predict_bounding_boxes_for_collection(collection_id: str) -> List[YolovPrediction]:
+class RenderTask(NamedTuple):
+    file_name: str
+    cropped_file_name: str
+    annotated_file_name: str
+    bbox: BoundingBox
+    # When false the bbox is only drawn on the annotated image, and the existing crop is kept.
+    crop: bool = True
+
+
+def predict_bounding_boxes_for_collection(
+        collection_id: str,
+        pool: Optional[PredictionPool] = None,
+        file_names: Optional[List[str]] = None
+) -> List[YolovPrediction]:
+    """
+    Predicts bounding boxes for the given images of a collection, or for every image if none are given. When a
+    prediction pool is configured, the images are split across its worker processes and the results are merged in file
+    name order.
+    """
     logger.info("Started bounding box prediction.")
     start_time = datetime.now()
 
-    model = torch.hub.load(
-        'ultralytics/yolov5', 'custom', 'models/frozen_backbone_coco_unlabeled.pt',
-        autoshape=True, force_reload=True
-    )
+    file_names = sorted(file_names if file_names is not None else list_image_paths_for_collection(collection_id))
+    pool = pool or prediction_pool()
+    if pool is None:
+        yolov_predictions = predict_bounding_boxes_for_files(file_names, collection_id)
+    else:
+        yolov_predictions = map_sharded(pool, predict_bounding_boxes_for_files, file_names, collection_id)
+    logger.info(f'Bounding box predictions completed after {datetime.now() - start_time}.')
+    return yolov_predictions
+
+
+def predict_bounding_boxes_for_files(file_names: List[str], collection_id: str) -> List[YolovPrediction]:
+    model = load_detector()
 
     yolov_predictions: List[YolovPrediction] = []
-    for input_image in read_images_for_collection(collection_id):
+    for input_image in read_images(file_names):
         yolov_predictions += predict_bounding_boxes(model, input_image, collection_id)
-    logger.info(f'Bounding box predictions completed after {datetime.now() - start_time}.')
 
     logger.info(f'Uploading results.')
     start_time = datetime.now()
-    for prediction in yolov_predictions:
-        if prediction.predicted_species is None:
-            continue
-        image = PIL.Image.open(prediction.file_name)
-        crop_and_upload(
-            image=image.copy(),
-            dest=prediction.cropped_file_name,
-            bbox=prediction.bbox
-        )
-        annotate_and_upload(
-            image=image.copy(),
-            dest=prediction.annotated_file_name,
+    render_outputs([
+        RenderTask(
+            file_name=prediction.file_name,
+            cropped_file_name=prediction.cropped_file_name,
+            annotated_file_name=prediction.annotated_file_name,
             bbox=prediction.bbox
         )
+        for prediction in yolov_predictions
+        if prediction.predicted_species is not None
+    ])
     logger.info(f'Results uploaded after {datetime.now() - start_time}.')
     return yolov_predictions
 
 
 def predict_bounding_boxes(model, input_image: InputImage, collection_id: str) -> List[YolovPrediction]:
-    raw_results = model(input_image.resized_image, size=640).pandas().xyxy[0]
+    with observe_stage('detect'):
+        raw_results = model(input_image.resized_image, size=640).pandas().xyxy[0]
     raw_results.reset_index()
 
     if len(raw_results) == 0:
@@ -94,7 +120,8 @@ def predict_bounding_boxes(model, input_image: InputImage, collection_id: str) -
         predictions.append(YolovPrediction(
             id=output_file_name.removesuffix('.jpg'),
             file_name=input_image.file_name,
-            annotated_file_name=f'{OUTPUTS_PATH}/{collection_id}/annotated/{species_name}/{output_file_name}',
+            # All detections in an image share one annotated image with every bbox drawn.
+            annotated_file_name=annotated_file_name_for(collection_id, input_image.file_name),
             cropped_file_name=f'{OUTPUTS_PATH}/{collection_id}/cropped/{species_name}/{output_file_name}',
             bbox=yolov2coco(
                 xmin=prediction['xmin'],
@@ -111,19 +138,75 @@ def predict_bounding_boxes(model, input_image: InputImage, collection_id: str) -
     return predictions
 
 
+def render_outputs(tasks: List[RenderTask]) -> None:
+    """
+    Renders the cropped and annotated images for each task, decoding each source image only once.
+    Tasks that share an annotated file name are drawn onto a single annotated image.
+    """
+    for file_name, file_tasks in group_render_tasks_by_file(tasks).items():
+        with observe_stage('decode'):
+            image = decode_image(file_name)
+        annotated_bboxes: Dict[str, List[BoundingBox]] = {}
+        for task in file_tasks:
+            if task.crop:
+                crop_and_upload(image=image, dest=task.cropped_file_name, bbox=task.bbox)
+            if task.annotated_file_name not in annotated_bboxes:
+                annotated_bboxes[task.annotated_file_name] = []
+            annotated_bboxes[task.annotated_file_name].append(task.bbox)
+        for annotated_file_name, bboxes in annotated_bboxes.items():
+            annotate_and_upload(image=image.copy(), dest=annotated_file_name, bboxes=bboxes)
+        prewarm_derivatives(
+            [t.cropped_file_name for t in file_tasks if t.crop] + list(annotated_bboxes.keys())
+        )
+
+
+def group_render_tasks_by_file(tasks: List[RenderTask]) -> Dict[str, List[RenderTask]]:
+    results = {}
+    for task in tasks:
+        if task.file_name not in results:
+            results[task.file_name] = []
+        results[task.file_name].append(task)
+    return results
+
+
 def crop_and_upload(image: PIL.Image.Image, dest: str, bbox: BoundingBox) -> None:
-    os.makedirs(os.path.dirname(dest), exist_ok=True)
-    image.crop(bbox.to_xy()).save(dest)
-    if s3_bucket is not None:
-        s3_bucket.upload_file(dest, dest)
+    with observe_stage('crop'):
+        data = encode_jpeg(image.crop(bbox.to_xy()))
+    write_and_upload(dest, data)
+
+
+def annotate_and_upload(image: PIL.Image.Image, dest: str, bboxes: List[BoundingBox]) -> None:
+    with observe_stage('annotate'):
+        draw = ImageDraw.Draw(image)
+        for bbox in bboxes:
+            draw.rectangle(bbox.to_xy(), outline=BOX_COLOR, width=5)
+        data = encode_jpeg(image)
+    write_and_upload(dest, data)
 
 
-def annotate_and_upload(image: PIL.Image.Image, dest: str, bbox: BoundingBox) -> None:
-    ImageDraw.Draw(image).rectangle(bbox.to_xy(), outline=BOX_COLOR, width=5)
-    os.makedirs(os.path.dirname(dest), exist_ok=True)
-    image.save(dest)
+def encode_jpeg(image: PIL.Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def write_and_upload(dest: str, data: bytes) -> None:
+    # Timed apart from encoding, so slow storage shows up on its own.
+    with observe_stage('write'):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(data)
+    upload(dest)
+
+
+def upload(dest: str) -> None:
     if s3_bucket is not None:
-        s3_bucket.upload_file(dest, dest)
+        with observe_stage('upload'):
+            s3_bucket.upload_file(dest, dest)
+
+
+def annotated_file_name_for(collection_id: str, file_name: str) -> str:
+    return f'{OUTPUTS_PATH}/{collection_id}/annotated/{os.path.basename(file_name)}'
 
 
 def yolov2coco(
@@ -1,24 +1,22 @@
-import json
 import logging
 from datetime import datetime
 from typing import NamedTuple, List, Dict, Iterable, Optional, Tuple
 
 import numpy as np
 import torch
-import torchvision
-import PIL.Image
-import joblib
 from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms
 from sklearn.preprocessing import normalize
 
 from api.data_models.species import Species
+from api.decoding import decode_image
+from api.metrics import observe_stage
+from api.predictions.models import load_backbone, load_classifier, load_labels
 from api.predictions.predict_bounding_boxes import YolovPrediction
+from api.predictions.sharding import PredictionPool, prediction_pool, map_sharded
 
 logger = logging.getLogger(__name__)
 
-BACKBONE_PATH = 'models/simclrresnet18embed.pth'
-
 
 class LocalImageDataset(Dataset):
     transform = transforms.Compose([
@@ -35,7 +33,7 @@ class LocalImageDataset(Dataset):
 
     def __getitem__(self, idx: int) -> Tuple[torch.Tensor, int]:
         file_name = self.file_names[idx]
-        image = PIL.Image.open(file_name).convert('RGB')
+        image = decode_image(file_name, (224, 224))
         return self.transform(image), 0
 
 
@@ -51,9 +49,26 @@ class IndividualPrediction(NamedTuple):
     individual_name: Optional[str]
 
 
-def predict_individuals_from_yolov_predictions(yolov_predictions: List[YolovPrediction]) -> List[IndividualPrediction]:
+def predict_individuals_from_yolov_predictions(
+        yolov_predictions: List[YolovPrediction],
+        pool: Optional[PredictionPool] = None
+) -> List[IndividualPrediction]:
+    """
+    Predicts the individual in each cropped image. When a prediction pool is configured, the crops are split across
+    its worker processes and the results are merged in their original order.
+    """
     logger.info(f'Starting individual prediction for {len(yolov_predictions)} images.')
     start_time = datetime.now()
+    pool = pool or prediction_pool()
+    if pool is None:
+        results = predict_individuals_for_shard(yolov_predictions)
+    else:
+        results = map_sharded(pool, predict_individuals_for_shard, yolov_predictions)
+    logger.info(f'Individual predictions completed after {datetime.now() - start_time}.')
+    return results
+
+
+def predict_individuals_for_shard(yolov_predictions: List[YolovPrediction]) -> List[IndividualPrediction]:
     backbone, device = load_backbone()
     results = []
     for species, yolov_predictions in group_yolov_predictions_by_species(yolov_predictions).items():
@@ -63,22 +78,9 @@ def predict_individuals_from_yolov_predictions(yolov_predictions: List[YolovPred
             species=species,
             file_names=[p.cropped_file_name for p in yolov_predictions]
         )
-    logger.info(f'Individual predictions completed after {datetime.now() - start_time}.')
-
     return results
 
 
-def load_backbone():
-    resnet18 = torchvision.models.resnet18()
-    backbone = torch.nn.Sequential(*list(resnet18.children())[:-1])
-    ckpt = torch.load(BACKBONE_PATH)
-    backbone.load_state_dict(ckpt['resnet18_parameters'])
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    backbone = backbone.to(device)
-    backbone.eval()
-    return backbone, device
-
-
 def group_yolov_predictions_by_species(
         predictions: List[YolovPrediction]
 ) -> Dict[Optional[Species], List[YolovPrediction]]:
@@ -86,6 +88,9 @@ def group_yolov_predictions_by_species(
     for prediction in predictions:
         # If this species is not something we know about or None, this returns a None value.
         species = Species.from_string(prediction.predicted_species or '')
+        # Species that only have training data so far cannot be identified yet.
+        if species is not None and not species.has_classifier():
+            species = None
         if species not in results:
             results[species] = []
         results[species].append(prediction)
@@ -108,12 +113,13 @@ def predict_individuals_from_species(
             for file_name in file_names
         ]
 
-    classifier = joblib.load(species.model_location())
-    with open(species.labels_location()) as f:
-        labels = json.load(f)
+    classifier = load_classifier(species)
+    labels = load_labels(species)
 
-    embeddings = images_to_embeddings(backbone, device, file_names)
-    predicted_labels = classifier.predict(embeddings)
+    with observe_stage('embed', items=len(file_names)):
+        embeddings = images_to_embeddings(backbone, device, file_names)
+    with observe_stage('classify', items=len(file_names)):
+        predicted_labels = classifier.predict(embeddings)
     results = []
     for file_name, label_idx in zip(file_names, predicted_labels):
         results.append(IndividualPrediction(
@@ -125,10 +131,10 @@ def predict_individuals_from_species(
     return results
 
 
-def images_to_embeddings(backbone, device, file_names: List[str]) -> np.ndarray:
+def images_to_embeddings(backbone, device, file_names: List[str], batch_size: int = 1) -> np.ndarray:
     embedding_tensors = []
 
-    data_loader = DataLoader(LocalImageDataset(file_names), batch_size=1, shuffle=False)
+    data_loader = DataLoader(LocalImageDataset(file_names), batch_size=batch_size, shuffle=False)
     with torch.no_grad():
         for batch, _ in data_loader:
             embedding = backbone(batch.to(device)).flatten(start_dim=1)
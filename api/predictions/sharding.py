@@ -0,0 +1,128 @@
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, Executor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, TypeVar, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Server processes started by serve.py. Each has its own prediction pool, so they share the CPUs between them.
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '2'))
+# Number of worker processes that predictions for a collection are split across. 1 runs predictions in-process.
+PREDICTION_PROCESSES = int(os.getenv('PREDICTION_PROCESSES', '1'))
+PREDICTION_PROCESS_THREADS = int(os.getenv(
+    'PREDICTION_PROCESS_THREADS', str(max(1, os.cpu_count() // (SERVER_WORKERS * PREDICTION_PROCESSES)))
+))
+# More shards than processes keeps every process busy when some images have more detections than others.
+SHARDS_PER_PROCESS = 4
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+class PredictionPool(NamedTuple):
+    executor: Executor
+    processes: int
+
+
+__prediction_pool: Optional[PredictionPool] = None
+__prediction_pool_lock = threading.Lock()
+# Shared pools that broke and were replaced, so requests still holding one move to the replacement.
+__retired_executors: weakref.WeakSet = weakref.WeakSet()
+__is_worker = False
+
+
+def create_prediction_pool(
+        processes: int,
+        torch_threads: int,
+        setup: Optional[Callable[[], None]] = None
+) -> PredictionPool:
+    """
+    Starts a pool of worker processes, each with its own models and a fixed number of torch threads.
+    Workers are spawned rather than forked, since forking a process that has already run torch can deadlock.
+    """
+    executor = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_prediction_worker,
+        initargs=(torch_threads, setup)
+    )
+    return PredictionPool(executor=executor, processes=processes)
+
+
+def prediction_pool() -> Optional[PredictionPool]:
+    """
+    Returns the shared prediction pool, or None if predictions should run in the current process.
+    """
+    global __prediction_pool
+    if PREDICTION_PROCESSES <= 1 or __is_worker:
+        return None
+    with __prediction_pool_lock:
+        if __prediction_pool is None:
+            __prediction_pool = create_prediction_pool(PREDICTION_PROCESSES, PREDICTION_PROCESS_THREADS)
+        return __prediction_pool
+
+
+def replace_broken_pool(pool: PredictionPool) -> Optional[PredictionPool]:
+    """
+    Replaces the shared prediction pool after one of its workers died, such as by being killed for running out of
+    memory, which breaks the whole pool. Returns the new shared pool, or None if the broken pool was never shared.
+    """
+    global __prediction_pool
+    with __prediction_pool_lock:
+        if __prediction_pool is not None and __prediction_pool.executor is pool.executor:
+            logger.warning('A prediction worker process died, so the prediction pool is being restarted.')
+            __prediction_pool = None
+            __retired_executors.add(pool.executor)
+            pool.executor.shutdown(wait=False, cancel_futures=True)
+        elif pool.executor not in __retired_executors:
+            return None
+    # Another request may already have replaced it.
+    return prediction_pool()
+
+
+def init_prediction_worker(torch_threads: int, setup: Optional[Callable[[], None]]) -> None:
+    global __is_worker
+    __is_worker = True
+
+    import torch
+    torch.set_num_threads(torch_threads)
+    torch.set_num_interop_threads(1)
+    if setup is not None:
+        setup()
+
+
+def split_into_shards(items: List[T], num_shards: int) -> List[List[T]]:
+    """
+    Splits items into at most num_shards contiguous shards of near equal size, preserving their order.
+    """
+    shard_size = max(1, math.ceil(len(items) / max(1, num_shards)))
+    return [items[idx:idx + shard_size] for idx in range(0, len(items), shard_size)]
+
+
+def map_sharded(pool: PredictionPool, fn: Callable[..., List[R]], items: List[T], *args) -> List[R]:
+    """
+    Calls fn(shard, *args) for each shard of items in the pool, and concatenates the results in shard order, so the
+    output does not depend on which worker finishes first.
+    """
+    try:
+        return __map_sharded(pool, fn, items, *args)
+    except BrokenProcessPool:
+        # Retry once on a fresh pool, since the shards are independent and a dead worker leaves nothing behind.
+        new_pool = replace_broken_pool(pool)
+        if new_pool is None:
+            raise
+        return __map_sharded(new_pool, fn, items, *args)
+
+
+def __map_sharded(pool: PredictionPool, fn: Callable[..., List[R]], items: List[T], *args) -> List[R]:
+    num_shards = pool.processes * SHARDS_PER_PROCESS
+    futures = [pool.executor.submit(fn, shard, *args) for shard in split_into_shards(items, num_shards)]
+    results = []
+    for future in futures:
+        results += future.result()
+    return results
@@ -0,0 +1,103 @@
+"""
+Prediction worker for distributed predictions.
+
+Takes per-image prediction tasks from the Redis stream that the api server publishes to when PREDICTION_QUEUE=redis,
+and saves their results for the server to collect. Tasks that fail are retried, and tasks held by a worker that stopped
+responding are taken over by another. Run any number of workers, on any nodes that share Redis and S3 with the server:
+
+    python -m api.predictions.worker
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+
+from api.data_models.prediction_tasks import PredictionTask, PredictionTaskResult, ensure_consumer_group, \
+    read_prediction_tasks, claim_stale_prediction_tasks, acknowledge_prediction_task, save_prediction_task_result
+from api.metrics import observe_stage
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_WORKER_THREADS = int(os.getenv('PREDICTION_WORKER_THREADS', str(os.cpu_count())))
+# Tasks a worker has not acknowledged for this long are taken over by another worker.
+PREDICTION_TASK_TIMEOUT_SECONDS = float(os.getenv('PREDICTION_TASK_TIMEOUT_SECONDS', '300'))
+# Times a task is attempted, including being taken over from a worker that died, before it is reported as failed.
+PREDICTION_TASK_MAX_ATTEMPTS = int(os.getenv('PREDICTION_TASK_MAX_ATTEMPTS', '3'))
+# How long to wait for new tasks before checking for stale ones again.
+READ_BLOCK_MS = 5000
+
+
+def run_worker(consumer: str, stop: threading.Event) -> None:
+    ensure_consumer_group()
+    logger.info(f'Prediction worker {consumer} started.')
+    while not stop.is_set():
+        for message_id, task, deliveries in claim_stale_prediction_tasks(
+                consumer, int(PREDICTION_TASK_TIMEOUT_SECONDS * 1000), count=1
+        ):
+            logger.warning(f'Took over prediction task for {task["file_name"]}, delivered {deliveries} times.')
+            if task['attempt'] + deliveries > PREDICTION_TASK_MAX_ATTEMPTS:
+                __fail_task(message_id, task, 'Workers stopped responding while predicting this image.')
+            else:
+                process_task(message_id, task)
+        for message_id, task in read_prediction_tasks(consumer, count=1, block_ms=READ_BLOCK_MS):
+            process_task(message_id, task)
+    logger.info(f'Prediction worker {consumer} stopped.')
+
+
+def process_task(message_id: str, task: PredictionTask) -> None:
+    from api.predictions.distributed import predict_task
+
+    try:
+        with observe_stage('prediction_task'):
+            result = predict_task(task)
+    except Exception as e:
+        logger.exception(f'Prediction task for {task["file_name"]} failed on attempt {task["attempt"] + 1}.')
+        if task['attempt'] + 1 < PREDICTION_TASK_MAX_ATTEMPTS:
+            acknowledge_prediction_task(message_id, retry=PredictionTask(**{**task, 'attempt': task['attempt'] + 1}))
+        else:
+            __fail_task(message_id, task, str(e))
+        return
+    # The result is saved before the task is acknowledged, so a worker dying in between only repeats the task.
+    save_prediction_task_result(task['run_id'], result)
+    acknowledge_prediction_task(message_id)
+
+
+def __fail_task(message_id: str, task: PredictionTask, error: str) -> None:
+    save_prediction_task_result(task['run_id'], PredictionTaskResult(
+        file_name=task['file_name'],
+        yolov_predictions=None,
+        individual_predictions=None,
+        error=error
+    ))
+    acknowledge_prediction_task(message_id)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--consumer', default=f'{socket.gethostname()}-{os.getpid()}',
+                        help='Name of this worker in the consumer group.')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s.%(msecs)d %(pathname)s:%(lineno)d [%(levelname)s] %(message)s',
+        datefmt='%Y-%m-%d:%H:%M:%S',
+        level=logging.INFO
+    )
+
+    import torch
+    from api.predictions.models import preload_models
+
+    torch.set_num_threads(PREDICTION_WORKER_THREADS)
+    preload_models()
+
+    stop = threading.Event()
+    # Finish the current task before exiting, rather than leaving it for another worker to take over.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    run_worker(args.consumer, stop)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import contextlib
+import cProfile
+import glob
+import io
+import logging
+import os
+import pstats
+import time
+from typing import Iterator, List, Optional, TypedDict
+
+from api.clients.s3_client import s3_bucket
+from api.data_models.prediction_inputs import OUTPUTS_PATH
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUMMARY_LINES = 50
+
+
+class Profile(TypedDict):
+    name: str
+    files: List[str]
+
+
+def profiles_location(collection_id: str) -> str:
+    return f'{OUTPUTS_PATH}/{collection_id}/profiles'
+
+
+@contextlib.contextmanager
+def profile_run(collection_id: str, kind: str, enabled: bool, offloaded: Optional[str] = None) -> Iterator[None]:
+    """
+    Captures a Python profile and a torch.profiler trace of the `with` block when enabled, and stores them under the
+    collection. When disabled this does nothing, so unflagged runs see no overhead.
+
+    Only the calling thread is profiled by cProfile, so DataLoader worker processes are not included. When the caller
+    hands work to other processes, `offloaded` says where, and is saved as offloaded.txt next to the profile, since
+    that work only shows up as time spent waiting for it.
+    """
+    if not enabled:
+        yield
+        return
+
+    from torch.profiler import profile, ProfilerActivity
+
+    dest = f'{profiles_location(collection_id)}/{int(time.time())}_{kind}'
+    os.makedirs(dest, exist_ok=True)
+    logger.info(f'Profiling {kind} for collection {collection_id} to {dest}.')
+    if offloaded is not None:
+        logger.warning(f'Profile {dest} does not include work done elsewhere: {offloaded}')
+        with open(f'{dest}/offloaded.txt', 'w') as f:
+            f.write(offloaded + '\n')
+
+    python_profiler = cProfile.Profile()
+    with profile(activities=[ProfilerActivity.CPU]) as torch_profiler:
+        python_profiler.enable()
+        try:
+            yield
+        finally:
+            python_profiler.disable()
+
+    python_profiler.dump_stats(f'{dest}/python.prof')
+    summary = io.StringIO()
+    pstats.Stats(python_profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+    with open(f'{dest}/python.txt', 'w') as f:
+        f.write(summary.getvalue())
+    with open(f'{dest}/torch.txt', 'w') as f:
+        f.write(torch_profiler.key_averages().table(sort_by='cpu_time_total', row_limit=PROFILE_SUMMARY_LINES))
+    torch_profiler.export_chrome_trace(f'{dest}/torch_trace.json')
+
+    if s3_bucket is not None:
+        for file_name in glob.glob(f'{dest}/*'):
+            s3_bucket.upload_file(file_name, file_name)
+
+
+def list_profiles_for_collection(collection_id: str) -> List[Profile]:
+    if s3_bucket is not None:
+        file_names = [o.key for o in s3_bucket.objects.filter(Prefix=f'{profiles_location(collection_id)}/')]
+    else:
+        file_names = glob.glob(f'{profiles_location(collection_id)}/*/*')
+
+    profiles = {}
+    for file_name in sorted(file_names):
+        name = os.path.basename(os.path.dirname(file_name))
+        if name not in profiles:
+            profiles[name] = Profile(name=name, files=[])
+        profiles[name]['files'].append(file_name)
+    return list(profiles.values())
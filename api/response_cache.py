@@ -0,0 +1,67 @@
+"""
+Conditional requests and an in-process cache for read-mostly endpoints.
+
+Every response is tagged with an ETag derived from the versions of the resources it was built from, which are bumped
+by each write. A request whose If-None-Match matches gets a 304 without the response being built, and otherwise the
+last response built for the same URL is reused while its versions are unchanged.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Tuple, Any, Optional
+
+import flask
+
+from api.metrics import RESPONSE_CACHE_EVENTS
+
+# Bytes of response bodies kept in memory by each worker. The least recently used are evicted first.
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+# The most recent response body for each URL, along with its ETag.
+__responses: OrderedDict[str, Tuple[str, bytes]] = OrderedDict()
+__responses_lock = threading.Lock()
+
+
+def cached_json_response(versions: List[str], build: Callable[[], Any]) -> flask.Response:
+    """
+    Returns the JSON of what build returns, only calling it if neither the client nor the cache has the response for
+    the current versions.
+    """
+    request = flask.request
+    etag = hashlib.sha1('\n'.join([request.full_path] + versions).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        RESPONSE_CACHE_EVENTS.labels('not_modified').inc()
+        response = flask.Response(status=304)
+    else:
+        body = __read_cached(request.full_path, etag)
+        if body is None:
+            RESPONSE_CACHE_EVENTS.labels('miss').inc()
+            body = flask.json.dumps(build()).encode()
+            __write_cached(request.full_path, etag, body)
+        else:
+            RESPONSE_CACHE_EVENTS.labels('hit').inc()
+        response = flask.Response(body, content_type='application/json')
+    response.set_etag(etag)
+    # Browsers may keep the response, but must check that it is still current before using it.
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def __read_cached(url: str, etag: str) -> Optional[bytes]:
+    with __responses_lock:
+        cached = __responses.get(url)
+        if cached is None or cached[0] != etag:
+            return None
+        __responses.move_to_end(url)
+        return cached[1]
+
+
+def __write_cached(url: str, etag: str, body: bytes) -> None:
+    if len(body) > RESPONSE_CACHE_BYTES:
+        return
+    with __responses_lock:
+        __responses.pop(url, None)
+        __responses[url] = (etag, body)
+        while sum(len(r[1]) for r in __responses.values()) > RESPONSE_CACHE_BYTES:
+            __responses.popitem(last=False)
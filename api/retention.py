@@ -0,0 +1,258 @@
+"""
+Garbage collection of collection data.
+
+Outputs that no annotation references, such as crops left behind when predictions are re-run, are deleted, along with
+derivatives of deleted files and data that is older than the collection's retention policy allows. Run it for every
+collection from cron with:
+
+    python -m api.retention [--dry-run]
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from typing import TypedDict, List, Optional, Dict, Set
+
+from api.clients.redis_client import redis_client
+from api.data_models.annotations import read_annotations_for_collection, delete_annotations_for_collection, \
+    REDIS_KEY as ANNOTATIONS_REDIS_KEY
+from api.data_models.bursts import remove_frames_from_bursts, REDIS_KEY as BURSTS_REDIS_KEY
+from api.data_models.clips import remove_frames_from_clips, REDIS_KEY as CLIPS_REDIS_KEY
+from api.data_models.collections import read_collections_from_redis
+from api.data_models.derivatives import DERIVATIVES_PATH, DERIVATIVE_SIZES, WEBSITE_DATA_PATH
+from api.data_models.prediction_inputs import INPUTS_PATH, OUTPUTS_PATH
+from api.data_models.prediction_runs import REDIS_KEY as PREDICTION_RUNS_REDIS_KEY
+from api.data_models.retention_policies import RetentionPolicy, read_retention_policy
+from api.data_models.retrain_event_log import LOGS_REDIS_KEY
+from api.data_models.retrain_metrics import METRICS_REDIS_KEY
+from api.data_models.retrain_status import read_job_status_from_redis, delete_job_status_from_redis
+from api.data_models.versions import bump_version, images_resource
+from api.leases import acquire_lease, keep_lease, read_lease_token, REDIS_KEY as LEASES_REDIS_KEY
+from api.metrics import observe_stage
+from api.storage import StoredFile, list_stored_files, delete_stored_files
+
+logger = logging.getLogger(__name__)
+
+# Files written more recently than this are never collected, such as derivatives generated while collecting. Prediction
+# runs are protected by their lease instead, since they can take much longer.
+GC_GRACE_SECONDS = float(os.getenv('GC_GRACE_SECONDS', '3600'))
+FINISHED_JOB_STATUSES = ['completed', 'aborted']
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class GcReport(TypedDict):
+    collection_id: str
+    dry_run: bool
+    policy: RetentionPolicy
+    expired_inputs: int
+    orphaned_outputs: int
+    expired_profiles: int
+    orphaned_derivatives: int
+    deleted_annotations: int
+    deleted_retrain_job: bool
+    deleted_redis_keys: List[str]
+    deleted_files: int
+    reclaimed_bytes: int
+    # Whether the collection was skipped because predictions were running for it.
+    skipped: bool
+
+
+def collect_garbage(collection_id: str, dry_run: bool = False, now: Optional[float] = None) -> GcReport:
+    """
+    Deletes a collection's unreferenced and expired files and Redis state, and reports what was, or with dry_run
+    would have been, deleted. Collections with predictions running are skipped, since a run clears the annotations
+    before writing new outputs. Collecting holds the predictions lease, so that no run starts meanwhile.
+    """
+    if __predictions_running(collection_id):
+        return __skipped_report(collection_id, dry_run)
+    if dry_run:
+        return __collect_garbage(collection_id, dry_run, now)
+    lease = acquire_lease(f'predictions:{collection_id}')
+    if lease is None:
+        return __skipped_report(collection_id, dry_run)
+    with keep_lease(lease):
+        return __collect_garbage(collection_id, dry_run, now)
+
+
+def __collect_garbage(collection_id: str, dry_run: bool, now: Optional[float]) -> GcReport:
+    now = now or time.time()
+    policy = read_retention_policy(collection_id)
+    grace_cutoff = now - GC_GRACE_SECONDS
+
+    with observe_stage('retention_list'):
+        inputs = list_stored_files(f'{INPUTS_PATH}/{collection_id}/')
+        outputs = list_stored_files(f'{OUTPUTS_PATH}/{collection_id}/')
+        derivatives = {}
+        for variant in DERIVATIVE_SIZES:
+            for prefix in [INPUTS_PATH, OUTPUTS_PATH]:
+                name = f'{prefix}/{collection_id}/'.removeprefix(f'{WEBSITE_DATA_PATH}/')
+                derivatives.update(list_stored_files(f'{DERIVATIVES_PATH}/{variant}/{name}'))
+
+    expired_inputs = __older_than(inputs.values(), policy['inputs_max_age_days'], now)
+    expired_input_keys = {f.key for f in expired_inputs}
+
+    annotations = read_annotations_for_collection(collection_id)
+    expired_annotations = [a for a in annotations if a['file_name'] in expired_input_keys]
+    referenced: Set[str] = set()
+    for annotation in annotations:
+        if annotation['file_name'] not in expired_input_keys:
+            referenced.update([annotation['cropped_file_name'], annotation['annotated_file_name']])
+
+    profiles_prefix = f'{OUTPUTS_PATH}/{collection_id}/profiles/'
+    orphaned_outputs = [
+        f for f in outputs.values()
+        if not f.key.startswith(profiles_prefix) and f.key not in referenced and f.modified < grace_cutoff
+    ]
+    expired_profiles = __older_than(
+        [f for f in outputs.values() if f.key.startswith(profiles_prefix)], policy['profiles_max_age_days'], now
+    )
+
+    deleted_keys = {f.key for f in expired_inputs + orphaned_outputs + expired_profiles}
+    remaining_keys = (inputs.keys() | outputs.keys()) - deleted_keys
+    orphaned_derivatives = [
+        f for f in derivatives.values()
+        if __derivative_source(f.key) not in remaining_keys and f.modified < grace_cutoff
+    ]
+
+    retrain_job_expired = __retrain_job_expired(collection_id, policy['retrain_logs_max_age_days'], now)
+    redis_keys = []
+    if retrain_job_expired:
+        keys = [f'{LOGS_REDIS_KEY}:{collection_id}', f'{METRICS_REDIS_KEY}:{collection_id}']
+        redis_keys = [k for k in keys if redis_client.exists(k)]
+    files = expired_inputs + orphaned_outputs + expired_profiles + orphaned_derivatives
+    report = GcReport(
+        collection_id=collection_id,
+        dry_run=dry_run,
+        policy=policy,
+        expired_inputs=len(expired_inputs),
+        orphaned_outputs=len(orphaned_outputs),
+        expired_profiles=len(expired_profiles),
+        orphaned_derivatives=len(orphaned_derivatives),
+        deleted_annotations=len(expired_annotations),
+        deleted_retrain_job=retrain_job_expired,
+        deleted_redis_keys=redis_keys,
+        deleted_files=len(files),
+        reclaimed_bytes=sum(f.size for f in files),
+        skipped=False,
+    )
+    if dry_run:
+        return report
+
+    with observe_stage('retention_delete', items=len(files)):
+        delete_stored_files(files)
+    if len(expired_inputs) > 0:
+        bump_version(images_resource(collection_id))
+    delete_annotations_for_collection(collection_id, [a['id'] for a in expired_annotations])
+    remove_frames_from_bursts(collection_id, expired_input_keys)
+    remove_frames_from_clips(collection_id, expired_input_keys)
+    if len(redis_keys) > 0:
+        redis_client.delete(*redis_keys)
+    if retrain_job_expired:
+        delete_job_status_from_redis(collection_id)
+
+    logger.info(f'Collected {len(files)} files and {report["reclaimed_bytes"]} bytes for collection {collection_id}.')
+    return report
+
+
+def __predictions_running(collection_id: str) -> bool:
+    """
+    Returns whether another process, such as a prediction run, holds the predictions lease. A run still recorded as
+    running without holding the lease died without finishing, so it does not block collection.
+    """
+    token = read_lease_token(f'predictions:{collection_id}')
+    return token is not None
+
+
+def __skipped_report(collection_id: str, dry_run: bool) -> GcReport:
+    logger.info(f'Skipped garbage collection for collection {collection_id} while predictions are running.')
+    return GcReport(
+        collection_id=collection_id,
+        dry_run=dry_run,
+        policy=read_retention_policy(collection_id),
+        expired_inputs=0,
+        orphaned_outputs=0,
+        expired_profiles=0,
+        orphaned_derivatives=0,
+        deleted_annotations=0,
+        deleted_retrain_job=False,
+        deleted_redis_keys=[],
+        deleted_files=0,
+        reclaimed_bytes=0,
+        skipped=True,
+    )
+
+
+def collect_orphaned_redis_keys(dry_run: bool = False) -> List[str]:
+    """
+    Deletes the Redis state of collections that no longer exist.
+    """
+    collection_ids = {c['id'] for c in read_collections_from_redis()}
+    patterns = [
+        f'{ANNOTATIONS_REDIS_KEY}:collections:*',
+        f'{BURSTS_REDIS_KEY}:*:*',
+        f'{CLIPS_REDIS_KEY}:collections:*',
+        f'{LEASES_REDIS_KEY}:fences:annotations:*',
+        f'{LEASES_REDIS_KEY}:tokens:predictions:*',
+        f'{LOGS_REDIS_KEY}:*',
+        f'{METRICS_REDIS_KEY}:*',
+    ]
+    orphaned = []
+    for pattern in patterns:
+        for key in redis_client.scan_iter(match=pattern):
+            if key.rsplit(':', 1)[-1] not in collection_ids:
+                orphaned.append(key)
+    # Prediction runs are kept in one hash, keyed by collection.
+    orphaned_runs = [c for c in redis_client.hkeys(PREDICTION_RUNS_REDIS_KEY) if c not in collection_ids]
+    if not dry_run and len(orphaned) > 0:
+        redis_client.delete(*orphaned)
+    if not dry_run and len(orphaned_runs) > 0:
+        redis_client.hdel(PREDICTION_RUNS_REDIS_KEY, *orphaned_runs)
+    return orphaned + [f'{PREDICTION_RUNS_REDIS_KEY}:{c}' for c in orphaned_runs]
+
+
+def collect_all_garbage(dry_run: bool = False) -> Dict:
+    reports = [collect_garbage(c['id'], dry_run) for c in read_collections_from_redis()]
+    return {
+        'dry_run': dry_run,
+        'collections': reports,
+        'orphaned_redis_keys': collect_orphaned_redis_keys(dry_run),
+        'deleted_files': sum(r['deleted_files'] for r in reports),
+        'reclaimed_bytes': sum(r['reclaimed_bytes'] for r in reports),
+    }
+
+
+def __older_than(files, max_age_days: Optional[float], now: float) -> List[StoredFile]:
+    if max_age_days is None:
+        return []
+    cutoff = now - max_age_days * SECONDS_PER_DAY
+    return [f for f in files if f.modified < cutoff]
+
+
+def __derivative_source(key: str) -> str:
+    # website-data/derivatives/<variant>/<name> is derived from website-data/<name>.
+    name = key.removeprefix(f'{DERIVATIVES_PATH}/').split('/', 1)[-1]
+    return f'{WEBSITE_DATA_PATH}/{name}'
+
+
+def __retrain_job_expired(collection_id: str, max_age_days: Optional[float], now: float) -> bool:
+    job = read_job_status_from_redis(collection_id)
+    if max_age_days is None or job['status'] not in FINISHED_JOB_STATUSES:
+        return False
+    return float(job['created_at']) < now - max_age_days * SECONDS_PER_DAY
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted without deleting it.')
+    parser.add_argument('--collection', default=None, help='Only collect garbage for this collection.')
+    args = parser.parse_args()
+
+    if args.collection is not None:
+        print(json.dumps(collect_garbage(args.collection, args.dry_run), indent=2))
+    else:
+        print(json.dumps(collect_all_garbage(args.dry_run), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,12 @@
-import glob
-from typing import List, NamedTuple, Tuple
+from typing import List, Tuple
 
-import PIL
-import PIL.Image
 import torch
 from torch.utils.data import Dataset
 from torchvision import transforms
 
 from api.data_models.annotations import Annotation
 from api.data_models.species import Species
-
-
-class TrainInput(NamedTuple):
-    file_name: str
-    name: str
+from api.training_shards import TrainingSample, list_training_samples, read_training_image
 
 
 class ClassifierTrainDataset(Dataset):
@@ -24,16 +17,10 @@ class ClassifierTrainDataset(Dataset):
     ])
 
     def __init__(self, species: Species, new_annotations: List[Annotation]):
-        self.inputs = []
-
-        for file_name in glob.glob(f'{species.training_data_location()}/*/*.jpg'):
-            self.inputs.append(TrainInput(
-                file_name=file_name,
-                name=file_name.split('/')[-2]
-            ))
+        self.inputs = list_training_samples(species)
 
         for annotation in new_annotations:
-            self.inputs.append(TrainInput(
+            self.inputs.append(TrainingSample(
                 file_name=annotation['cropped_file_name'],
                 name=annotation['predicted_name']
             ))
@@ -45,6 +32,6 @@ class ClassifierTrainDataset(Dataset):
         return len(self.inputs)
 
     def __getitem__(self, idx) -> Tuple[torch.Tensor, int]:
-        image = PIL.Image.open(self.inputs[idx].file_name).convert('RGB')
+        image = read_training_image(self.inputs[idx], (224, 224))
         image = self.transform(image)
         return image, self.labels.index(self.inputs[idx].name)
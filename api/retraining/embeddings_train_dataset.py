@@ -1,17 +1,12 @@
-import glob
 import random
-from typing import NamedTuple, List
+from typing import List
 
-from PIL import Image
 from torch.utils.data import Dataset
 from torchvision.transforms import transforms
 
 from api.data_models.annotations import Annotation
-
-
-class TrainInput(NamedTuple):
-    file_name: str
-    name: str
+from api.data_models.species import list_species
+from api.training_shards import TrainingSample, list_training_samples, read_training_image
 
 
 class EmbeddingsTrainDataset(Dataset):
@@ -20,15 +15,12 @@ class EmbeddingsTrainDataset(Dataset):
     def __init__(self, new_annotations: List[Annotation], num2sample: int):
         self.inputs = []
 
-        for file_name in glob.glob(f'training_data/cropped/*/*/*.jpg'):
-            self.inputs.append(TrainInput(
-                file_name=file_name,
-                name=file_name.split('/')[-2]
-            ))
+        for species in list_species():
+            self.inputs += list_training_samples(species)
         self.inputs = random.sample(self.inputs, num2sample)
 
         for annotation in new_annotations:
-            self.inputs.append(TrainInput(
+            self.inputs.append(TrainingSample(
                 file_name=annotation['cropped_file_name'],
                 name=annotation['predicted_name']
             ))
@@ -42,6 +34,6 @@ class EmbeddingsTrainDataset(Dataset):
     def __getitem__(self, idx):
         label = self.labels.index(self.inputs[idx].name)
         file_name = self.inputs[idx].file_name
-        image = Image.open(file_name)
+        image = read_training_image(self.inputs[idx], (224, 224))
         image = self.transform(image)
         return image, label, file_name
@@ -1,4 +1,10 @@
-from typing import List, Tuple
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, Executor
+from typing import List, Tuple, Optional
 
 import joblib
 import numpy as np
@@ -12,9 +18,26 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.preprocessing import normalize
 from torch.utils.data import DataLoader
 
-from api.clients.s3_client import s3_bucket
 from api.data_models.annotations import Annotation
-from api.data_models.species import Species
+from api.data_models.retrain_event_log import log_event, RetrainEventLog
+from api.data_models.retrain_status import read_job_status_from_redis
+from api.data_models.species import Species, list_species
+from api.data_models.versions import bump_version, labels_resource
+from api.leases import Lease, acquire_lease, wait_for_lease, keep_lease, check_fencing_token
+from api.metrics import observe_stage
+from api.predictions.models import load_backbone
+from api.retraining.classifier_train_dataset import ClassifierTrainDataset
+
+logger = logging.getLogger(__name__)
+
+# Number of species classifiers retrained at once, each in its own process. 1 retrains them one after another.
+RETRAIN_CLASSIFIER_PROCESSES = int(os.getenv(
+    'RETRAIN_CLASSIFIER_PROCESSES', str(max(1, min(len(list_species()), os.cpu_count())))
+))
+# CPU threads each species' retraining may use, for both embedding its images and the grid search. By default the CPUs
+# are divided between the processes actually started.
+RETRAIN_CLASSIFIER_THREADS = int(os.getenv('RETRAIN_CLASSIFIER_THREADS', '0')) or None
+CLASSIFIER_EMBEDDING_BATCH_SIZE = 32
 
 
 def generate_embeddings(backbone, data_loader: DataLoader) -> Tuple[np.ndarray, np.ndarray]:
@@ -42,7 +65,12 @@ def generate_embeddings(backbone, data_loader: DataLoader) -> Tuple[np.ndarray,
     return embeddings, labels
 
 
-def retrain_classifier_for_species(species: Species, train_embeddings: np.ndarray, train_labels: np.ndarray) -> None:
+def retrain_classifier_for_species(
+        species: Species,
+        train_embeddings: np.ndarray,
+        train_labels: np.ndarray,
+        lease: Optional[Lease] = None
+) -> None:
     # Use K-fold cross validation to train the classifier since some classes will only have 1 example
     cv = KFold(n_splits=5, random_state=1, shuffle=True)
 
@@ -73,17 +101,104 @@ def retrain_classifier_for_species(species: Species, train_embeddings: np.ndarra
     knn_grid_search.fit(train_embeddings, train_labels)
 
     # Save the best fit model to the model folder
+    if lease is not None:
+        check_fencing_token(lease.name, lease)
     joblib.dump(knn_grid_search.best_estimator_, species.model_location())
 
 
-def upload_annotations_to_training(annotations: List[Annotation]) -> None:
-    for annotation in annotations:
-        if annotation['accepted'] is False:
-            continue
+def classifier_threads(processes: int) -> int:
+    """
+    Returns the CPU threads each of the given number of classifier retraining processes may use.
+    """
+    return RETRAIN_CLASSIFIER_THREADS or max(1, os.cpu_count() // processes)
+
+
+def create_classifier_pool(processes: int) -> Executor:
+    """
+    Starts a pool of processes for retraining species classifiers, each limited to its share of the CPU threads.
+    """
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_classifier_worker,
+        initargs=(classifier_threads(processes),)
+    )
+
+
+def init_classifier_worker(threads: int) -> None:
+    from threadpoolctl import threadpool_limits
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    # Limits the BLAS and OpenMP pools used by numpy and scikit-learn for the rest of the process.
+    threadpool_limits(limits=threads)
+
+
+def retrain_classifier_job(collection_id: str, species: Species, annotations: List[Annotation]) -> None:
+    """
+    Retrains the classifier for one species on its existing training data and its new annotations, and saves the
+    model and its labels. Safe to run in a separate process, since progress is reported through the event log.
+    """
+    if __is_aborted(collection_id):
+        return
+
+    __log_event(collection_id, f'Loading training data for the {species} classifier.')
+    train_dataset = ClassifierTrainDataset(species, annotations)
+    train_dataloader = DataLoader(
+        train_dataset,
+        batch_size=CLASSIFIER_EMBEDDING_BATCH_SIZE,
+        shuffle=False,
+        num_workers=0,
+        drop_last=False
+    )
+    backbone, device = load_backbone()
+    start_time = time.perf_counter()
+    with observe_stage('retrain_classifier_embed', items=len(train_dataset)):
+        train_embeddings, train_labels = generate_embeddings(backbone, train_dataloader)
+    __log_event(
+        collection_id,
+        f'Loaded {len(train_embeddings)} embeddings for {species} after {int(time.perf_counter() - start_time)}s.'
+    )
+
+    if __is_aborted(collection_id):
+        return
+
+    # Retraining for other collections may be writing the same species' model.
+    lease_name = f'models:{species}'
+    lease = acquire_lease(lease_name)
+    if lease is None:
+        __log_event(collection_id, f'Waiting for another retraining of the {species} classifier to finish.')
+        lease = wait_for_lease(lease_name)
+    with keep_lease(lease):
+        __log_event(collection_id, f'Started retraining for the {species} classifier.')
+        start_time = time.perf_counter()
+        with observe_stage('retrain_classifier_fit', items=len(train_embeddings)):
+            retrain_classifier_for_species(
+                species=species,
+                train_embeddings=train_embeddings,
+                train_labels=train_labels,
+                lease=lease
+            )
+
+        if __is_aborted(collection_id):
+            return
+
+        check_fencing_token(lease_name, lease)
+        with open(species.labels_location(), 'w') as f:
+            json.dump(train_dataset.labels, f)
+    bump_version(labels_resource(str(species)))
+
+    __log_event(
+        collection_id,
+        f'Completed retraining for the {species} classifier after {int(time.perf_counter() - start_time)}s.'
+    )
+    logger.info(f'Model saved as {species.model_location()}')
+
+
+def __log_event(collection_id: str, message: str) -> None:
+    logger.info(message)
+    log_event(RetrainEventLog(collection_id=collection_id, created_at=time.time(), message=message))
 
-        species = Species.from_string(annotation['predicted_species'])
-        if species is None:
-            continue
 
-        upload_path = f"{species.training_data_location()}/{annotation['predicted_name']}/{annotation['id']}.jpg"
-        s3_bucket.upload_file(annotation['cropped_file_name'], upload_path)
+def __is_aborted(collection_id: str) -> bool:
+    return read_job_status_from_redis(collection_id)['status'] == 'aborted'
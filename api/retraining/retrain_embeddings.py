@@ -1,6 +1,8 @@
 import multiprocessing
 import os
-from typing import Callable
+import random
+import time
+from typing import Callable, Optional, Tuple
 
 import lightly
 import pytorch_lightning as pl
@@ -11,30 +13,50 @@ from lightly.loss import NTXentLoss
 from lightly.models.modules.heads import SimCLRProjectionHead
 from pytorch_lightning import Trainer, Callback
 from pytorch_lightning.callbacks import EarlyStopping
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset
 
+from api.leases import Lease, check_fencing_token
 from api.retraining.embeddings_train_dataset import EmbeddingsTrainDataset
 from api.retraining.retrain_embeddings_logger import RetrainEmbeddingsLogger
 
 TRAINING_BATCH_SIZE = 320
 TRAINING_WORKERS = multiprocessing.cpu_count()
 TRAINING_MAX_EPOCHS = 100
+# Retraining with fewer accepted annotations than this only fine-tunes the last backbone block and the projection head,
+# which takes minutes rather than hours on a CPU. 0 always fine-tunes the whole backbone.
+PARTIAL_FINE_TUNING_MAX_ANNOTATIONS = int(os.getenv('PARTIAL_FINE_TUNING_MAX_ANNOTATIONS', '50'))
+PARTIAL_TRAINING_BATCH_SIZE = 64
+# Augmented view pairs of each image whose frozen activations are computed once and sampled from in every epoch.
+PARTIAL_CACHED_VIEW_PAIRS = 4
+# Leading modules of the backbone, the stem and the first three residual stages, that partial fine-tuning freezes.
+FROZEN_BACKBONE_MODULES = 7
+# `full` fine-tunes the whole backbone, `partial` only its last block.
+TRAINING_MODES = ['full', 'partial']
 
 BACKBONE_MODEL_PATH = 'models/simclrresnet18embed.pth'
 PROJECTION_HEAD_MODEL_PATH = 'models/simclr_projectionhead.pth'
 
 
-def embedding_num_sample(len_new_images: int):
+def embedding_num_sample(len_new_images: int, batch_size: int = TRAINING_BATCH_SIZE):
     """
     Parameters:
     uploaded_images: a local file path of uploaded images
+    batch_size: the training batch size, which the total number of images is rounded up to
     Returns: the number of prior training images to sample from S3
     """
-    total_images = ((int(len_new_images * 3) // TRAINING_BATCH_SIZE) + 1) * TRAINING_BATCH_SIZE
+    total_images = ((int(len_new_images * 3) // batch_size) + 1) * batch_size
     len_old_images = total_images - len_new_images
     return len_old_images
 
 
+def embedding_training_mode(len_new_images: int) -> str:
+    return 'partial' if len_new_images < PARTIAL_FINE_TUNING_MAX_ANNOTATIONS else 'full'
+
+
+def embedding_batch_size(mode: str) -> int:
+    return PARTIAL_TRAINING_BATCH_SIZE if mode == 'partial' else TRAINING_BATCH_SIZE
+
+
 class SimCLRModel(pl.LightningModule):
     """A version of the SimCLR model for embedding re-training"""
 
@@ -73,6 +95,35 @@ class SimCLRModel(pl.LightningModule):
         return [optim], [scheduler]
 
 
+class TimeBudgetCallback(Callback):
+    """
+    Stops training in time to finish by a deadline. After every epoch, the mean epoch time so far projects how many
+    epochs fit before the deadline, and the cosine learning rate schedule is stretched or shrunk to end with them.
+    """
+
+    def __init__(self, deadline: float, on_epoch_end: Optional[Callable[[int, float, int], None]] = None):
+        super().__init__()
+        self.deadline = deadline
+        self.on_epoch_end = on_epoch_end
+        self.__start_time = time.time()
+
+    def on_train_start(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        self.__start_time = time.time()
+
+    def on_train_epoch_end(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        completed_epochs = trainer.current_epoch + 1
+        seconds_per_epoch = (time.time() - self.__start_time) / completed_epochs
+        remaining_epochs = int(max(0.0, self.deadline - time.time()) // seconds_per_epoch)
+        planned_epochs = min(trainer.max_epochs, completed_epochs + remaining_epochs)
+        for config in trainer.lr_scheduler_configs:
+            if isinstance(config.scheduler, torch.optim.lr_scheduler.CosineAnnealingLR):
+                config.scheduler.T_max = planned_epochs
+        if completed_epochs >= planned_epochs:
+            trainer.should_stop = True
+        if self.on_epoch_end is not None:
+            self.on_epoch_end(completed_epochs, seconds_per_epoch, planned_epochs)
+
+
 class ShouldAbortCallback(Callback):
     def __init__(self, should_abort: Callable[[], bool]):
         super().__init__()
@@ -87,51 +138,109 @@ class ShouldAbortCallback(Callback):
             trainer.should_stop = True
 
 
-def retrain_embeddings(
-        should_abort: Callable[[], bool],
-        train_dataset: EmbeddingsTrainDataset,
-        logger: RetrainEmbeddingsLogger
-):
-    # Use the lightly SimCLR collate function to create the augmented transforms
-    collate_fn = lightly.data.SimCLRCollateFunction(input_size=224)
+class CachedActivationsDataset(Dataset):
+    """
+    Activations of the frozen backbone layers for PARTIAL_CACHED_VIEW_PAIRS augmented view pairs of each image. Each
+    item is a randomly chosen pair of one image, in the same format as the SimCLR collate function's batches.
+    """
+
+    def __init__(self, views0: torch.Tensor, views1: torch.Tensor, num_images: int):
+        self.views0 = views0
+        self.views1 = views1
+        self.num_images = num_images
 
-    # Create the dataloaders to train the embeddings and the classifier
-    train_dataloader = DataLoader(
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, idx):
+        pair = random.randrange(len(self.views0) // self.num_images) * self.num_images + idx
+        return (self.views0[pair].float(), self.views1[pair].float()), 0, idx
+
+
+def cache_frozen_activations(frozen: nn.Module, train_dataset: EmbeddingsTrainDataset) -> CachedActivationsDataset:
+    """
+    Runs PARTIAL_CACHED_VIEW_PAIRS augmentations of every image through the frozen layers once, so that training epochs
+    only run the layers that are fine-tuned.
+    """
+    data_loader = DataLoader(
         train_dataset,
-        batch_size=TRAINING_BATCH_SIZE,
-        shuffle=True,
-        collate_fn=collate_fn,
-        drop_last=True,
+        batch_size=PARTIAL_TRAINING_BATCH_SIZE,
+        shuffle=False,
+        collate_fn=lightly.data.SimCLRCollateFunction(input_size=224),
         num_workers=TRAINING_WORKERS
     )
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    frozen = frozen.to(device).eval()
+    views0, views1 = [], []
+    with torch.no_grad():
+        for _ in range(PARTIAL_CACHED_VIEW_PAIRS):
+            for (x0, x1), _, _ in data_loader:
+                # Half precision halves the memory of the cache, and the fine-tuned layers still train in full.
+                views0.append(frozen(x0.to(device)).half().cpu())
+                views1.append(frozen(x1.to(device)).half().cpu())
+    return CachedActivationsDataset(torch.cat(views0), torch.cat(views1), len(train_dataset))
 
-    # Load the saved state dict objections for the backbone and the projection head
-    resnet18 = torchvision.models.resnet18()
-    backbone = nn.Sequential(*list(resnet18.children())[:-1])
-    ckpt = torch.load(BACKBONE_MODEL_PATH)
-    backbone.load_state_dict(ckpt['resnet18_parameters'])
 
-    project_head = SimCLRProjectionHead(512, 512, 128)
-    projection_ckpt = torch.load(PROJECTION_HEAD_MODEL_PATH)
-    project_head.load_state_dict(projection_ckpt['projection_parameters'])
+def retrain_embeddings(
+        should_abort: Callable[[], bool],
+        train_dataset: EmbeddingsTrainDataset,
+        logger: RetrainEmbeddingsLogger,
+        lease: Optional[Lease] = None,
+        mode: str = 'full',
+        deadline: Optional[float] = None,
+        on_epoch_end: Optional[Callable[[int, float, int], None]] = None
+):
+    """
+    Fine-tunes the backbone and projection head and saves them. With a deadline, training stops once no further epoch
+    fits before it, and on_epoch_end is called with the completed and planned epochs after each one.
+    """
+    if mode not in TRAINING_MODES:
+        raise ValueError(f'Unknown training mode {mode}, expected one of {TRAINING_MODES}.')
+    backbone, project_head = load_simclr_modules()
+
+    if mode == 'partial':
+        # The frozen stages keep their weights and batch norm statistics. The fine-tuned block is shared with the
+        # backbone, so the backbone saved below includes its new weights.
+        activations = cache_frozen_activations(backbone[:FROZEN_BACKBONE_MODULES], train_dataset)
+        train_dataloader = DataLoader(
+            activations, batch_size=PARTIAL_TRAINING_BATCH_SIZE, shuffle=True, drop_last=True, num_workers=0
+        )
+        simclr_model = SimCLRModel(backbone[FROZEN_BACKBONE_MODULES:], project_head)
+    else:
+        # Use the lightly SimCLR collate function to create the augmented transforms
+        collate_fn = lightly.data.SimCLRCollateFunction(input_size=224)
 
-    # Create an instance of the SimCLR model with the pretrained backbone and head
-    simclr_model = SimCLRModel(backbone, project_head)
+        # Create the dataloaders to train the embeddings and the classifier
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_size=TRAINING_BATCH_SIZE,
+            shuffle=True,
+            collate_fn=collate_fn,
+            drop_last=True,
+            num_workers=TRAINING_WORKERS
+        )
+
+        # Create an instance of the SimCLR model with the pretrained backbone and head
+        simclr_model = SimCLRModel(backbone, project_head)
 
     # Define the pytorch trainer and allow for early stopping
     early_stopping_callback = EarlyStopping(monitor='train_loss', patience=3, verbose=True, mode='min')
     should_abort_callback = ShouldAbortCallback(should_abort)
+    callbacks = [early_stopping_callback, should_abort_callback]
+    if deadline is not None:
+        callbacks.append(TimeBudgetCallback(deadline, on_epoch_end))
     os.makedirs('embedding_train_logs', exist_ok=True)
     Trainer(
         max_epochs=TRAINING_MAX_EPOCHS,
         gpus=1 if torch.cuda.is_available() else 0,
-        callbacks=[early_stopping_callback, should_abort_callback],
+        callbacks=callbacks,
         logger=logger
     ).fit(simclr_model, train_dataloader)
 
     # Save the retrained model backbone and projection head
-    pretrained_backbone = simclr_model.backbone
-    backbone_state_dict = {'resnet18_parameters': pretrained_backbone.state_dict()}
+    if lease is not None:
+        check_fencing_token(lease.name, lease)
+    backbone_state_dict = {'resnet18_parameters': backbone.state_dict()}
     torch.save(backbone_state_dict, BACKBONE_MODEL_PATH)
 
     pretrained_projection_head = simclr_model.projection_head
@@ -139,3 +248,17 @@ def retrain_embeddings(
     torch.save(projection_head_state_dict, PROJECTION_HEAD_MODEL_PATH)
 
     print('Embedding retraining has completed.')
+
+
+def load_simclr_modules() -> Tuple[nn.Sequential, SimCLRProjectionHead]:
+    # Load the saved state dict objections for the backbone and the projection head
+    resnet18 = torchvision.models.resnet18()
+    backbone = nn.Sequential(*list(resnet18.children())[:-1])
+    ckpt = torch.load(BACKBONE_MODEL_PATH)
+    backbone.load_state_dict(ckpt['resnet18_parameters'])
+
+    project_head = SimCLRProjectionHead(512, 512, 128)
+    projection_ckpt = torch.load(PROJECTION_HEAD_MODEL_PATH)
+    project_head.load_state_dict(projection_ckpt['projection_parameters'])
+
+    return backbone, project_head
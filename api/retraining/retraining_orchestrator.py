@@ -1,41 +1,84 @@
-import json
+import contextlib
 import logging
-import shutil
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict
-
-from torch.utils.data import DataLoader
+from typing import List, Dict, Optional
 
 from api.clients.s3_client import s3_bucket
 from api.data_models.annotations import read_annotations_for_collection, Annotation
-from api.predictions.predict_individual import load_backbone
-from api.retraining.classifier_train_dataset import ClassifierTrainDataset
 from api.retraining.embeddings_train_dataset import EmbeddingsTrainDataset
-from api.retraining.retrain_classifier import retrain_classifier_for_species, generate_embeddings
-from api.retraining.retrain_embeddings import retrain_embeddings, embedding_num_sample, TRAINING_BATCH_SIZE, \
-    TRAINING_MAX_EPOCHS, TRAINING_WORKERS
+from api.retraining.retrain_classifier import retrain_classifier_job, create_classifier_pool, classifier_threads, \
+    RETRAIN_CLASSIFIER_PROCESSES
+from api.retraining.retrain_embeddings import retrain_embeddings, embedding_num_sample, TRAINING_MAX_EPOCHS, \
+    TRAINING_WORKERS, embedding_training_mode, embedding_batch_size, PARTIAL_FINE_TUNING_MAX_ANNOTATIONS
 from api.retraining.retrain_embeddings_logger import RetrainEmbeddingsLogger
 from api.data_models.retrain_event_log import log_event, RetrainEventLog, truncate_job_logs
 from api.data_models.retrain_metrics import truncate_metrics
-from api.data_models.retrain_status import read_job_status_from_redis, save_job_status_to_redis, RetrainStatus
+from api.data_models.retrain_status import read_job_status_from_redis, save_job_status_to_redis, RetrainStatus, \
+    RetrainBudget
 from api.data_models.species import Species
+from api.leases import Lease, keep_lease, acquire_lease, wait_for_lease, release_lease
+from api.metrics import observe_stage
+from api.profiling import profile_run
+from api.storage import ensure_local
+from api.training_shards import write_training_shard, upload_training_shard, sync_training_shards, \
+    TRAINING_SYNC_THREADS
+
+
+BACKBONE_LEASE_NAME = 'models:backbone'
+# Seconds before a retraining deadline that the embeddings backbone stops training by, to leave time for retraining the
+# classifiers and promoting the new training data.
+RETRAIN_RESERVED_SECONDS = float(os.getenv('RETRAIN_RESERVED_SECONDS', '900'))
 
 
 class RetrainingOrchestrator:
-    def __init__(self, collection_id: str, logger: logging.Logger, classifier_only: bool):
+    def __init__(
+            self,
+            collection_id: str,
+            logger: logging.Logger,
+            classifier_only: bool,
+            profile: bool = False,
+            lease: Optional[Lease] = None,
+            deadline: Optional[float] = None
+    ):
         self.collection_id = collection_id
         self.logger = logger
         self.classifier_only = classifier_only
+        self.profile = profile
+        # The lease that keeps other retraining runs for the collection from starting, renewed while retraining.
+        self.lease = lease
+        # Unix time by which retraining should be completed. The backbone trains for as many epochs as fit before it.
+        self.deadline = deadline
         self.__version = str(time.time())
 
     def start_retraining(self) -> None:
+        with contextlib.ExitStack() as stack:
+            if self.lease is not None:
+                stack.enter_context(keep_lease(self.lease))
+            with profile_run(self.collection_id, 'retraining', self.profile):
+                self.__retrain()
+
+    def __retrain(self) -> None:
         truncate_job_logs(self.collection_id)
         truncate_metrics(self.collection_id)
         job = self.__job_status()
         job['status'] = 'started'
+        if self.deadline is not None:
+            job['budget'] = RetrainBudget(
+                deadline=self.deadline,
+                reserved_seconds=RETRAIN_RESERVED_SECONDS,
+                seconds_per_epoch=None,
+                planned_epochs=None,
+                completed_epochs=0,
+                used=0,
+                projected_finish=None
+            )
         save_job_status_to_redis(job)
         self.__log_event(f'Started retraining for collection {self.collection_id}.')
+        if self.deadline is not None:
+            self.__log_event(f'Retraining is due by {datetime.fromtimestamp(self.deadline).isoformat()}.')
 
         new_annotations = read_annotations_for_collection(self.collection_id)
         new_annotations = [a for a in new_annotations if a['accepted']]
@@ -49,8 +92,20 @@ class RetrainingOrchestrator:
             f"Retraining with {len(new_annotations)} new annotation{'s' if len(new_annotations) != 1 else ''}."
         )
 
+        if s3_bucket is not None:
+            # Other nodes may have added training data since this one last retrained.
+            with observe_stage('retrain_sync'):
+                report = sync_training_shards('download')
+                # Prediction workers on other nodes may have written the crops, which are then only in S3.
+                crops = [a['cropped_file_name'] for a in new_annotations if a['cropped_file_name'] is not None]
+                with ThreadPoolExecutor(max_workers=TRAINING_SYNC_THREADS) as executor:
+                    list(executor.map(ensure_local, crops))
+            if report['downloaded'] > 0:
+                self.__log_event(f"Downloaded {report['downloaded']} new training data shards.")
+
         if not self.classifier_only:
             self.__retrain_embeddings(new_annotations)
+        self.__update_budget(projected_finish=time.time() + RETRAIN_RESERVED_SECONDS)
 
         if self.__should_abort():
             self.__log_event('Retraining aborted!')
@@ -62,9 +117,11 @@ class RetrainingOrchestrator:
             self.__log_event('Retraining aborted!')
             return
 
-        self.__upload_annotations_to_training(new_annotations)
+        with observe_stage('retrain_upload', items=len(new_annotations)):
+            self.__upload_annotations_to_training(new_annotations)
         self.__log_event(f'New images added to classifier training data for future training.')
 
+        self.__update_budget(projected_finish=time.time())
         job = self.__job_status()
         job['status'] = 'completed'
         save_job_status_to_redis(job)
@@ -72,16 +129,41 @@ class RetrainingOrchestrator:
 
     def __retrain_embeddings(self, new_annotations: List[Annotation]) -> None:
         self.__log_event("Started retraining for the embeddings backbone.")
+        mode = embedding_training_mode(len(new_annotations))
+        if mode == 'partial':
+            self.__log_event(
+                f'Fewer than {PARTIAL_FINE_TUNING_MAX_ANNOTATIONS} new annotations, so only the last backbone block '
+                f'and the projection head are fine-tuned.'
+            )
+        batch_size = embedding_batch_size(mode)
         self.__log_event(
-            f'Batch size: {TRAINING_BATCH_SIZE}, max epochs: {TRAINING_MAX_EPOCHS}, workers: {TRAINING_WORKERS}.'
+            f'Batch size: {batch_size}, max epochs: {TRAINING_MAX_EPOCHS}, workers: {TRAINING_WORKERS}.'
         )
-        num_prior_images = embedding_num_sample(len(new_annotations))
+        num_prior_images = embedding_num_sample(len(new_annotations), batch_size)
         self.__log_event(f'Fine-tuning with {num_prior_images} images from existing training data.')
 
         dataset = EmbeddingsTrainDataset(new_annotations=new_annotations, num2sample=num_prior_images)
         logger = RetrainEmbeddingsLogger(collection_id=self.collection_id, version=self.__version)
+        # Retraining for other collections may be writing the backbone too.
+        model_lease = acquire_lease(BACKBONE_LEASE_NAME)
+        if model_lease is None:
+            self.__log_event('Waiting for another retraining of the embeddings backbone to finish.')
+            model_lease = wait_for_lease(BACKBONE_LEASE_NAME)
+
+        training_deadline = None
+        if self.deadline is not None:
+            training_deadline = self.deadline - RETRAIN_RESERVED_SECONDS
+            if time.time() >= training_deadline:
+                release_lease(model_lease)
+                self.__log_event('Skipped retraining the embeddings backbone, since there is no time left for it.')
+                return
+
         start_time = datetime.now()
-        retrain_embeddings(should_abort=self.__should_abort, train_dataset=dataset, logger=logger)
+        with keep_lease(model_lease), observe_stage('retrain_embeddings', items=len(dataset)):
+            retrain_embeddings(
+                should_abort=self.__should_abort, train_dataset=dataset, logger=logger, lease=model_lease, mode=mode,
+                deadline=training_deadline, on_epoch_end=self.__report_epoch
+            )
         elapsed_time = datetime.now() - start_time
 
         if self.__should_abort():
@@ -89,51 +171,54 @@ class RetrainingOrchestrator:
         self.__log_event(f'Completed retraining for the embeddings backbone after {elapsed_time.seconds}s.')
 
     def __retrain_classifier(self, new_annotations: List[Annotation]) -> None:
-        backbone, device = load_backbone()
         grouped_annotations = self.__group_annotations_by_species(new_annotations)
         for species in grouped_annotations.keys():
             self.__log_event(f'Found new training data for the {species} classifier.')
 
-        for species, annotations in grouped_annotations.items():
-            if self.__should_abort():
-                return
-
-            self.__log_event(f'Loading training data for the {species} classifier.')
-            train_dataset = ClassifierTrainDataset(species, new_annotations)
-            train_dataloader = DataLoader(
-                train_dataset,
-                batch_size=1,  # Batch size to be 1 so that no training examples are dropped.
-                shuffle=True,
-                num_workers=2,
-                drop_last=True
-            )
-            load_data_start_time = datetime.now()
-            train_embeddings, train_labels = generate_embeddings(backbone, train_dataloader)
-            elapsed_time = datetime.now() - load_data_start_time
-            self.__log_event(
-                f'Loaded {len(train_embeddings)} embeddings for {species} after {elapsed_time.seconds}s.'
-            )
+        processes = min(RETRAIN_CLASSIFIER_PROCESSES, len(grouped_annotations))
+        if processes <= 1:
+            for species, annotations in grouped_annotations.items():
+                retrain_classifier_job(self.collection_id, species, annotations)
+            return
 
-            if self.__should_abort():
-                return
+        # Each species only depends on its own data, so retraining takes as long as the largest species.
+        self.__log_event(
+            f'Retraining {len(grouped_annotations)} classifiers in {processes} processes '
+            f'with {classifier_threads(processes)} threads each.'
+        )
+        executor = create_classifier_pool(processes)
+        try:
+            futures = [
+                executor.submit(retrain_classifier_job, self.collection_id, species, annotations)
+                for species, annotations in grouped_annotations.items()
+            ]
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
 
-            self.__log_event(f'Started retraining for the {species} classifier.')
-            retrain_start_time = datetime.now()
-            retrain_classifier_for_species(
-                species=species,
-                train_embeddings=train_embeddings,
-                train_labels=train_labels
+    def __report_epoch(self, completed_epochs: int, seconds_per_epoch: float, planned_epochs: int) -> None:
+        if completed_epochs == 1:
+            self.__log_event(
+                f'The first epoch took {int(seconds_per_epoch)}s, so the backbone is planned to train for {planned_epochs} epochs.'
             )
-            elapsed_time = datetime.now() - retrain_start_time
-
-            if self.__should_abort():
-                return
-
-            with open(species.labels_location(), 'w') as f:
-                json.dump(train_dataset.labels, f)
+        remaining_seconds = (planned_epochs - completed_epochs) * seconds_per_epoch
+        self.__update_budget(
+            seconds_per_epoch=seconds_per_epoch,
+            planned_epochs=planned_epochs,
+            completed_epochs=completed_epochs,
+            projected_finish=time.time() + remaining_seconds + RETRAIN_RESERVED_SECONDS
+        )
 
-            self.__log_event(f'Completed retraining for the {species} classifier after {elapsed_time.seconds}s.')
-            self.logger.info(f'Model saved as {species.model_location()}')
+    def __update_budget(self, **changes) -> None:
+        if self.deadline is None:
+            return
+        job = self.__job_status()
+        if job['budget'] is None:
+            return
+        used = (time.time() - job['created_at']) / max(1.0, self.deadline - job['created_at'])
+        job['budget'] = RetrainBudget(**{**job['budget'], **changes, 'used': round(used, 3)})
+        save_job_status_to_redis(job)
 
     def __job_status(self) -> RetrainStatus:
         return read_job_status_from_redis(self.collection_id)
@@ -153,22 +238,19 @@ class RetrainingOrchestrator:
         results = {}
         for annotation in annotations:
             species = Species.from_string(annotation['predicted_species'])
+            if species is None:
+                continue
             if species not in results:
                 results[species] = []
             results[species].append(annotation)
         return results
 
-    @staticmethod
-    def __upload_annotations_to_training(annotations: List[Annotation]) -> None:
-        for annotation in annotations:
-            if annotation['accepted'] is False:
-                continue
-
-            species = Species.from_string(annotation['predicted_species'])
-            if species is None:
-                continue
-
-            new_path = f"{species.training_data_location()}/{annotation['predicted_name']}/{annotation['id']}.jpg"
-            shutil.copyfile(annotation['cropped_file_name'], new_path)
-            if s3_bucket is not None:
-                s3_bucket.upload_file(annotation['cropped_file_name'], new_path)
+    def __upload_annotations_to_training(self, annotations: List[Annotation]) -> None:
+        # Each promotion adds one shard per species, so other nodes only download the new shards.
+        for species, species_annotations in self.__group_annotations_by_species(annotations).items():
+            shard = write_training_shard(species, [
+                (f"{a['predicted_name']}/{a['id']}.jpg", a['cropped_file_name'])
+                for a in species_annotations if a['accepted'] is not False
+            ])
+            if shard is not None and s3_bucket is not None:
+                upload_training_shard(shard)
@@ -0,0 +1,116 @@
+import logging
+import os
+import tempfile
+from typing import NamedTuple, Dict, List, TypedDict
+
+from api.clients.s3_client import s3_bucket
+
+logger = logging.getLogger(__name__)
+
+# The most keys a single S3 DeleteObjects request accepts.
+S3_DELETE_BATCH_SIZE = 1000
+
+
+class StoredFile(NamedTuple):
+    key: str
+    size: int
+    modified: float
+    local: bool
+    s3: bool
+
+
+class DeleteReport(TypedDict):
+    files: int
+    bytes: int
+    local_files: int
+    s3_objects: int
+
+
+def list_stored_files(prefix: str) -> Dict[str, StoredFile]:
+    """
+    Lists the files under a website-data prefix, such as `website-data/outputs/<collectionID>/`, both on local disk and
+    in S3, keyed by path.
+    """
+    files: Dict[str, StoredFile] = {}
+    for dir_path, _, file_names in os.walk(prefix):
+        for file_name in file_names:
+            key = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(key)
+            except FileNotFoundError:
+                continue
+            files[key] = StoredFile(key=key, size=stat.st_size, modified=stat.st_mtime, local=True, s3=False)
+
+    if s3_bucket is not None:
+        for o in s3_bucket.objects.filter(Prefix=prefix):
+            local = files.get(o.key)
+            files[o.key] = StoredFile(
+                key=o.key,
+                size=max(o.size, local.size if local is not None else 0),
+                modified=max(o.last_modified.timestamp(), local.modified if local is not None else 0),
+                local=local is not None,
+                s3=True
+            )
+    return files
+
+
+def stored_file(key: str) -> StoredFile:
+    """
+    Returns a file that may exist locally or in S3, without listing S3. The size only covers the local copy.
+    """
+    try:
+        stat = os.stat(key)
+        return StoredFile(key=key, size=stat.st_size, modified=stat.st_mtime, local=True, s3=s3_bucket is not None)
+    except FileNotFoundError:
+        return StoredFile(key=key, size=0, modified=0, local=False, s3=s3_bucket is not None)
+
+
+def ensure_local(key: str) -> bool:
+    """
+    Downloads a file from S3 unless it is already on local disk, e.g. on a prediction worker node. Returns whether the
+    file exists locally.
+    """
+    if os.path.exists(key):
+        return True
+    if s3_bucket is None:
+        return False
+    os.makedirs(os.path.dirname(key), exist_ok=True)
+    # Download to a temporary file first, so concurrent readers never see a partial file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(key), suffix='.tmp')
+    os.close(fd)
+    try:
+        s3_bucket.download_file(key, tmp_path)
+        os.replace(tmp_path, key)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+
+def delete_stored_files(files: List[StoredFile]) -> DeleteReport:
+    """
+    Deletes files from local disk and from S3, where S3 objects are deleted in bulk.
+    """
+    report = DeleteReport(files=0, bytes=0, local_files=0, s3_objects=0)
+    for f in files:
+        if not f.local:
+            continue
+        try:
+            os.remove(f.key)
+            report['local_files'] += 1
+        except FileNotFoundError:
+            pass
+
+    s3_keys = [f.key for f in files if f.s3]
+    if s3_bucket is not None:
+        for idx in range(0, len(s3_keys), S3_DELETE_BATCH_SIZE):
+            batch = s3_keys[idx:idx + S3_DELETE_BATCH_SIZE]
+            response = s3_bucket.delete_objects(Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+            errors = response.get('Errors', [])
+            for error in errors:
+                logger.warning(f"Failed to delete {error['Key']} from S3: {error['Message']}")
+            report['s3_objects'] += len(batch) - len(errors)
+
+    report['files'] = len(files)
+    report['bytes'] = sum(f.size for f in files)
+    return report
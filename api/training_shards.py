@@ -0,0 +1,266 @@
+"""
+Training data packed into append-only shards.
+
+Each time annotations are promoted to training data, their crops are packed into one new shard per species: an
+uncompressed tar file, `training_data/shards/<species>/<shard>.tar`, next to a JSON index of the offset and size of
+every image in it. Shards are never changed once written and their names are unique, so copies are compared by name
+alone, and syncing with S3 only transfers the shards one side is missing instead of listing and copying every image.
+The index is written after its shard, so a shard without an index is incomplete and ignored.
+
+Images in the older `training_data/cropped/<species>/<individual>/<id>.jpg` layout are still read, and `pack` moves
+them into a shard:
+
+    python -m api.training_shards sync
+    python -m api.training_shards sync --direction download
+    python -m api.training_shards pack
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import tarfile
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, List, Tuple, TypedDict, Dict, Set
+
+import PIL.Image
+
+from api.clients.s3_client import s3_bucket
+from api.data_models.species import Species, TRAINING_SHARDS_PATH, list_species
+from api.decoding import decode_image
+from api.storage import ensure_local
+
+logger = logging.getLogger(__name__)
+
+# Shards transferred to or from S3 at the same time.
+TRAINING_SYNC_THREADS = int(os.getenv('TRAINING_SYNC_THREADS', '16'))
+SYNC_DIRECTIONS = ['both', 'upload', 'download']
+
+
+class TrainingSample(NamedTuple):
+    # Name of the individual.
+    name: str
+    # Path of a loose image, or of the image within its shard.
+    file_name: str
+    # Path of the shard holding the image, or None for a loose image.
+    shard: Optional[str] = None
+    offset: int = 0
+    size: int = 0
+
+
+class ShardIndexEntry(TypedDict):
+    name: str
+    # Name of the tar member, `<individual>/<id>.jpg`.
+    member: str
+    offset: int
+    size: int
+
+
+class ShardIndex(TypedDict):
+    species: str
+    created_at: float
+    samples: List[ShardIndexEntry]
+
+
+class SyncReport(TypedDict):
+    uploaded: int
+    downloaded: int
+    bytes_uploaded: int
+    bytes_downloaded: int
+    up_to_date: int
+
+
+def shard_index_location(shard: str) -> str:
+    return f'{shard.removesuffix(".tar")}.json'
+
+
+def write_training_shard(species: Species, images: List[Tuple[str, str]]) -> Optional[str]:
+    """
+    Packs images, given as (member, file name) pairs where members are named `<individual>/<id>.jpg`, into a new shard
+    and returns its path, or None if there are no new images. Members already in one of the species' shards are
+    skipped, so promoting the same annotations again does not duplicate them.
+    """
+    existing = list_shard_members(species)
+    images = [(member, file_name) for member, file_name in dict(images).items() if member not in existing]
+    if len(images) == 0:
+        return None
+    os.makedirs(species.training_shards_location(), exist_ok=True)
+    # Names sort in the order shards were written.
+    shard = f'{species.training_shards_location()}/{time.time_ns()}-{uuid.uuid4().hex[:8]}.tar'
+
+    fd, tmp_path = tempfile.mkstemp(dir=species.training_shards_location(), suffix='.tmp')
+    os.close(fd)
+    try:
+        with tarfile.open(tmp_path, 'w') as tar:
+            for member, file_name in images:
+                tar.add(file_name, arcname=member, recursive=False)
+        with tarfile.open(tmp_path, 'r') as tar:
+            samples = [
+                ShardIndexEntry(name=m.name.split('/')[0], member=m.name, offset=m.offset_data, size=m.size)
+                for m in tar.getmembers() if m.isfile()
+            ]
+        os.replace(tmp_path, shard)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    index = ShardIndex(species=species.value, created_at=time.time(), samples=samples)
+    __write_json(shard_index_location(shard), index)
+    logger.info(f'Packed {len(samples)} images into {shard}.')
+    return shard
+
+
+def upload_training_shard(shard: str) -> None:
+    # The index goes last, so other nodes never download a shard that is still being uploaded.
+    s3_bucket.upload_file(shard, shard)
+    s3_bucket.upload_file(shard_index_location(shard), shard_index_location(shard))
+
+
+def list_training_shards(species: Species) -> List[str]:
+    """
+    Lists the complete shards of a species, oldest first.
+    """
+    index_files = sorted(glob.glob(f'{species.training_shards_location()}/*.json'))
+    return [f'{f.removesuffix(".json")}.tar' for f in index_files if os.path.exists(f'{f.removesuffix(".json")}.tar')]
+
+
+def read_shard_index(shard: str) -> ShardIndex:
+    with open(shard_index_location(shard)) as f:
+        return json.load(f)
+
+
+def list_training_samples(species: Species) -> List[TrainingSample]:
+    """
+    Lists every training image of a species, from its shards and from the older loose layout.
+    """
+    samples = [
+        TrainingSample(name=file_name.split('/')[-2], file_name=file_name)
+        for file_name in sorted(glob.glob(f'{species.training_data_location()}/*/*.jpg'))
+    ]
+    for shard in list_training_shards(species):
+        for entry in read_shard_index(shard)['samples']:
+            samples.append(TrainingSample(
+                name=entry['name'],
+                file_name=f'{shard}/{entry["member"]}',
+                shard=shard,
+                offset=entry['offset'],
+                size=entry['size']
+            ))
+    return samples
+
+
+def list_shard_members(species: Species) -> Set[str]:
+    """
+    Returns the `<individual>/<id>.jpg` names of every image in the shards of a species.
+    """
+    return {entry['member'] for shard in list_training_shards(species) for entry in read_shard_index(shard)['samples']}
+
+
+def read_training_image(sample: TrainingSample, min_size: Optional[Tuple[int, int]] = None) -> PIL.Image.Image:
+    """
+    Decodes a training image, reading only its own bytes from its shard.
+    """
+    if sample.shard is None:
+        return decode_image(sample.file_name, min_size)
+    with open(sample.shard, 'rb') as f:
+        f.seek(sample.offset)
+        data = f.read(sample.size)
+    return decode_image(io.BytesIO(data), min_size)
+
+
+def sync_training_shards(direction: str = 'both') -> SyncReport:
+    """
+    Uploads the shards that are only on local disk to S3, and downloads the shards that are only in S3.
+    """
+    if direction not in SYNC_DIRECTIONS:
+        raise ValueError(f'Unknown sync direction {direction}, expected one of {SYNC_DIRECTIONS}.')
+    if s3_bucket is None:
+        raise ValueError('Syncing training data shards requires S3.')
+
+    local = {}
+    for dir_path, _, file_names in os.walk(TRAINING_SHARDS_PATH):
+        for file_name in file_names:
+            key = os.path.join(dir_path, file_name)
+            local[key] = os.path.getsize(key)
+    remote = {o.key: o.size for o in s3_bucket.objects.filter(Prefix=f'{TRAINING_SHARDS_PATH}/')}
+
+    local_shards = __complete_shards(local)
+    remote_shards = __complete_shards(remote)
+    uploads = []
+    if direction in ['both', 'upload']:
+        # Shards are immutable, so a copy of a different size in S3 can only be a broken one.
+        uploads = [s for s in local_shards if s not in remote_shards or remote[s] != local[s]]
+    downloads = []
+    if direction in ['both', 'download']:
+        downloads = [s for s in remote_shards if s not in local_shards]
+
+    with ThreadPoolExecutor(max_workers=TRAINING_SYNC_THREADS) as executor:
+        futures = [executor.submit(upload_training_shard, s) for s in uploads]
+        futures += [executor.submit(__download_training_shard, s) for s in downloads]
+        for future in futures:
+            future.result()
+
+    transferred = set(uploads) | set(downloads)
+    return SyncReport(
+        uploaded=len(uploads),
+        downloaded=len(downloads),
+        bytes_uploaded=sum(local[s] + local[shard_index_location(s)] for s in uploads),
+        bytes_downloaded=sum(remote[s] + remote[shard_index_location(s)] for s in downloads),
+        up_to_date=len(set(local_shards) & set(remote_shards) - transferred)
+    )
+
+
+def pack_loose_training_data(species: Species) -> Optional[str]:
+    """
+    Moves the loose images of a species into a new shard, and returns it, or None if there were none. Loose images
+    that are already in a shard are only removed.
+    """
+    loose = [s for s in list_training_samples(species) if s.shard is None]
+    shard = write_training_shard(species, [(f'{s.name}/{os.path.basename(s.file_name)}', s.file_name) for s in loose])
+    for sample in loose:
+        os.remove(sample.file_name)
+    return shard
+
+
+def __download_training_shard(shard: str) -> None:
+    ensure_local(shard)
+    ensure_local(shard_index_location(shard))
+
+
+def __complete_shards(sizes: Dict[str, int]) -> List[str]:
+    return sorted(
+        f'{k.removesuffix(".json")}.tar' for k in sizes
+        if k.endswith('.json') and f'{k.removesuffix(".json")}.tar' in sizes
+    )
+
+
+def __write_json(file_name: str, value) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_name), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, file_name)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sync_parser = subparsers.add_parser('sync', help='Transfer the shards missing locally or in S3.')
+    sync_parser.add_argument('--direction', choices=SYNC_DIRECTIONS, default='both')
+    pack_parser = subparsers.add_parser('pack', help='Move images in the loose layout into shards.')
+    pack_parser.add_argument('--species', nargs='+', default=None, help='Only pack these species.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'sync':
+        print(json.dumps(sync_training_shards(args.direction), indent=2))
+    else:
+        species = [Species(s) for s in args.species] if args.species is not None else list_species()
+        print(json.dumps({s.value: pack_loose_training_data(s) for s in species}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
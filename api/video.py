@@ -0,0 +1,104 @@
+"""
+Frame sampling for camera-trap video clips.
+
+Clips are decoded as a stream, one frame at a time, so only the sampled frames are ever kept. Frames are analysed at
+VIDEO_ANALYSIS_FPS: a small blurred grayscale copy of each analysed frame is compared with the last sampled frame, and
+the frame is sampled when they differ by more than VIDEO_CHANGE_THRESHOLD. That catches an animal moving as well as the
+scene changing, such as the light or the camera being knocked. A frame is also sampled after VIDEO_MAX_GAP_SECONDS
+without one, so a slow animal is never missed entirely, and never within VIDEO_MIN_GAP_SECONDS of the last one.
+"""
+import logging
+import math
+import os
+from typing import NamedTuple, Optional, Iterator
+
+import PIL.Image
+
+from api.metrics import VIDEO_FRAMES
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ['.mp4', '.avi', '.mov', '.mkv']
+# Frames per second compared with the last sampled frame. Frames in between are decoded but not analysed.
+VIDEO_ANALYSIS_FPS = float(os.getenv('VIDEO_ANALYSIS_FPS', '4'))
+# Mean absolute difference, out of 255, between an analysed frame and the last sampled frame that samples it.
+VIDEO_CHANGE_THRESHOLD = float(os.getenv('VIDEO_CHANGE_THRESHOLD', '12'))
+VIDEO_MIN_GAP_SECONDS = float(os.getenv('VIDEO_MIN_GAP_SECONDS', '0.5'))
+VIDEO_MAX_GAP_SECONDS = float(os.getenv('VIDEO_MAX_GAP_SECONDS', '5'))
+# Most frames sampled from one clip.
+VIDEO_MAX_FRAMES = int(os.getenv('VIDEO_MAX_FRAMES', '60'))
+# Frame rate assumed for clips that do not record one.
+DEFAULT_FPS = 30
+ANALYSIS_WIDTH = 64
+
+
+class SampledFrame(NamedTuple):
+    index: int
+    # Seconds from the start of the clip.
+    timestamp: float
+    # Mean absolute difference from the previously sampled frame, or None for the first sampled frame.
+    change: Optional[float]
+    image: PIL.Image.Image
+
+
+def is_video(file_name: str) -> bool:
+    return os.path.splitext(file_name)[1].lower() in VIDEO_EXTENSIONS
+
+
+def sample_frames(file_name: str) -> Iterator[SampledFrame]:
+    """
+    Decodes a clip frame by frame and yields the frames that are worth predicting on.
+    """
+    # OpenCV is only needed for video.
+    import cv2
+    import numpy as np
+
+    capture = cv2.VideoCapture(file_name)
+    if not capture.isOpened():
+        raise ValueError(f'{file_name} is not a video that can be decoded.')
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if math.isnan(fps) or fps <= 0:
+        fps = DEFAULT_FPS
+    stride = max(1, round(fps / VIDEO_ANALYSIS_FPS))
+
+    last_sampled: Optional[np.ndarray] = None
+    last_timestamp = 0.0
+    index = -1
+    sampled = 0
+    try:
+        while sampled < VIDEO_MAX_FRAMES and capture.grab():
+            index += 1
+            if index % stride != 0:
+                continue
+            ok, pixels = capture.retrieve()
+            if not ok:
+                break
+            timestamp = index / fps
+            height = max(1, round(pixels.shape[0] * ANALYSIS_WIDTH / pixels.shape[1]))
+            small = cv2.resize(pixels, (ANALYSIS_WIDTH, height), interpolation=cv2.INTER_AREA)
+            # Blurring keeps sensor noise and compression artifacts from counting as change.
+            small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (3, 3), 0).astype(np.int16)
+
+            change = None if last_sampled is None else float(np.abs(small - last_sampled).mean())
+            gap = timestamp - last_timestamp
+            if change is not None and (
+                    gap < VIDEO_MIN_GAP_SECONDS or (change <= VIDEO_CHANGE_THRESHOLD and gap < VIDEO_MAX_GAP_SECONDS)
+            ):
+                continue
+            last_sampled, last_timestamp = small, timestamp
+            sampled += 1
+            yield SampledFrame(
+                index=index,
+                timestamp=timestamp,
+                change=change,
+                image=PIL.Image.fromarray(cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB))
+            )
+        if sampled == VIDEO_MAX_FRAMES and capture.grab():
+            logger.warning(
+                f'Stopped sampling {file_name} at {index / fps:.1f}s after {VIDEO_MAX_FRAMES} frames, so the rest of '
+                f'the clip is not predicted on. Raise VIDEO_MAX_FRAMES to sample longer clips.'
+            )
+    finally:
+        capture.release()
+        VIDEO_FRAMES.labels('sampled').inc(sampled)
+        VIDEO_FRAMES.labels('skipped').inc(index + 1 - sampled)
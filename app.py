@@ -5,15 +5,23 @@ import os
 import flask
 from flask import send_from_directory
 from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
 
 from api.clients.redis_client import redis_client
 from api.data_models.retrain_event_log import LOGS_REDIS_KEY
 from api.data_models.retrain_metrics import METRICS_REDIS_KEY
 from api.data_models.retrain_status import JOBS_REDIS_KEY
-from api.endpoints import images, labels, collections, annotations, species, predictions, retrain
+from api.endpoints import images, labels, collections, annotations, species, predictions, retrain, derivatives, \
+    metrics, profiles, bursts, retention, exports, ingestion, clips
+from api.storage import ensure_local
 
 APP_HOST = os.getenv('APP_HOST', 'localhost')
 APP_PORT = int(os.getenv('APP_PORT', '5000'))
+# The `metadata` role serves collections, images and annotations without ever loading the ML stack.
+APP_ROLE = os.getenv('APP_ROLE', 'full')
+APP_ROLES = ['full', 'metadata']
+if APP_ROLE not in APP_ROLES:
+    raise ValueError(f'APP_ROLE must be one of {APP_ROLES}, not `{APP_ROLE}`.')
 
 logging.basicConfig(
     format='%(asctime)s.%(msecs)d %(pathname)s:%(lineno)d [%(levelname)s] %(message)s',
@@ -26,9 +34,18 @@ app.register_blueprint(labels.flask_blueprint)
 app.register_blueprint(species.flask_blueprint)
 app.register_blueprint(collections.flask_blueprint)
 app.register_blueprint(images.flask_blueprint)
-app.register_blueprint(predictions.flask_blueprint)
 app.register_blueprint(annotations.flask_blueprint)
-app.register_blueprint(retrain.flask_blueprint)
+app.register_blueprint(derivatives.flask_blueprint)
+app.register_blueprint(metrics.flask_blueprint)
+app.register_blueprint(profiles.flask_blueprint)
+app.register_blueprint(bursts.flask_blueprint)
+app.register_blueprint(retention.flask_blueprint)
+app.register_blueprint(exports.flask_blueprint)
+app.register_blueprint(ingestion.flask_blueprint)
+app.register_blueprint(clips.flask_blueprint)
+if APP_ROLE == 'full':
+    app.register_blueprint(predictions.flask_blueprint)
+    app.register_blueprint(retrain.flask_blueprint)
 
 
 @app.errorhandler(HTTPException)
@@ -46,6 +63,14 @@ def handle_exception(e):
 
 @app.get('/website-data/<path:name>')
 def get_website_data(name):
+    path = safe_join('website-data', name)
+    if path is None:
+        flask.abort(404)
+    # Crops and annotated images written by prediction workers on other nodes are only in S3.
+    try:
+        ensure_local(path)
+    except Exception:
+        logging.warning(f'{path} not found in S3.')
     return send_from_directory('website-data', name)
 
 
@@ -54,8 +79,12 @@ def serve():
     return send_from_directory(app.static_folder, 'index.html')
 
 
-if __name__ == "__main__":
+def clear_retraining_state() -> None:
     redis_client.delete(JOBS_REDIS_KEY)
     redis_client.delete(LOGS_REDIS_KEY)
     redis_client.delete(METRICS_REDIS_KEY)
+
+
+if __name__ == "__main__":
+    clear_retraining_state()
     app.run(port=APP_PORT, host=APP_HOST)
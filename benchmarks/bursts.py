@@ -0,0 +1,63 @@
+"""
+Reports how much inference burst detection saves on a real collection.
+
+Groups the images in a directory into bursts of near-duplicate frames, the same way predictions do, and prints the
+bursts and the fraction of frames that would not need inference as JSON.
+
+    python -m benchmarks.bursts website-data/inputs/<collectionID>
+    python -m benchmarks.bursts photos/ --max-seconds 5 --max-hash-distance 4
+"""
+import argparse
+import glob
+import json
+import os
+import time
+from typing import Dict
+
+from benchmarks.common import timed, StageResult
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='Directory of JPEG images.')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Overrides BURST_MAX_SECONDS.')
+    parser.add_argument('--max-hash-distance', type=int, default=None, help='Overrides BURST_MAX_HASH_DISTANCE.')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    from api.data_models.bursts import burst_report
+    from api.predictions import bursts
+
+    if args.max_seconds is not None:
+        bursts.BURST_MAX_SECONDS = args.max_seconds
+    if args.max_hash_distance is not None:
+        bursts.BURST_MAX_HASH_DISTANCE = args.max_hash_distance
+
+    file_names = sorted(glob.glob(os.path.join(args.directory, '*.jpg')) +
+                        glob.glob(os.path.join(args.directory, '*.JPG')))
+    if len(file_names) == 0:
+        parser.error(f'No JPEG images found in {args.directory}.')
+
+    stages: Dict[str, StageResult] = {}
+    with timed(stages, 'group', len(file_names)):
+        groups = bursts.group_bursts(file_names, set())
+
+    report = json.dumps({
+        'benchmark': 'bursts',
+        'created_at': time.time(),
+        'directory': args.directory,
+        'max_seconds': bursts.BURST_MAX_SECONDS,
+        'max_hash_distance': bursts.BURST_MAX_HASH_DISTANCE,
+        'stages': stages,
+        'report': burst_report(groups),
+        'bursts': [b for b in groups if len(b['file_names']) > 1],
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+Helpers shared by the offline benchmarks.
+"""
+import contextlib
+import fnmatch
+import os
+import resource
+import sys
+import time
+from types import ModuleType
+from typing import Dict, List, Optional, Iterator, Tuple, TypedDict
+
+import numpy as np
+import PIL.Image
+
+
+class StageResult(TypedDict):
+    seconds: float
+    items: int
+    items_per_second: float
+    ms_per_item: float
+
+
+@contextlib.contextmanager
+def timed(results: Dict[str, StageResult], stage: str, items: int) -> Iterator[None]:
+    """
+    Times the body of the `with` block and records it under `stage`.
+    """
+    start_time = time.perf_counter()
+    yield
+    results[stage] = stage_result(time.perf_counter() - start_time, items)
+
+
+@contextlib.contextmanager
+def observed_stages(results: Dict[str, StageResult], module: ModuleType) -> Iterator[None]:
+    """
+    Records the `observe_stage` timings of a production module during the `with` block, summed by stage.
+    """
+    totals: Dict[str, List[float]] = {}
+    observe_stage = module.observe_stage
+
+    @contextlib.contextmanager
+    def recording(stage: str, items: int = 1) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            with observe_stage(stage, items):
+                yield
+        finally:
+            total = totals.setdefault(stage, [0.0, 0])
+            total[0] += time.perf_counter() - start_time
+            total[1] += items
+
+    module.observe_stage = recording
+    try:
+        yield
+    finally:
+        module.observe_stage = observe_stage
+        for stage, (seconds, items) in totals.items():
+            results[stage] = stage_result(seconds, int(items))
+
+
+def stage_result(seconds: float, items: int) -> StageResult:
+    return StageResult(
+        seconds=seconds,
+        items=items,
+        items_per_second=items / seconds if seconds > 0 else 0,
+        ms_per_item=seconds * 1000 / items if items > 0 else 0,
+    )
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """
+    Returns the peak resident memory of this process, or with children of the largest child process that has exited,
+    such as a DataLoader worker.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+
+def make_synthetic_jpegs(
+        directory: str,
+        count: int,
+        size: Tuple[int, int] = (4000, 3000),
+        seed: int = 0,
+        quality: int = 90
+) -> List[str]:
+    """
+    Writes `count` camera-trap sized JPEGs. Each image is upscaled low-resolution noise, which compresses about as well
+    as a real outdoor scene, unlike full-resolution noise.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    file_names = []
+    for idx in range(count):
+        low_res = rng.integers(0, 256, size=(size[1] // 16, size[0] // 16, 3), dtype=np.uint8)
+        image = PIL.Image.fromarray(low_res).resize(size, PIL.Image.BILINEAR)
+        file_name = os.path.join(directory, f'synthetic_{idx:05d}.jpg')
+        image.save(file_name, quality=quality)
+        file_names.append(file_name)
+    return file_names
+
+
+class InMemoryRedis:
+    """
+    A local stand-in for the subset of the redis client used by `api.data_models`, so that benchmarks need no server.
+    """
+
+    def __init__(self):
+        self.__data: Dict[str, object] = {}
+
+    def hset(self, key: str, field: Optional[str] = None, value: Optional[str] = None, mapping: Optional[Dict] = None):
+        h = self.__data.setdefault(key, {})
+        if field is not None:
+            h[field] = value
+        h.update(mapping or {})
+        return 1
+
+    def hsetnx(self, key: str, field: str, value):
+        h = self.__data.setdefault(key, {})
+        if field in h:
+            return 0
+        h[field] = str(value)
+        return 1
+
+    def hincrby(self, key: str, field: str, amount: int = 1):
+        h = self.__data.setdefault(key, {})
+        h[field] = str(int(h.get(field, 0)) + amount)
+        return int(h[field])
+
+    def hget(self, key: str, field: str):
+        return self.__data.get(key, {}).get(field)
+
+    def hmget(self, key: str, fields: List[str]):
+        h = self.__data.get(key, {})
+        return [h.get(f) for f in fields]
+
+    def hvals(self, key: str):
+        return list(self.__data.get(key, {}).values())
+
+    def hgetall(self, key: str):
+        return dict(self.__data.get(key, {}))
+
+    def hdel(self, key: str, *fields: str):
+        h = self.__data.get(key, {})
+        return sum(h.pop(f, None) is not None for f in fields)
+
+    def rpush(self, key: str, *values: str):
+        lst = self.__data.setdefault(key, [])
+        lst.extend(values)
+        return len(lst)
+
+    def lrange(self, key: str, start: int, end: int):
+        lst = self.__data.get(key, [])
+        return lst[start:] if end == -1 else lst[start:end + 1]
+
+    def delete(self, *keys: str):
+        return sum(self.__data.pop(k, None) is not None for k in keys)
+
+    def sadd(self, key: str, *values: str):
+        s = self.__data.setdefault(key, set())
+        added = len(set(values) - s)
+        s.update(values)
+        return added
+
+    def smembers(self, key: str):
+        return set(self.__data.get(key, set()))
+
+    def srem(self, key: str, *values: str):
+        s = self.__data.get(key, set())
+        removed = len(s & set(values))
+        s.difference_update(values)
+        return removed
+
+    def exists(self, *keys: str):
+        return sum(k in self.__data for k in keys)
+
+    def keys(self, pattern: str = '*'):
+        return [k for k in self.__data if fnmatch.fnmatch(k, pattern)]
+
+    def scan_iter(self, match: str = '*'):
+        return iter(self.keys(match))
+
+
+def use_in_memory_redis() -> InMemoryRedis:
+    """
+    Replaces the redis client in every loaded `api` module with an in-memory stand-in.
+    """
+    client = InMemoryRedis()
+    for name, module in list(sys.modules.items()):
+        if name.startswith('api.') and hasattr(module, 'redis_client'):
+            setattr(module, 'redis_client', client)
+    return client
@@ -0,0 +1,108 @@
+"""
+Measures how fast each image decoder produces the inputs the models need.
+
+Writes synthetic JPEGs of each size, then decodes them with every decoder to each target size, the same way
+`api.decoding.decode_resized` does for predictions and training. A target of `full` decodes every pixel, as crops need.
+Prints milliseconds per image and the speedup over the `full` decoder as JSON.
+
+    python -m benchmarks.decode
+    python -m benchmarks.decode --megapixels 2 12 20 --targets 224 640 full --decoders pil opencv full
+"""
+import argparse
+import importlib.util
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, TypedDict
+
+from benchmarks.common import StageResult, timed, make_synthetic_jpegs
+
+# Camera traps shoot 4:3 images.
+ASPECT_RATIO = 4 / 3
+
+
+class DecodeResult(TypedDict):
+    megapixels: float
+    width: int
+    height: int
+    target: Optional[int]
+    decoder: str
+    decoded_width: int
+    decoded_height: int
+    stage: StageResult
+    speedup: Optional[float]
+
+
+def run(file_names: List[str], target: Optional[int], decoder: str) -> DecodeResult:
+    from api.decoding import decode_image, decode_resized, image_size
+
+    # Decode once first, so the timings do not include the page cache warming up.
+    decoded = decode_image(file_names[0], None if target is None else (target, target), decoder)
+    stages: Dict[str, StageResult] = {}
+    with timed(stages, 'decode', len(file_names)):
+        for file_name in file_names:
+            if target is None:
+                decode_image(file_name, decoder=decoder)
+            else:
+                decode_resized(file_name, (target, target), decoder)
+
+    width, height = image_size(file_names[0])
+    return DecodeResult(
+        megapixels=round(width * height / 1e6, 1),
+        width=width,
+        height=height,
+        target=target,
+        decoder=decoder,
+        decoded_width=decoded.width,
+        decoded_height=decoded.height,
+        stage=stages['decode'],
+        speedup=None,
+    )
+
+
+def main() -> None:
+    from api.decoding import IMAGE_DECODERS
+
+    available = [d for d in IMAGE_DECODERS if d != 'opencv' or importlib.util.find_spec('cv2') is not None]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[2, 12, 20], help='Image sizes to decode.')
+    parser.add_argument('--targets', nargs='+', default=['224', '640', 'full'],
+                        help='Square target sizes, or full for a full-resolution decode.')
+    parser.add_argument('--decoders', nargs='+', choices=IMAGE_DECODERS, default=available)
+    parser.add_argument('--images', type=int, default=10, help='Images decoded per measurement.')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+    targets = [None if t == 'full' else int(t) for t in args.targets]
+
+    results: List[DecodeResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for megapixels in args.megapixels:
+            height = int((megapixels * 1e6 / ASPECT_RATIO) ** 0.5)
+            size = (int(height * ASPECT_RATIO), height)
+            file_names = make_synthetic_jpegs(os.path.join(tmp_dir, f'{megapixels}mp'), args.images, size=size)
+            for target in targets:
+                # Every decoder decodes the full resolution when there is no target, so only measure one.
+                decoders = ['full'] if target is None else args.decoders
+                runs = [run(file_names, target, decoder) for decoder in decoders]
+                baseline = next((r for r in runs if r['decoder'] == 'full'), None)
+                for r in runs:
+                    if baseline is not None and r['stage']['seconds'] > 0:
+                        r['speedup'] = round(baseline['stage']['seconds'] / r['stage']['seconds'], 2)
+                results += runs
+
+    report = json.dumps({
+        'benchmark': 'decode',
+        'created_at': time.time(),
+        'images': args.images,
+        'results': results,
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
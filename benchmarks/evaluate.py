@@ -0,0 +1,447 @@
+"""
+Accuracy versus latency evaluation of individual identification.
+
+Holds out a split of the training images of each individual, embeds both splits with every
+combination of backbone, runtime backend and quantization level, and matches the held-out images against the rest
+with every combination of PCA size and matcher. Reports top-1 and top-5 accuracy next to embedding latency, matching
+latency and model and index size in one table.
+
+Embeddings are cached under `--cache-dir`, keyed by the split and the embedding configuration, so sweeping PCA sizes
+and matchers, or re-running a sweep with more configurations, only embeds images once per configuration.
+
+    python -m benchmarks.evaluate
+    python -m benchmarks.evaluate --backbones simclr imagenet --backends eager torchscript onnx \\
+        --quantization fp32 int8 --pca none 64 0.95 --matchers exact ivf --output evaluation.json
+
+Backbones:    simclr (the deployed backbone), imagenet (torchvision's pretrained ResNet18)
+Backends:     eager, torchscript, onnx (onnxruntime)
+Quantization: fp32, bf16 (eager only), int8 (onnx only, dynamic quantization)
+Matchers:     exact (brute force nearest neighbours), ivf (approximate, k-means inverted file index)
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, TypedDict, Union, TYPE_CHECKING
+
+import numpy as np
+
+from benchmarks.common import peak_rss_mb
+
+if TYPE_CHECKING:
+    from api.training_shards import TrainingSample
+
+BACKBONES = ['simclr', 'imagenet']
+BACKENDS = ['eager', 'torchscript', 'onnx']
+QUANTIZATION = ['fp32', 'bf16', 'int8']
+MATCHERS = ['exact', 'ivf']
+# Quantization levels that each backend can run.
+SUPPORTED_QUANTIZATION = {'eager': ['fp32', 'bf16'], 'torchscript': ['fp32'], 'onnx': ['fp32', 'int8']}
+TOP_K = 5
+# Neighbours retrieved per query. Several neighbours usually share an individual, so retrieve enough for TOP_K labels.
+NUM_NEIGHBOURS = 50
+IMAGE_SIZE = 224
+
+TABLE_COLUMNS = [
+    ('backbone', '{}'), ('backend', '{}'), ('quantization', '{}'), ('pca', '{}'), ('matcher', '{}'),
+    ('top1', '{:.3f}'), ('top5', '{:.3f}'), ('embed_ms_per_image', '{:.2f}'), ('match_ms_per_query', '{:.3f}'),
+    ('model_mb', '{:.1f}'), ('index_mb', '{:.2f}'),
+]
+
+
+class Split(NamedTuple):
+    species: str
+    train: List['TrainingSample']
+    test: List['TrainingSample']
+
+
+class EmbeddingConfig(NamedTuple):
+    backbone: str
+    backend: str
+    quantization: str
+
+
+class Embeddings(NamedTuple):
+    train: np.ndarray
+    test: np.ndarray
+    ms_per_image: float
+    model_mb: float
+
+
+class EvaluationResult(TypedDict):
+    backbone: str
+    backend: str
+    quantization: str
+    pca: str
+    matcher: str
+    test_images: int
+    top1: float
+    top5: float
+    embed_ms_per_image: float
+    match_ms_per_query: float
+    model_mb: float
+    index_mb: float
+    species: Dict[str, Dict[str, float]]
+
+
+def split_species(species: str, test_fraction: float, seed: int) -> Split:
+    """
+    Holds out test_fraction of the images of each individual with at least two images. Individuals with one image
+    stay in the training split, so every held-out image has at least one match.
+    """
+    from api.data_models.species import Species
+    from api.training_shards import list_training_samples
+
+    by_name: Dict[str, List['TrainingSample']] = {}
+    for sample in list_training_samples(Species(species)):
+        by_name.setdefault(sample.name, []).append(sample)
+
+    rng = random.Random(seed)
+    train, test = [], []
+    for name, samples in sorted(by_name.items()):
+        rng.shuffle(samples)
+        num_test = min(max(1, round(len(samples) * test_fraction)), len(samples) - 1)
+        test += samples[:num_test]
+        train += samples[num_test:]
+    return Split(species=species, train=train, test=test)
+
+
+def load_embeddings(split: Split, config: EmbeddingConfig, batch_size: int, cache_dir: str) -> Embeddings:
+    """
+    Returns the cached embeddings of both splits for config, computing them if the split or the backbone changed.
+    """
+    cache_file = os.path.join(cache_dir, f'{__cache_key(split, config)}.npz')
+    if os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        return Embeddings(
+            train=cached['train'], test=cached['test'],
+            ms_per_image=float(cached['ms_per_image']), model_mb=float(cached['model_mb'])
+        )
+
+    runner, model_mb = build_runner(config)
+    train, train_seconds = embed(split.train, runner, batch_size)
+    test, test_seconds = embed(split.test, runner, batch_size)
+    embeddings = Embeddings(
+        train=train, test=test,
+        ms_per_image=(train_seconds + test_seconds) * 1000 / max(1, len(train) + len(test)),
+        model_mb=model_mb
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f'{cache_file}.tmp.npz'
+    np.savez(tmp_file, **embeddings._asdict())
+    os.replace(tmp_file, cache_file)
+    return embeddings
+
+
+def build_runner(config: EmbeddingConfig) -> Tuple[Callable[[np.ndarray], np.ndarray], float]:
+    """
+    Returns a function from a batch of normalised images to embeddings, and the size of the model in megabytes.
+    """
+    import torch
+
+    backbone = __load_torch_backbone(config.backbone)
+    example = torch.zeros(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    fp32_mb = sum(p.numel() * p.element_size() for p in backbone.parameters()) / (1024 * 1024)
+
+    if config.quantization not in SUPPORTED_QUANTIZATION[config.backend]:
+        raise ValueError(f'{config.backend} does not support {config.quantization}.')
+
+    if config.backend == 'eager':
+        def run_eager(batch: np.ndarray) -> np.ndarray:
+            with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=config.quantization == 'bf16'):
+                return backbone(torch.from_numpy(batch)).float().flatten(start_dim=1).numpy()
+        return run_eager, fp32_mb
+
+    if config.backend == 'torchscript':
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(backbone, example))
+
+        def run_torchscript(batch: np.ndarray) -> np.ndarray:
+            with torch.no_grad():
+                return scripted(torch.from_numpy(batch)).flatten(start_dim=1).numpy()
+        return run_torchscript, fp32_mb
+
+    if config.backend == 'onnx':
+        import onnxruntime
+
+        model_dir = tempfile.mkdtemp(prefix='evaluate_onnx_')
+        model_file = os.path.join(model_dir, 'backbone.onnx')
+        torch.onnx.export(
+            backbone, example, model_file, input_names=['images'], output_names=['embeddings'],
+            dynamic_axes={'images': {0: 'batch'}, 'embeddings': {0: 'batch'}}
+        )
+        if config.quantization == 'int8':
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantized_file = os.path.join(model_dir, 'backbone_int8.onnx')
+            quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QUInt8)
+            model_file = quantized_file
+        session = onnxruntime.InferenceSession(model_file, providers=['CPUExecutionProvider'])
+
+        def run_onnx(batch: np.ndarray) -> np.ndarray:
+            return session.run(['embeddings'], {'images': batch})[0].reshape(len(batch), -1)
+        return run_onnx, os.path.getsize(model_file) / (1024 * 1024)
+
+    raise ValueError(f'Unknown backend {config.backend}.')
+
+
+def embed(
+        samples: List['TrainingSample'],
+        runner: Callable[[np.ndarray], np.ndarray],
+        batch_size: int
+) -> Tuple[np.ndarray, float]:
+    """
+    Returns the L2 normalised embeddings of the images, and the seconds spent in the model, excluding decoding.
+    """
+    from sklearn.preprocessing import normalize
+    from torch.utils.data import DataLoader
+
+    data_loader = DataLoader(TrainingImages(samples), batch_size=batch_size, shuffle=False, num_workers=2)
+    embeddings = []
+    model_seconds = 0.0
+    for image_batch, _ in data_loader:
+        start_time = time.perf_counter()
+        embeddings.append(runner(image_batch.numpy()))
+        model_seconds += time.perf_counter() - start_time
+    return normalize(np.concatenate(embeddings)), model_seconds
+
+
+class TrainingImages:
+    """
+    Training images transformed for the backbone, read by a DataLoader.
+    """
+
+    def __init__(self, samples: List['TrainingSample']):
+        self.samples = samples
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def __getitem__(self, idx: int):
+        from api.predictions.predict_individual import LocalImageDataset
+        from api.training_shards import read_training_image
+
+        image = read_training_image(self.samples[idx], (IMAGE_SIZE, IMAGE_SIZE))
+        return LocalImageDataset.transform(image), 0
+
+
+class IvfIndex:
+    """
+    Approximate nearest neighbour search over an inverted file index. Training embeddings are clustered with k-means,
+    and each query is only compared with the members of its `probes` nearest clusters.
+    """
+
+    def __init__(self, embeddings: np.ndarray, probes: int = 4, seed: int = 0):
+        from sklearn.cluster import MiniBatchKMeans
+
+        num_lists = max(1, int(math.sqrt(len(embeddings))))
+        self.probes = min(probes, num_lists)
+        self.embeddings = embeddings
+        self.kmeans = MiniBatchKMeans(n_clusters=num_lists, random_state=seed, n_init=3).fit(embeddings)
+        self.lists = [np.flatnonzero(self.kmeans.labels_ == idx) for idx in range(num_lists)]
+
+    def kneighbors(self, queries: np.ndarray, n_neighbors: int) -> np.ndarray:
+        centroid_distances = self.kmeans.transform(queries)
+        results = []
+        for query, distances in zip(queries, centroid_distances):
+            candidates = np.concatenate([self.lists[idx] for idx in np.argsort(distances)[:self.probes]])
+            candidate_distances = np.linalg.norm(self.embeddings[candidates] - query, axis=1)
+            results.append(candidates[np.argsort(candidate_distances)[:n_neighbors]])
+        return results
+
+    def nbytes(self) -> int:
+        return self.embeddings.nbytes + self.kmeans.cluster_centers_.nbytes
+
+
+def evaluate_matcher(
+        split: Split,
+        embeddings: Embeddings,
+        pca: Optional[Union[int, float]],
+        matcher: str
+) -> Tuple[np.ndarray, float, float]:
+    """
+    Returns the rank of the true individual for each held-out image, or TOP_K if it is not in the top TOP_K, along
+    with the matching milliseconds per query and the index size in megabytes.
+    """
+    from sklearn.decomposition import PCA
+    from sklearn.neighbors import NearestNeighbors
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    steps = [('scaler', StandardScaler())]
+    if pca is not None:
+        steps.append(('pca', PCA(n_components=min(pca, *embeddings.train.shape) if pca >= 1 else pca)))
+    transform = Pipeline(steps).fit(embeddings.train)
+    train = transform.transform(embeddings.train).astype(np.float32)
+    n_neighbors = min(NUM_NEIGHBOURS, len(train))
+
+    if matcher == 'exact':
+        index = NearestNeighbors(n_neighbors=n_neighbors, algorithm='brute').fit(train)
+        index_bytes = train.nbytes
+    elif matcher == 'ivf':
+        index = IvfIndex(train)
+        index_bytes = index.nbytes()
+    else:
+        raise ValueError(f'Unknown matcher {matcher}.')
+
+    start_time = time.perf_counter()
+    test = transform.transform(embeddings.test).astype(np.float32)
+    if matcher == 'exact':
+        neighbours = index.kneighbors(test, n_neighbors=n_neighbors, return_distance=False)
+    else:
+        neighbours = index.kneighbors(test, n_neighbors=n_neighbors)
+    match_seconds = time.perf_counter() - start_time
+
+    train_names = [e.name for e in split.train]
+    ranks = []
+    for example, row in zip(split.test, neighbours):
+        # Individuals are ranked by their nearest training image.
+        ranked_names = list(dict.fromkeys(train_names[idx] for idx in row))[:TOP_K]
+        ranks.append(ranked_names.index(example.name) if example.name in ranked_names else TOP_K)
+    return np.array(ranks), match_seconds * 1000 / max(1, len(test)), index_bytes / (1024 * 1024)
+
+
+def run_sweep(
+        splits: List[Split],
+        embedding_configs: List[EmbeddingConfig],
+        pca_sizes: List[Optional[Union[int, float]]],
+        matchers: List[str],
+        batch_size: int,
+        cache_dir: str
+) -> List[EvaluationResult]:
+    results = []
+    for config in embedding_configs:
+        if config.quantization not in SUPPORTED_QUANTIZATION[config.backend]:
+            print(f'Skipping {"/".join(config)}: {config.backend} does not support {config.quantization}.',
+                  file=sys.stderr)
+            continue
+        embeddings = {s.species: load_embeddings(s, config, batch_size, cache_dir) for s in splits}
+
+        for pca, matcher in itertools.product(pca_sizes, matchers):
+            print(f'Evaluating {"/".join(config)} with pca={pca} and matcher={matcher}.', file=sys.stderr)
+            ranks, match_ms, index_mb, per_species = [], 0.0, 0.0, {}
+            for split in splits:
+                species_ranks, species_match_ms, species_index_mb = evaluate_matcher(
+                    split, embeddings[split.species], pca, matcher
+                )
+                ranks.append(species_ranks)
+                match_ms += species_match_ms * len(species_ranks)
+                index_mb += species_index_mb
+                per_species[split.species] = {
+                    'top1': float(np.mean(species_ranks < 1)),
+                    'top5': float(np.mean(species_ranks < TOP_K)),
+                }
+
+            all_ranks = np.concatenate(ranks)
+            results.append(EvaluationResult(
+                backbone=config.backbone,
+                backend=config.backend,
+                quantization=config.quantization,
+                pca=str(pca).lower(),
+                matcher=matcher,
+                test_images=len(all_ranks),
+                top1=float(np.mean(all_ranks < 1)),
+                top5=float(np.mean(all_ranks < TOP_K)),
+                embed_ms_per_image=float(np.mean([e.ms_per_image for e in embeddings.values()])),
+                match_ms_per_query=match_ms / max(1, len(all_ranks)),
+                model_mb=max(e.model_mb for e in embeddings.values()),
+                index_mb=index_mb,
+                species=per_species,
+            ))
+    return results
+
+
+def format_table(results: List[EvaluationResult]) -> str:
+    rows = [[name for name, _ in TABLE_COLUMNS]]
+    for result in results:
+        rows.append([fmt.format(result[name]) for name, fmt in TABLE_COLUMNS])
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(TABLE_COLUMNS))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+
+def parse_pca(value: str) -> Optional[Union[int, float]]:
+    if value.lower() == 'none':
+        return None
+    return float(value) if '.' in value else int(value)
+
+
+def main() -> None:
+    from api.data_models.species import list_species
+
+    known_species = [s.value for s in list_species()]
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--species', nargs='+', default=known_species, choices=known_species)
+    parser.add_argument('--backbones', nargs='+', default=['simclr'], choices=BACKBONES)
+    parser.add_argument('--backends', nargs='+', default=['eager'], choices=BACKENDS)
+    parser.add_argument('--quantization', nargs='+', default=['fp32'], choices=QUANTIZATION)
+    parser.add_argument('--pca', nargs='+', type=parse_pca, default=[0.95],
+                        help='PCA components, a fraction of explained variance, or none.')
+    parser.add_argument('--matchers', nargs='+', default=['exact'], choices=MATCHERS)
+    parser.add_argument('--test-fraction', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--cache-dir', default='.cache/evaluation')
+    parser.add_argument('--output', default=None, help='Also write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    splits = [split_species(species, args.test_fraction, args.seed) for species in args.species]
+    splits = [s for s in splits if len(s.test) > 0]
+    if len(splits) == 0:
+        parser.error('No individuals with more than one training image were found.')
+    for split in splits:
+        print(f'{split.species}: {len(split.train)} training and {len(split.test)} held-out images.', file=sys.stderr)
+
+    embedding_configs = [
+        EmbeddingConfig(*config) for config in itertools.product(args.backbones, args.backends, args.quantization)
+    ]
+    results = run_sweep(splits, embedding_configs, args.pca, args.matchers, args.batch_size, args.cache_dir)
+    print(format_table(results))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'benchmark': 'evaluate',
+                'created_at': time.time(),
+                'test_fraction': args.test_fraction,
+                'seed': args.seed,
+                'peak_rss_mb': peak_rss_mb(),
+                'results': results,
+            }, f, indent=2)
+
+
+def __cache_key(split: Split, config: EmbeddingConfig) -> str:
+    from api.predictions.models import BACKBONE_PATH
+
+    digest = hashlib.sha1()
+    for example in split.train + [None] + split.test:
+        digest.update(repr(example).encode())
+    if config.backbone == 'simclr':
+        # Retraining the backbone invalidates its embeddings.
+        digest.update(str(os.path.getmtime(BACKBONE_PATH)).encode())
+    return f'{split.species}_{"_".join(config)}_{digest.hexdigest()[:16]}'
+
+
+def __load_torch_backbone(name: str):
+    import torch
+    import torchvision
+
+    if name == 'simclr':
+        from api.predictions.models import load_backbone
+        backbone, _ = load_backbone()
+        return backbone.cpu().eval()
+    if name == 'imagenet':
+        resnet18 = torchvision.models.resnet18(pretrained=True)
+        return torch.nn.Sequential(*list(resnet18.children())[:-1]).eval()
+    raise ValueError(f'Unknown backbone {name}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Offline end-to-end benchmark of the prediction pipeline.
+
+Runs decode, detect, render, embed, classify and save stages on synthetic camera-trap JPEGs, with randomly initialised
+YOLOv5 and ResNet18 weights and an in-memory Redis stand-in. The render stage runs the production `render_outputs`, so
+it covers decoding each source once, cropping, drawing the annotated image and writing both. Its decode, crop and
+encode, annotate and encode, and write steps are also reported on their own under `render_stages`. Each configuration
+runs in a fresh process so that peak RSS is measured per configuration. Results are printed as JSON.
+
+YOLOv5 is loaded from a local checkout, by default the torch hub cache, so no network access is needed:
+
+    python -m benchmarks.pipeline --sizes 10 50 --batch-sizes 1 16
+    python -m benchmarks.pipeline --yolov5-dir ~/src/yolov5 --output pipeline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, TypedDict
+
+from benchmarks.common import StageResult, timed, observed_stages, peak_rss_mb, make_synthetic_jpegs, \
+    use_in_memory_redis
+
+DETECTOR_INPUT_SIZE = 640
+NUM_CLASSIFIER_LABELS = 20
+NUM_CLASSIFIER_EXAMPLES = 200
+
+
+class PipelineConfig(NamedTuple):
+    collection_size: int
+    batch_size: int
+    image_width: int
+    image_height: int
+    detections_per_image: int
+    torch_threads: Optional[int]
+    yolov5_dir: Optional[str]
+
+
+class PipelineResult(TypedDict):
+    config: Dict
+    stages: Dict[str, StageResult]
+    # Steps of the render stage, as timed by the production code.
+    render_stages: Dict[str, StageResult]
+    total_seconds: float
+    images_per_second: float
+    peak_rss_mb: float
+
+
+def run_configuration(config: PipelineConfig) -> PipelineResult:
+    import numpy as np
+    import torch
+    import torchvision
+    from sklearn.decomposition import PCA
+    from sklearn.neighbors import KNeighborsClassifier
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    from api.data_models.annotations import Annotation, save_annotations_for_collection
+    from api.data_models.prediction_inputs import read_images
+    from api.predictions import predict_bounding_boxes
+    from api.predictions.predict_bounding_boxes import BoundingBox, RenderTask, render_outputs
+    from api.predictions.predict_individual import images_to_embeddings
+
+    use_in_memory_redis()
+    if config.torch_threads is not None:
+        torch.set_num_threads(config.torch_threads)
+    device = torch.device('cpu')
+    stages: Dict[str, StageResult] = {}
+    render_stages: Dict[str, StageResult] = {}
+    num_images = config.collection_size
+    num_detections = num_images * config.detections_per_image
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_names = make_synthetic_jpegs(
+            os.path.join(tmp_dir, 'inputs'), num_images, size=(config.image_width, config.image_height)
+        )
+
+        with timed(stages, 'decode', num_images):
+            input_images = read_images(file_names)
+
+        if config.yolov5_dir is not None:
+            detector = torch.hub.load(
+                config.yolov5_dir, 'yolov5s', source='local', pretrained=False, classes=3, autoshape=True
+            )
+            with timed(stages, 'detect', num_images):
+                for idx in range(0, num_images, config.batch_size):
+                    batch = [i.resized_image for i in input_images[idx:idx + config.batch_size]]
+                    detector(batch, size=DETECTOR_INPUT_SIZE).pandas()
+
+        # Randomly initialised weights detect nothing useful, so crop fixed boxes instead.
+        bboxes = []
+        for idx in range(config.detections_per_image):
+            w, h = config.image_width / 4, config.image_height / 4
+            bboxes.append(BoundingBox(x=idx * w / 2, y=idx * h / 2, w=w, h=h))
+
+        tasks = []
+        for input_image in input_images:
+            for idx, bbox in enumerate(bboxes):
+                name = f'{idx}_{os.path.basename(input_image.file_name)}'
+                tasks.append(RenderTask(
+                    file_name=input_image.file_name,
+                    cropped_file_name=os.path.join(tmp_dir, 'cropped', name),
+                    annotated_file_name=os.path.join(tmp_dir, 'annotated', os.path.basename(input_image.file_name)),
+                    bbox=bbox
+                ))
+        # Outputs stay on local disk, even when S3 is configured.
+        predict_bounding_boxes.s3_bucket = None
+        with timed(stages, 'render', num_detections), observed_stages(render_stages, predict_bounding_boxes):
+            render_outputs(tasks)
+        crop_file_names = [t.cropped_file_name for t in tasks]
+
+        resnet18 = torchvision.models.resnet18()
+        backbone = torch.nn.Sequential(*list(resnet18.children())[:-1]).to(device).eval()
+        with timed(stages, 'embed', num_detections):
+            embeddings = images_to_embeddings(backbone, device, crop_file_names, batch_size=config.batch_size)
+
+        rng = np.random.default_rng(0)
+        classifier = Pipeline([
+            ('scaler', StandardScaler()),
+            ('pca', PCA(0.9)),
+            ('KNN', KNeighborsClassifier(n_neighbors=1)),
+        ]).fit(
+            rng.normal(size=(NUM_CLASSIFIER_EXAMPLES, embeddings.shape[1])),
+            rng.integers(0, NUM_CLASSIFIER_LABELS, size=NUM_CLASSIFIER_EXAMPLES)
+        )
+        with timed(stages, 'classify', num_detections):
+            predicted_labels = classifier.predict(embeddings)
+
+        with timed(stages, 'save', num_detections):
+            save_annotations_for_collection('benchmark', [
+                Annotation(
+                    id=os.path.basename(crop_file_name).removesuffix('.jpg'),
+                    file_name=crop_file_name,
+                    annotated_file_name=None,
+                    cropped_file_name=crop_file_name,
+                    bbox=list(bboxes[0]),
+                    species_confidence=1.0,
+                    predicted_species='Crocuta_crocuta',
+                    predicted_name=str(label),
+                    accepted=False,
+                    ignored=False,
+                )
+                for crop_file_name, label in zip(crop_file_names, predicted_labels)
+            ])
+
+    total_seconds = sum(s['seconds'] for s in stages.values())
+    return PipelineResult(
+        config=config._asdict(),
+        stages=stages,
+        render_stages=render_stages,
+        total_seconds=total_seconds,
+        images_per_second=num_images / total_seconds,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def run_isolated(config: PipelineConfig) -> PipelineResult:
+    # A fresh interpreter per configuration keeps peak RSS from leaking between configurations.
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run_configuration, (config,))
+
+
+def default_yolov5_dir() -> Optional[str]:
+    import torch
+    yolov5_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+    return yolov5_dir if os.path.isdir(yolov5_dir) else None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50], help='Collection sizes, in images.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--image-size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--detections-per-image', type=int, default=2)
+    parser.add_argument('--torch-threads', type=int, default=None)
+    parser.add_argument('--yolov5-dir', default=None, help='Local YOLOv5 checkout. Defaults to the torch hub cache.')
+    parser.add_argument('--skip-detect', action='store_true')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    yolov5_dir = None
+    if not args.skip_detect:
+        yolov5_dir = args.yolov5_dir or default_yolov5_dir()
+        if yolov5_dir is None:
+            parser.error('No local YOLOv5 checkout found. Pass --yolov5-dir or --skip-detect.')
+
+    results: List[PipelineResult] = []
+    for collection_size in args.sizes:
+        for batch_size in args.batch_sizes:
+            config = PipelineConfig(
+                collection_size=collection_size,
+                batch_size=batch_size,
+                image_width=args.image_size[0],
+                image_height=args.image_size[1],
+                detections_per_image=args.detections_per_image,
+                torch_threads=args.torch_threads,
+                yolov5_dir=yolov5_dir,
+            )
+            print(f'Running {config}.', file=sys.stderr)
+            results.append(run_isolated(config))
+
+    report = json.dumps({
+        'benchmark': 'pipeline',
+        'created_at': time.time(),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""
+Throughput benchmark for retraining the embeddings backbone and refitting the species classifiers.
+
+Packs synthetic crops into training data shards in a scratch directory, then for every combination of dataset size,
+batch size and DataLoader workers measures, with a randomly initialised `SimCLRModel`:
+
+- load:    samples per second that `EmbeddingsTrainDataset` and the SimCLR collate function deliver, with no model
+- compute: samples per second of SimCLR training steps on batches that are already in memory
+- fit:     seconds per epoch of the same Lightning `Trainer` fit that `retrain_embeddings` runs, in each training mode
+- cache:   with `--modes partial`, seconds to cache the activations of the frozen backbone layers
+
+For every dataset size it also embeds `ClassifierTrainDataset` and times the grid search of
+`retrain_classifier_for_species`. Each configuration runs in a fresh process so that peak RSS is measured per
+configuration. Results are printed as JSON.
+
+    python -m benchmarks.retraining
+    python -m benchmarks.retraining --samples 320 1280 --batch-sizes 32 64 --workers 0 2 4 --epochs 2
+    python -m benchmarks.retraining --samples 64 --batch-sizes 64 --workers 2 --modes full partial --skip-classifier
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Optional, TypedDict
+
+from benchmarks.common import StageResult, timed, peak_rss_mb, make_synthetic_jpegs
+
+# Training steps on in-memory batches cycle through this many batches, so memory stays flat for large datasets.
+COMPUTE_BATCHES = 3
+
+
+class TrainingConfig(NamedTuple):
+    samples: int
+    batch_size: int
+    workers: int
+    epochs: int
+    torch_threads: Optional[int]
+    skip_fit: bool
+    mode: str
+
+
+class TrainingResult(TypedDict):
+    config: Dict
+    stages: Dict[str, StageResult]
+    seconds_per_epoch: Optional[float]
+    # Whether the DataLoader delivers samples more slowly than the model consumes them.
+    load_bound: bool
+    peak_rss_mb: float
+    peak_loader_rss_mb: float
+
+
+class ClassifierResult(TypedDict):
+    samples: int
+    individuals: int
+    stages: Dict[str, StageResult]
+    peak_rss_mb: float
+
+
+def species_for_size(samples: int) -> str:
+    return f'Synthetic_{samples}'
+
+
+def write_training_data(samples: List[int], individuals: int, crop_size: List[int]) -> None:
+    """
+    Packs one species per dataset size into a shard, so each classifier trains on exactly that many crops.
+    """
+    from api.data_models.species import Species
+    from api.training_shards import write_training_shard
+
+    for num_samples in samples:
+        species = species_for_size(num_samples)
+        file_names = make_synthetic_jpegs(
+            os.path.join('crops', species), num_samples, size=(crop_size[0], crop_size[1]), seed=num_samples
+        )
+        write_training_shard(Species(species), [
+            (f'individual_{idx % individuals}/{os.path.basename(f)}', f) for idx, f in enumerate(file_names)
+        ])
+
+
+def random_simclr_model():
+    import torch.nn as nn
+    import torchvision
+    from lightly.models.modules.heads import SimCLRProjectionHead
+
+    from api.retraining.retrain_embeddings import SimCLRModel
+
+    resnet18 = torchvision.models.resnet18()
+    return SimCLRModel(nn.Sequential(*list(resnet18.children())[:-1]), SimCLRProjectionHead(512, 512, 128))
+
+
+def run_training(config: TrainingConfig) -> TrainingResult:
+    import lightly
+    import torch
+    from pytorch_lightning import Trainer
+    from torch.utils.data import DataLoader
+
+    from api.retraining.embeddings_train_dataset import EmbeddingsTrainDataset
+    from api.retraining.retrain_embeddings import SimCLRModel, cache_frozen_activations, FROZEN_BACKBONE_MODULES, \
+        PARTIAL_CACHED_VIEW_PAIRS
+
+    if config.torch_threads is not None:
+        torch.set_num_threads(config.torch_threads)
+    stages: Dict[str, StageResult] = {}
+    dataset = EmbeddingsTrainDataset(new_annotations=[], num2sample=config.samples)
+    data_loader = DataLoader(
+        dataset,
+        batch_size=config.batch_size,
+        shuffle=True,
+        collate_fn=lightly.data.SimCLRCollateFunction(input_size=224),
+        drop_last=True,
+        num_workers=config.workers
+    )
+    samples_per_epoch = len(data_loader) * config.batch_size
+
+    batches = []
+    with timed(stages, 'load', samples_per_epoch):
+        for batch in data_loader:
+            if len(batches) < COMPUTE_BATCHES:
+                batches.append(batch)
+
+    model = random_simclr_model()
+    [optimizer], _ = model.configure_optimizers()
+    model.train()
+    with timed(stages, 'compute', samples_per_epoch):
+        for (x0, x1), _, _ in itertools.islice(itertools.cycle(batches), len(data_loader)):
+            loss = model.criterion(model(x0), model(x1))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+    seconds_per_epoch = None
+    if not config.skip_fit:
+        model = random_simclr_model()
+        fit_loader = data_loader
+        if config.mode == 'partial':
+            with timed(stages, 'cache', config.samples * PARTIAL_CACHED_VIEW_PAIRS):
+                activations = cache_frozen_activations(model.backbone[:FROZEN_BACKBONE_MODULES], dataset)
+            fit_loader = DataLoader(activations, batch_size=config.batch_size, shuffle=True, drop_last=True)
+            model = SimCLRModel(model.backbone[FROZEN_BACKBONE_MODULES:], model.projection_head)
+        trainer = Trainer(
+            max_epochs=config.epochs,
+            gpus=1 if torch.cuda.is_available() else 0,
+            logger=False,
+            enable_checkpointing=False,
+            enable_progress_bar=False,
+            enable_model_summary=False
+        )
+        with timed(stages, 'fit', samples_per_epoch * config.epochs):
+            trainer.fit(model, fit_loader)
+        seconds_per_epoch = stages['fit']['seconds'] / config.epochs
+
+    return TrainingResult(
+        config=config._asdict(),
+        stages=stages,
+        seconds_per_epoch=seconds_per_epoch,
+        load_bound=stages['load']['items_per_second'] < stages['compute']['items_per_second'],
+        peak_rss_mb=peak_rss_mb(),
+        peak_loader_rss_mb=peak_rss_mb(children=True),
+    )
+
+
+def run_classifier(samples: int, torch_threads: Optional[int]) -> ClassifierResult:
+    import torch
+    from torch.utils.data import DataLoader
+
+    from api.data_models.species import Species
+    from api.retraining.classifier_train_dataset import ClassifierTrainDataset
+    from api.retraining.retrain_classifier import generate_embeddings, retrain_classifier_for_species, \
+        CLASSIFIER_EMBEDDING_BATCH_SIZE
+
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    stages: Dict[str, StageResult] = {}
+    species = Species(species_for_size(samples))
+    # Batched the same way as `retrain_classifier_job`.
+    dataset = ClassifierTrainDataset(species, [])
+    data_loader = DataLoader(dataset, batch_size=CLASSIFIER_EMBEDDING_BATCH_SIZE, shuffle=False, num_workers=0)
+    with timed(stages, 'embed', len(dataset)):
+        embeddings, labels = generate_embeddings(random_simclr_model().backbone, data_loader)
+
+    os.makedirs('models', exist_ok=True)
+    with timed(stages, 'grid_search', len(dataset)):
+        retrain_classifier_for_species(species, embeddings, labels)
+
+    return ClassifierResult(
+        samples=samples,
+        individuals=len(dataset.labels),
+        stages=stages,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def run_isolated(function, *args):
+    # A fresh interpreter per configuration keeps peak RSS from leaking between configurations.
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, nargs='+', default=[320, 1280], help='Training dataset sizes.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 64])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4], help='DataLoader worker counts.')
+    parser.add_argument('--epochs', type=int, default=1, help='Epochs of each timed Trainer fit.')
+    parser.add_argument('--individuals', type=int, default=20, help='Individuals the crops are spread across.')
+    parser.add_argument('--crop-size', type=int, nargs=2, default=[320, 240], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--torch-threads', type=int, default=None)
+    parser.add_argument('--skip-fit', action='store_true', help='Only measure loading and compute throughput.')
+    parser.add_argument('--modes', nargs='+', choices=['full', 'partial'], default=['full'],
+                        help='Embedding training modes to fit in.')
+    parser.add_argument('--skip-classifier', action='store_true')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    # The datasets read training data relative to the working directory, so run inside a scratch directory.
+    repo_dir = os.getcwd()
+    sys.path.insert(0, repo_dir)
+    training_results: List[TrainingResult] = []
+    classifier_results: List[ClassifierResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            write_training_data(args.samples, args.individuals, args.crop_size)
+            for samples, batch_size, workers, mode in itertools.product(
+                    args.samples, args.batch_sizes, args.workers, args.modes
+            ):
+                if batch_size > samples:
+                    continue
+                config = TrainingConfig(
+                    samples=samples,
+                    batch_size=batch_size,
+                    workers=workers,
+                    epochs=args.epochs,
+                    torch_threads=args.torch_threads,
+                    skip_fit=args.skip_fit,
+                    mode=mode,
+                )
+                print(f'Running {config}.', file=sys.stderr)
+                training_results.append(run_isolated(run_training, config))
+            if not args.skip_classifier:
+                for samples in args.samples:
+                    print(f'Running classifier refit on {samples} samples.', file=sys.stderr)
+                    classifier_results.append(run_isolated(run_classifier, samples, args.torch_threads))
+        finally:
+            os.chdir(repo_dir)
+
+    report = json.dumps({
+        'benchmark': 'retraining',
+        'created_at': time.time(),
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'training': training_results,
+        'classifier': classifier_results,
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
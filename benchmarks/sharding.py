@@ -0,0 +1,169 @@
+"""
+Scaling benchmark for sharded predictions across worker processes.
+
+Runs bounding box and individual predictions on a synthetic collection with 1 to N worker processes, using randomly
+initialised YOLOv5 and ResNet18 weights, and reports throughput and speedup over the smallest pool. Results are
+printed as JSON.
+
+    python -m benchmarks.sharding --workers 1 2 4 8 --images 64
+"""
+import argparse
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, TypedDict, Optional
+
+from benchmarks.common import make_synthetic_jpegs
+from benchmarks.pipeline import default_yolov5_dir
+
+COLLECTION_ID = 'benchmark'
+NUM_CLASSIFIER_LABELS = 20
+NUM_CLASSIFIER_EXAMPLES = 200
+
+
+class ScalingResult(TypedDict):
+    workers: int
+    threads_per_worker: int
+    detect_seconds: float
+    detect_images_per_second: float
+    identify_seconds: float
+    identify_crops_per_second: float
+    speedup: Dict[str, float]
+
+
+def use_random_models(yolov5_dir: str) -> None:
+    """
+    Runs in each worker process, replacing the trained models with randomly initialised ones.
+    """
+    import numpy as np
+    import torch
+    import torchvision
+    from sklearn.neighbors import KNeighborsClassifier
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    from api.predictions import predict_bounding_boxes, predict_individual
+
+    detector = torch.hub.load(yolov5_dir, 'yolov5s', source='local', pretrained=False, classes=3, autoshape=True)
+    resnet18 = torchvision.models.resnet18()
+    backbone = torch.nn.Sequential(*list(resnet18.children())[:-1]).eval()
+    rng = np.random.default_rng(0)
+    classifier = Pipeline([('scaler', StandardScaler()), ('KNN', KNeighborsClassifier(n_neighbors=1))]).fit(
+        rng.normal(size=(NUM_CLASSIFIER_EXAMPLES, 512)),
+        rng.integers(0, NUM_CLASSIFIER_LABELS, size=NUM_CLASSIFIER_EXAMPLES)
+    )
+    labels = [f'individual_{idx}' for idx in range(NUM_CLASSIFIER_LABELS)]
+
+    predict_bounding_boxes.load_detector = lambda: detector
+    predict_individual.load_backbone = lambda: (backbone, torch.device('cpu'))
+    predict_individual.load_classifier = lambda species: classifier
+    predict_individual.load_labels = lambda species: labels
+
+
+def run_workers(
+        workers: int,
+        threads_per_worker: int,
+        yolov5_dir: str,
+        crop_file_names: List[str]
+) -> ScalingResult:
+    from api.predictions.predict_bounding_boxes import YolovPrediction, predict_bounding_boxes_for_collection
+    from api.predictions.predict_individual import predict_individuals_from_yolov_predictions
+    from api.predictions.sharding import create_prediction_pool
+
+    pool = create_prediction_pool(workers, threads_per_worker, setup=functools.partial(use_random_models, yolov5_dir))
+    crops = [
+        YolovPrediction(
+            file_name=file_name,
+            id=os.path.basename(file_name),
+            annotated_file_name=None,
+            cropped_file_name=file_name,
+            bbox=None,
+            confidence=1.0,
+            predicted_species='Crocuta_crocuta'
+        )
+        for file_name in crop_file_names
+    ]
+    try:
+        # Start every worker and load its models before timing.
+        predict_individuals_from_yolov_predictions(crops[:workers * 4], pool=pool)
+
+        start_time = time.perf_counter()
+        num_images = len(predict_bounding_boxes_for_collection(COLLECTION_ID, pool=pool))
+        detect_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        predict_individuals_from_yolov_predictions(crops, pool=pool)
+        identify_seconds = time.perf_counter() - start_time
+    finally:
+        pool.executor.shutdown()
+
+    return ScalingResult(
+        workers=workers,
+        threads_per_worker=threads_per_worker,
+        detect_seconds=detect_seconds,
+        detect_images_per_second=num_images / detect_seconds,
+        identify_seconds=identify_seconds,
+        identify_crops_per_second=len(crops) / identify_seconds,
+        speedup={},
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads-per-worker', type=int, default=None, help='Defaults to CPU count / workers.')
+    parser.add_argument('--images', type=int, default=64)
+    parser.add_argument('--crops', type=int, default=256)
+    parser.add_argument('--image-size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--yolov5-dir', default=None, help='Local YOLOv5 checkout. Defaults to the torch hub cache.')
+    parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout.')
+    args = parser.parse_args()
+
+    yolov5_dir: Optional[str] = args.yolov5_dir or default_yolov5_dir()
+    if yolov5_dir is None:
+        parser.error('No local YOLOv5 checkout found. Pass --yolov5-dir.')
+
+    # Workers resolve the collection's paths relative to the working directory, so run inside a scratch directory.
+    repo_dir = os.getcwd()
+    sys.path.insert(0, repo_dir)
+    results: List[ScalingResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            make_synthetic_jpegs(
+                f'website-data/inputs/{COLLECTION_ID}', args.images, size=(args.image_size[0], args.image_size[1])
+            )
+            crop_file_names = make_synthetic_jpegs('crops', args.crops, size=(320, 240), seed=1)
+            for workers in args.workers:
+                threads_per_worker = args.threads_per_worker or max(1, os.cpu_count() // workers)
+                print(f'Running with {workers} workers and {threads_per_worker} threads each.', file=sys.stderr)
+                results.append(run_workers(workers, threads_per_worker, yolov5_dir, crop_file_names))
+        finally:
+            os.chdir(repo_dir)
+
+    for result in results:
+        result['speedup'] = {
+            'detect': results[0]['detect_seconds'] / result['detect_seconds'],
+            'identify': results[0]['identify_seconds'] / result['identify_seconds'],
+        }
+
+    report = json.dumps({
+        'benchmark': 'sharding',
+        'created_at': time.time(),
+        'cpu_count': os.cpu_count(),
+        'images': args.images,
+        'crops': args.crops,
+        'results': results,
+    }, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report)
+
+
+if __name__ == '__main__':
+    main()
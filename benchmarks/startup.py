@@ -0,0 +1,84 @@
+"""
+Measures how long the api server takes to boot, and how much memory it uses, for each APP_ROLE.
+
+Each run imports `app` in a fresh interpreter, so nothing is shared between runs. Results are printed as JSON.
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --roles full --preload
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import List, TypedDict, Optional
+
+ML_MODULES = ['torch', 'torchvision', 'lightly', 'pytorch_lightning', 'sklearn', 'joblib']
+
+# Runs in the child interpreter. ru_maxrss is reported in kilobytes on Linux.
+CHILD_SCRIPT = '''
+import json, resource, sys, time
+start_time = time.perf_counter()
+import app
+import_seconds = time.perf_counter() - start_time
+preload_seconds = None
+if {preload}:
+    from api.predictions.models import preload_models
+    start_time = time.perf_counter()
+    preload_models()
+    preload_seconds = time.perf_counter() - start_time
+print(json.dumps({{
+    'import_seconds': import_seconds,
+    'preload_seconds': preload_seconds,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'ml_modules_loaded': [m for m in {ml_modules} if m in sys.modules],
+}}))
+'''
+
+
+class StartupResult(TypedDict):
+    role: str
+    runs: int
+    import_seconds_median: float
+    import_seconds_max: float
+    preload_seconds_median: Optional[float]
+    max_rss_mb_median: float
+    ml_modules_loaded: List[str]
+
+
+def measure_role(role: str, runs: int, preload: bool) -> StartupResult:
+    script = CHILD_SCRIPT.format(preload=preload and role == 'full', ml_modules=ML_MODULES)
+    env = {**os.environ, 'APP_ROLE': role}
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', script], env=env, check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    preload_samples = [s['preload_seconds'] for s in samples if s['preload_seconds'] is not None]
+    return StartupResult(
+        role=role,
+        runs=runs,
+        import_seconds_median=statistics.median(s['import_seconds'] for s in samples),
+        import_seconds_max=max(s['import_seconds'] for s in samples),
+        preload_seconds_median=statistics.median(preload_samples) if len(preload_samples) > 0 else None,
+        max_rss_mb_median=statistics.median(s['max_rss_mb'] for s in samples),
+        ml_modules_loaded=samples[-1]['ml_modules_loaded'],
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--roles', nargs='+', default=['metadata', 'full'])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--preload', action='store_true', help='Also time loading every model in the full role.')
+    args = parser.parse_args()
+
+    results = [measure_role(role, args.runs, args.preload) for role in args.roles]
+    print(json.dumps({'benchmark': 'startup', 'python': sys.version.split()[0], 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Production entry point for the api server.
+
+The master process loads every model and then forks SERVER_WORKERS worker processes, which share the model weights
+copy-on-write. Each worker serves requests on its own threads. Prediction requests run in a separate, smaller pool of
+slots, so a slow prediction run never holds up lightweight endpoints such as /api/v1/collections.
+"""
+import logging
+import glob
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Dict
+
+from prometheus_client import multiprocess
+from werkzeug.serving import make_server
+
+from api.endpoints.predictions import RECEIVED_AT_ENVIRON_KEY
+from api.metrics import PROMETHEUS_MULTIPROC_DIR
+from api.predictions.models import preload_models
+from api.predictions.sharding import SERVER_WORKERS
+from app import app, APP_HOST, APP_PORT, APP_ROLE, clear_retraining_state
+
+logger = logging.getLogger(__name__)
+
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '16'))
+PREDICTION_THREADS = int(os.getenv('PREDICTION_THREADS', '1'))
+TORCH_THREADS = int(os.getenv('TORCH_THREADS', str(max(1, os.cpu_count() // SERVER_WORKERS))))
+
+PREDICTION_PATHS = {'/api/v1/predictions'}
+
+
+class RequestPools:
+    """
+    WSGI middleware that limits how many requests of each kind a worker handles at once.
+    Prediction requests and all other requests are counted separately.
+    """
+
+    def __init__(self, wsgi_app, threads: int, prediction_threads: int):
+        self.wsgi_app = wsgi_app
+        self.__pools: Dict[bool, threading.BoundedSemaphore] = {
+            False: threading.BoundedSemaphore(threads),
+            True: threading.BoundedSemaphore(prediction_threads),
+        }
+
+    def __call__(self, environ, start_response):
+        environ[RECEIVED_AT_ENVIRON_KEY] = time.time()
+        is_prediction = environ.get('PATH_INFO') in PREDICTION_PATHS
+        with self.__pools[is_prediction]:
+            return self.wsgi_app(environ, start_response)
+
+
+def run_worker(listen_socket: socket.socket) -> None:
+    if APP_ROLE == 'full':
+        import torch
+        torch.set_num_threads(TORCH_THREADS)
+    app.wsgi_app = RequestPools(app.wsgi_app, SERVER_THREADS, PREDICTION_THREADS)
+    server = make_server(APP_HOST, APP_PORT, app, threaded=True, fd=listen_socket.fileno())
+    logger.info(f'Worker {os.getpid()} started.')
+    server.serve_forever()
+
+
+def fork_worker(listen_socket: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            run_worker(listen_socket)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def main() -> None:
+    clear_retraining_state()
+    if PROMETHEUS_MULTIPROC_DIR is not None:
+        # Metrics from a previous run of the server must not be aggregated into this one.
+        for file_name in glob.glob(f'{PROMETHEUS_MULTIPROC_DIR}/*.db'):
+            os.remove(file_name)
+    if APP_ROLE == 'full':
+        logger.info('Preloading models.')
+        preload_models()
+
+    listen_socket = socket.create_server((APP_HOST, APP_PORT))
+    listen_socket.set_inheritable(True)
+    logger.info(f'Listening on {APP_HOST}:{APP_PORT} with {SERVER_WORKERS} workers.')
+
+    workers = {fork_worker(listen_socket) for _ in range(SERVER_WORKERS)}
+
+    def stop(signum, frame):
+        for worker_pid in workers:
+            os.kill(worker_pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Replace any worker that exits unexpectedly.
+    while True:
+        pid, status = os.wait()
+        if pid in workers:
+            workers.remove(pid)
+            if PROMETHEUS_MULTIPROC_DIR is not None:
+                multiprocess.mark_process_dead(pid)
+            logger.warning(f'Worker {pid} exited with status {status}, restarting.')
+            workers.add(fork_worker(listen_socket))
+
+
+if __name__ == '__main__':
+    main()
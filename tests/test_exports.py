@@ -0,0 +1,89 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import PIL.Image
+import pytest
+
+from api import exports, storage
+from api.data_models.annotations import Annotation, UNDETECTED
+from api.exports import plan_export, stream_tar, stream_zip
+
+
+def annotation(id: str, file_name: str, species: str, bbox, cropped_file_name) -> Annotation:
+    return Annotation(
+        id=id,
+        file_name=file_name,
+        annotated_file_name=None,
+        cropped_file_name=cropped_file_name,
+        bbox=bbox,
+        species_confidence=0.9,
+        predicted_species=species,
+        predicted_name=UNDETECTED if cropped_file_name is None else 'Zoe',
+        accepted=False,
+        ignored=False,
+    )
+
+
+@pytest.fixture
+def collection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, 's3_bucket', None)
+    for name, size in [('empty.jpg', (64, 48)), ('hyena.jpg', (320, 240))]:
+        os.makedirs('website-data/inputs/c', exist_ok=True)
+        PIL.Image.new('RGB', size).save(f'website-data/inputs/c/{name}')
+    crop = 'website-data/outputs/c/cropped/Crocuta_crocuta/hyena.jpg'
+    os.makedirs(os.path.dirname(crop))
+    PIL.Image.new('RGB', (30, 40)).save(crop)
+    annotations = [
+        annotation('1', 'website-data/inputs/c/empty.jpg', UNDETECTED, [0, 0, 0, 0], None),
+        annotation('2', 'website-data/inputs/c/hyena.jpg', 'Crocuta_crocuta', [10, 20, 30, 40], crop),
+    ]
+    monkeypatch.setattr(exports, 'read_annotations_for_collection', lambda collection_id: annotations)
+    return 'c'
+
+
+def test_tar_export_round_trips(collection):
+    plan = plan_export(collection, 'tar', 'json', ['inputs', 'cropped'])
+    data = b''.join(stream_tar(plan))
+
+    assert len(data) == plan.size
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert archive.getnames() == [
+            'c/annotations.json',
+            'c/inputs/empty.jpg',
+            'c/inputs/hyena.jpg',
+            'c/cropped/Crocuta_crocuta/hyena.jpg',
+        ]
+        with open('website-data/inputs/c/hyena.jpg', 'rb') as f:
+            assert archive.extractfile('c/inputs/hyena.jpg').read() == f.read()
+        assert [a['id'] for a in json.load(archive.extractfile('c/annotations.json'))] == ['1', '2']
+
+
+def test_tar_range_matches_the_full_archive(collection):
+    plan = plan_export(collection, 'tar', 'json', ['inputs', 'cropped'])
+    data = b''.join(stream_tar(plan))
+
+    # Starts inside the annotations header and ends inside an image.
+    start, end = 100, plan.size // 2
+    assert b''.join(stream_tar(plan, start, end)) == data[start:end + 1]
+    assert b''.join(stream_tar(plan, plan.size - 1)) == data[-1:]
+
+
+def test_zip_export_is_valid(collection):
+    plan = plan_export(collection, 'zip', 'coco', ['inputs'])
+    data = b''.join(stream_zip(plan))
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ['c/annotations_coco.json', 'c/inputs/empty.jpg', 'c/inputs/hyena.jpg']
+        coco = json.loads(archive.read('c/annotations_coco.json'))
+
+    # Images without detections are listed, but add no annotation or category.
+    assert [(i['file_name'], i['width'], i['height']) for i in coco['images']] == [
+        ('empty.jpg', 64, 48), ('hyena.jpg', 320, 240)
+    ]
+    assert coco['categories'] == [{'id': 1, 'name': 'Crocuta_crocuta'}]
+    assert [(a['bbox'], a['area'], a['category_id']) for a in coco['annotations']] == [([10, 20, 30, 40], 1200, 1)]
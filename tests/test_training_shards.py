@@ -0,0 +1,33 @@
+import PIL.Image
+
+from api.data_models.species import Species
+from api.training_shards import write_training_shard, list_training_samples, list_training_shards, read_shard_index
+
+
+def test_promoting_the_same_annotation_twice_keeps_one_sample(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crop = str(tmp_path / 'crop.jpg')
+    PIL.Image.new('RGB', (32, 32)).save(crop)
+    species = Species('Crocuta_crocuta')
+
+    first = write_training_shard(species, [('Zoe/annotation-1.jpg', crop)])
+    second = write_training_shard(species, [('Zoe/annotation-1.jpg', crop)])
+
+    assert first is not None
+    assert second is None
+    assert list_training_shards(species) == [first]
+    samples = list_training_samples(species)
+    assert [(s.name, s.file_name.split('/')[-1]) for s in samples] == [('Zoe', 'annotation-1.jpg')]
+
+
+def test_new_annotations_are_added_next_to_promoted_ones(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crop = str(tmp_path / 'crop.jpg')
+    PIL.Image.new('RGB', (32, 32)).save(crop)
+    species = Species('Crocuta_crocuta')
+
+    write_training_shard(species, [('Zoe/annotation-1.jpg', crop)])
+    shard = write_training_shard(species, [('Zoe/annotation-1.jpg', crop), ('Ada/annotation-2.jpg', crop)])
+
+    assert [e['member'] for e in read_shard_index(shard)['samples']] == ['Ada/annotation-2.jpg']
+    assert len(list_training_samples(species)) == 2